@@ -0,0 +1,125 @@
+#------------------------------- Adaptive batch sizing -------------------------------#
+# Instead of a fixed batch_size, the runner asks AdaptiveBatchSizer how many
+# rows to generate next:
+#   - the first size comes from the safe size remembered for the model, or
+#     from token_budget / (max prompt + max_new_tokens), or batch_size
+#   - after `grow_after` successful batches the size doubles (capped by
+#     max_size and, once a size has failed, bisected towards it)
+#   - an out-of-memory error halves the size; the runner re-queues the
+#     failed rows, so only that batch is retried
+# The safe size and the smallest failing size are kept per model
+# (optionally in a JSON file), so the next run neither starts small nor
+# repeats the OOM.
+# OOMAbove injects fake OOMs, so all of this can be exercised on CPU.
+
+import os
+import json
+import torch
+
+
+def is_oom(exc):
+    if isinstance(exc, torch.OutOfMemoryError):
+        return True
+    return isinstance(exc, RuntimeError) and "out of memory" in str(exc).lower()
+
+
+class OOMAbove:
+    """
+    Fault injector for UnifiedLLMRunner(oom_injector=...): raises an
+    out-of-memory error whenever a batch has more than max_rows rows.
+    """
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.raised = 0
+
+    def __call__(self, rows):
+        if rows > self.max_rows:
+            self.raised += 1
+            raise torch.OutOfMemoryError(
+                f"CUDA out of memory (injected: {rows} rows > {self.max_rows})"
+            )
+
+
+class AdaptiveBatchSizer:
+
+    def __init__(self, initial, max_size, grow_after=2, ceiling=None):
+        self.size = max(1, min(initial, max_size))
+        self.max_size = max_size
+        self.grow_after = grow_after
+        # Smallest size that failed; growth stays below it
+        self.ceiling = ceiling
+        # Largest size that succeeded
+        self.safe = 0
+        self.streak = 0
+        self.ooms = 0
+
+    def success(self, rows):
+        self.safe = max(self.safe, rows)
+        if rows < self.size:
+            # Short tail batch, says nothing about the current size
+            return
+        self.streak += 1
+        if self.streak >= self.grow_after:
+            self.streak = 0
+            self.grow()
+
+    def grow(self):
+        target = min(self.size * 2, self.max_size)
+        if self.ceiling is not None:
+            target = min(target, (self.size + self.ceiling) // 2)
+        self.size = max(self.size, target)
+
+    def failure(self, rows):
+        """
+        Record an OOM at `rows`; returns the size to retry with.
+        """
+        self.ooms += 1
+        self.streak = 0
+        if rows <= 1:
+            raise RuntimeError("Out of memory with a single-row batch")
+        self.ceiling = rows if self.ceiling is None else min(self.ceiling, rows)
+        self.size = max(1, rows // 2)
+        return self.size
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "safe": self.safe,
+            "ceiling": self.ceiling,
+            "ooms": self.ooms,
+        }
+
+
+class SafeBatchSizes:
+    """
+    model_id -> {"safe": largest size that generated without OOM,
+    "ceiling": smallest size that ran out of memory (or None)}, kept in
+    memory and (if path is set) in a JSON file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.sizes = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.sizes = json.load(f)
+
+    def get(self, model_id):
+        return self.sizes.get(model_id)
+
+    def update(self, model_id, sizer):
+        previous = self.sizes.get(model_id, {"safe": 0, "ceiling": None})
+        ceilings = [c for c in (previous["ceiling"], sizer.ceiling) if c is not None]
+        ceiling = min(ceilings) if ceilings else None
+        safe = max(previous["safe"], sizer.safe)
+        if ceiling is not None:
+            safe = min(safe, ceiling - 1)
+        if safe <= 0:
+            return
+        self.sizes[model_id] = {"safe": safe, "ceiling": ceiling}
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.sizes, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
@@ -0,0 +1,195 @@
+#------------------------------- Generation backends -------------------------------#
+# UnifiedLLMRunner(backend=...) picks who turns chat messages into text:
+#   "transformers": the in-process HF model (the runner's own batch stages)
+#   "openai":       a local OpenAI-compatible server (vLLM, llama.cpp
+#                   server, TGI, ...) over pooled keep-alive HTTP
+#                   connections, with at most max_concurrency requests in
+#                   flight
+#   "llamacpp":     a GGUF model in process through llama-cpp-python (CPU)
+# Prompts, output cleaning and the results JSONL are the same for all.
+
+import json
+import time
+import queue
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+BACKENDS = ("transformers", "openai", "llamacpp")
+
+# Overloaded / restarting server: worth another try
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to one host, reused across requests.
+    """
+
+    def __init__(self, base_url, size=8, timeout=120):
+        parts = urlsplit(base_url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.opened = 0
+
+    def _connect(self):
+        self.opened += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        (status, response bytes). A stale keep-alive connection (closed by
+        the server while idle) is replaced and the request sent once more.
+        """
+        for attempt in range(2):
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                conn.request(method, self.base_path + path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self.idle.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class OpenAIBackend:
+
+    def __init__(self, base_url="http://127.0.0.1:8000/v1", api_key=None,
+                 max_concurrency=8, timeout=120, retries=2):
+        """
+        base_url: server root including /v1. max_concurrency bounds both
+        the in-flight requests and the pooled connections. Requests failing
+        with a RETRY_STATUSES code are retried `retries` times with backoff.
+        """
+        self.retries = retries
+        self.pool = ConnectionPool(base_url, max_concurrency, timeout)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="openai")
+        self.headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.model = None
+        self.settings = {}
+
+    def open(self, model_name, model_id, settings):
+        """
+        settings: max_new_tokens and json_mode (response_format json_object).
+        """
+        self.model = model_id
+        self.settings = settings
+
+    def complete(self, messages):
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.settings["max_new_tokens"],
+            "temperature": 0.0,
+            "top_p": 1.0,
+        }
+        if self.settings.get("json_mode"):
+            payload["response_format"] = {"type": "json_object"}
+
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(self.retries + 1):
+            status, data = self.pool.request("POST", "/chat/completions", body, self.headers)
+            if status not in RETRY_STATUSES or attempt == self.retries:
+                break
+            time.sleep(0.5 * 2 ** attempt)
+
+        if status != 200:
+            raise RuntimeError(f"{self.model}: HTTP {status}: {data[:200].decode('utf-8', 'replace')}")
+        return json.loads(data)["choices"][0]["message"]["content"] or ""
+
+    def generate(self, conversations):
+        """
+        Text per conversation, in order; requests run concurrently.
+        """
+        return list(self.executor.map(self.complete, conversations))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+
+class LlamaCppBackend:
+
+    def __init__(self, n_ctx=4096, n_threads=None, n_gpu_layers=0):
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_gpu_layers = n_gpu_layers
+        self.llm = None
+        self.settings = {}
+
+    def open(self, model_name, model_id, settings):
+        """
+        model_id: path to a .gguf file.
+        """
+        try:
+            from llama_cpp import Llama
+        except ImportError as exc:
+            raise ImportError("backend='llamacpp' needs llama-cpp-python") from exc
+
+        self.settings = settings
+        self.llm = Llama(
+            model_path=model_id,
+            n_ctx=self.n_ctx,
+            n_threads=self.n_threads,
+            n_gpu_layers=self.n_gpu_layers,
+            verbose=False
+        )
+
+    def generate(self, conversations):
+        outputs = []
+        for messages in conversations:
+            kwargs = {}
+            if self.settings.get("json_mode"):
+                kwargs["response_format"] = {"type": "json_object"}
+            result = self.llm.create_chat_completion(
+                messages=messages,
+                max_tokens=self.settings["max_new_tokens"],
+                temperature=0.0,
+                top_p=1.0,
+                **kwargs
+            )
+            outputs.append(result["choices"][0]["message"]["content"] or "")
+        return outputs
+
+    def close(self):
+        self.llm = None
+
+
+def make_backend(name, options=None):
+    options = options or {}
+    if name == "openai":
+        return OpenAIBackend(**options)
+    if name == "llamacpp":
+        return LlamaCppBackend(**options)
+    raise ValueError(f"No backend object for {name!r}")
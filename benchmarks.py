@@ -0,0 +1,469 @@
+#------------------------------- Offline benchmark harness -------------------------------#
+# Reproducible CPU-only benchmarks of the runner and parser hot paths:
+#   python benchmarks.py --model stub --comments 2000 --output bench.json
+#   python benchmarks.py --model tiny --comments 200 --compare bench.json
+# Models:
+#   stub: returns canned JSON outputs without any forward pass, so the
+#         numbers are the runner's own overhead (templating, tokenization,
+#         decoding, repair, writing)
+#   tiny: a randomly initialised 2-layer Llama built from a config, with a
+#         byte-level BPE tokenizer trained on the prompt text (no downloads)
+# CPU modes (weight dtype x threads x torch.compile) on the tiny model, or
+# on a small pretrained causal LM given by --cpu-model:
+#   python benchmarks.py --cpu-modes float32,bfloat16,int8 --threads 1,4
+#   python benchmarks.py --cpu-modes float32,int8 --cpu-model HuggingFaceTB/SmolLM2-135M-Instruct
+# Everything is seeded; the report is JSON (stdout or --output).
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+import torch
+
+from llm_runner import UnifiedLLMRunner
+from prompts import build_prompt_appearance
+from json_scanner import benchmark_repair, sample_outputs
+from output_parser import parse_appearance_output_file
+from parallel_parser import parse_output_files
+from metrics import generated_lengths
+from prompt_renderer import PromptRenderer, compare_with_full
+
+WORDS = (
+    "she he they looks look ugly pretty beautiful dress hair face body nice great "
+    "awful the a is her his you so very love hate wear shirt fat thin old young "
+    "makeup smile eyes legs skirt outfit clean dirty messy gorgeous hideous "
+    "policy vote speech news today game team win lost crazy stupid smart"
+).split()
+
+CANNED_OUTPUTS = [
+    '{"contains_appearance": true, "appearance_sub_category": "body_features", '
+    '"appearance_valence": "negative", "segments": ["so fat"], "reason": "Insults her body."}',
+    '{"contains_appearance": false, "appearance_sub_category": null, '
+    '"appearance_valence": null, "segments": [], "reason": "No reference to looks."}',
+    '```json\n{"contains_appearance": true, "appearance_sub_category": "facial_features", '
+    '"appearance_valence": "positive", "segments": ["pretty face"], "reason": "Compliments her face."}\n```',
+    'Here is the JSON:\n{"contains_appearance": "true", "appearance_sub_category": '
+    '"clothing_or_dress", "appearance_valence": "neutral", "segments": ["red dress"], "reason": "Describes',
+]
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+
+# -------------------------
+# Synthetic data
+# -------------------------
+
+def synthetic_corpus(n, length_dist="tweet", mean_words=20, seed=0):
+    """
+    [(cid, text)] with word counts drawn from:
+      tweet:   log-normal around mean_words, capped at 4x
+      uniform: 1 .. 2 * mean_words
+      fixed:   exactly mean_words
+    """
+    rng = random.Random(seed)
+    comments = []
+    for i in range(n):
+        if length_dist == "tweet":
+            words = int(min(max(1, rng.lognormvariate(0, 0.6) * mean_words), 4 * mean_words))
+        elif length_dist == "uniform":
+            words = rng.randint(1, 2 * mean_words)
+        elif length_dist == "fixed":
+            words = mean_words
+        else:
+            raise ValueError(f"Unknown length distribution: {length_dist}")
+        comments.append((str(i), " ".join(rng.choices(WORDS, k=words))))
+    return comments
+
+
+# -------------------------
+# Models
+# -------------------------
+
+def build_tokenizer(vocab_size=2048):
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    specials = ["<pad>", "<eos>", "<|system|>", "<|user|>", "<|assistant|>"]
+    texts = [build_prompt_appearance(text) for _, text in synthetic_corpus(200)]
+    texts += CANNED_OUTPUTS * 20
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=specials,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+
+    wrapped = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<eos>", pad_token="<pad>"
+    )
+    wrapped.chat_template = CHAT_TEMPLATE
+    wrapped.padding_side = "left"
+    return wrapped
+
+
+def build_tiny_model(tokenizer, hidden_size=64, layers=2, seed=0):
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=4096,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model
+
+
+class StubModel(torch.nn.Module):
+    """
+    model.generate stand-in: every row gets the next canned output
+    (tokenized once), padded with EOS to the batch's longest.
+    """
+
+    def __init__(self, tokenizer, outputs=CANNED_OUTPUTS):
+        super().__init__()
+        self.anchor = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.outputs = [
+            tokenizer(text, add_special_tokens=False)["input_ids"] + [self.eos_token_id]
+            for text in outputs
+        ]
+        self.calls = 0
+
+    def forward(self, *args, **kwargs):
+        raise NotImplementedError("StubModel only supports generate()")
+
+    def generate(self, input_ids, max_new_tokens=180, **kwargs):
+        rows = []
+        for _ in range(input_ids.shape[0]):
+            rows.append(self.outputs[self.calls % len(self.outputs)][:max_new_tokens])
+            self.calls += 1
+        width = max(len(row) for row in rows)
+        generated = torch.full((len(rows), width), self.eos_token_id, dtype=torch.long)
+        for i, row in enumerate(rows):
+            generated[i, :len(row)] = torch.tensor(row)
+        return torch.cat([input_ids, generated.to(input_ids.device)], dim=1)
+
+
+class BenchmarkRunner(UnifiedLLMRunner):
+    """
+    UnifiedLLMRunner on a prebuilt model (cast to the runner's CPU dtype),
+    or on model_id from the hub when model is None; counts generated tokens.
+    """
+
+    def __init__(self, model, tokenizer, **kwargs):
+        super().__init__(device="cpu", **kwargs)
+        self.bench_model = model
+        self.bench_tokenizer = tokenizer
+        self.generated_tokens = 0
+
+    def load_pretrained(self, model_id):
+        if self.bench_model is None:
+            return super().load_pretrained(model_id)
+        if isinstance(self.bench_model, StubModel):
+            return self.bench_model, self.bench_tokenizer
+        return self.bench_model.to(self.cpu_torch_dtype()), self.bench_tokenizer
+
+    def generate_batch(self, session, job):
+        job = super().generate_batch(session, job)
+        if job["generated"] is not None:
+            eos = session["tokenizer"].eos_token_id
+            self.generated_tokens += int(generated_lengths(job["generated"], eos).sum())
+        return job
+
+
+# -------------------------
+# Benchmarks
+# -------------------------
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_generation(model_kind, comments, workdir, batch_size=8, max_new_tokens=64,
+                     engine="static", schedule="fixed", pipeline=False, model_id=None,
+                     **runner_kwargs):
+    """
+    model_id: hub id of a pretrained causal LM (with a chat template),
+    used instead of the stub / tiny model. runner_kwargs go to the runner
+    (e.g. cpu_dtype, num_threads, compile_decode).
+    """
+    tokenizer = model = None
+    if model_id is not None:
+        model_kind = "pretrained"
+    else:
+        tokenizer = build_tokenizer()
+        if model_kind == "stub":
+            if engine != "static":
+                raise ValueError("The stub model only supports the static engine")
+            model = StubModel(tokenizer)
+        else:
+            model = build_tiny_model(tokenizer)
+
+    runner = BenchmarkRunner(
+        model, tokenizer,
+        batch_size=batch_size,
+        max_new_tokens=max_new_tokens,
+        engine=engine,
+        schedule=schedule,
+        pipeline=pipeline,
+        output_base=workdir,
+        **runner_kwargs
+    )
+    runner.datasetName = "bench"
+
+    start = time.perf_counter()
+    runner.process_dataset(comments, model_kind, model_id or model_kind)
+    seconds = time.perf_counter() - start
+
+    # A speculative probe generates its batch twice; only one run counts
+    probe = runner.last_speculative_probe
+    probe_seconds = probe["speculative_seconds"] if probe else 0.0
+    seconds -= probe_seconds
+
+    tokens = runner.generated_tokens
+    if engine == "continuous":
+        tokens = runner.last_engine_stats["generated_tokens"]
+
+    return {
+        "model": model_kind,
+        "engine": engine,
+        "schedule": schedule,
+        "pipeline": pipeline,
+        "batch_size": batch_size,
+        "max_new_tokens": max_new_tokens,
+        "comments": len(comments),
+        "seconds": seconds,
+        "comments_per_sec": len(comments) / seconds if seconds else 0.0,
+        "generated_tokens": tokens,
+        "tokens_per_sec": tokens / seconds if seconds else 0.0,
+        "stages": runner.last_stage_times,
+        "speculative_probe_seconds": probe_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }, runner.output_path(model_kind)
+
+
+def bench_cpu_modes(comments, workdir, dtypes=("float32",), threads=(None,), compile_decode=False,
+                    model_id=None, batch_size=8, max_new_tokens=64):
+    """
+    Generation throughput for every CPU weight dtype x thread count
+    (x with / without torch.compile). The first compiled run includes
+    the compilation time, so compiled modes also report a warm rerun.
+    """
+    results = []
+    for dtype in dtypes:
+        for num_threads in threads:
+            for compiled in ((False, True) if compile_decode else (False,)):
+                previous_threads = torch.get_num_threads()
+                kwargs = dict(
+                    batch_size=batch_size, max_new_tokens=max_new_tokens, model_id=model_id,
+                    cpu_dtype=dtype, num_threads=num_threads, compile_decode=compiled,
+                )
+                try:
+                    report, output = bench_generation("tiny", comments, workdir, **kwargs)
+                    if compiled:
+                        os.remove(output)
+                        warm, output = bench_generation("tiny", comments, workdir, **kwargs)
+                        report["warm_tokens_per_sec"] = warm["tokens_per_sec"]
+                    os.remove(output)
+                finally:
+                    torch.set_num_threads(previous_threads)
+
+                results.append({
+                    "cpu_dtype": dtype,
+                    "threads": num_threads or previous_threads,
+                    "compile": compiled,
+                    "seconds": report["seconds"],
+                    "generated_tokens": report["generated_tokens"],
+                    "tokens_per_sec": report["tokens_per_sec"],
+                    "warm_tokens_per_sec": report.get("warm_tokens_per_sec"),
+                    "comments_per_sec": report["comments_per_sec"],
+                })
+    return results
+
+
+def bench_prompts(comments, model_name="llama3_8b", batch_size=16):
+    """
+    Per-comment chat-template render + full tokenization vs the memoized
+    PromptRenderer, on the benchmark tokenizer; checks token equality.
+    """
+    tokenizer = build_tokenizer()
+    runner = UnifiedLLMRunner(device="cpu")
+    renderer = PromptRenderer(
+        tokenizer,
+        lambda comment: runner.render_prompt(tokenizer, comment, model_name),
+    )
+    return compare_with_full(renderer, [text for _, text in comments], batch_size)
+
+
+def bench_parse(comments, workdir, records=20000, workers=2):
+    """
+    Serial and parallel parse of a synthetic results file.
+    """
+    texts = [text for text, _ in sample_outputs(records // 2 + 1)][:records]
+    results = os.path.join(workdir, "parse_bench_results.jsonl")
+    with open(results, "w") as f:
+        for i, text in enumerate(texts):
+            f.write(json.dumps({"model": "bench", "cid": str(i), "raw_output": text}) + "\n")
+    size = os.path.getsize(results)
+    lookup = dict(comments)
+
+    start = time.perf_counter()
+    parse_appearance_output_file(results, lookup, os.path.join(workdir, "parsed", "serial.csv"))
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parse_output_files(
+        [{"task": "appearance", "input": results, "output": os.path.join(workdir, "parsed", "parallel.csv")}],
+        lookup,
+        workers=workers,
+        chunk_bytes=max(size // (4 * workers), 1)
+    )
+    parallel = time.perf_counter() - start
+
+    return {
+        "records": len(texts),
+        "bytes": size,
+        "serial_rows_per_sec": len(texts) / serial if serial else 0.0,
+        "serial_mb_per_sec": size / serial / 1e6 if serial else 0.0,
+        "parallel_workers": workers,
+        "parallel_rows_per_sec": len(texts) / parallel if parallel else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare_reports(baseline, current, prefix=""):
+    """
+    {dotted.key: current / baseline} for every numeric value in both.
+    """
+    ratios = {}
+    for key, value in current.items():
+        if key not in baseline:
+            continue
+        name = prefix + key
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            ratios.update(compare_reports(baseline[key], value, name + "."))
+        elif (isinstance(value, (int, float)) and not isinstance(value, bool)
+              and isinstance(baseline[key], (int, float)) and baseline[key]):
+            ratios[name] = value / baseline[key]
+    return ratios
+
+
+def run_benchmarks(args):
+    comments = synthetic_corpus(args.comments, args.length_dist, args.mean_words, args.seed)
+
+    report = {
+        "commit": git_commit(),
+        "torch_threads": torch.get_num_threads(),
+        "corpus": {
+            "comments": args.comments,
+            "length_dist": args.length_dist,
+            "mean_words": args.mean_words,
+            "seed": args.seed,
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Runner chatter goes to stderr; stdout stays machine-readable
+        with contextlib.redirect_stdout(sys.stderr):
+            report["generation"], _ = bench_generation(
+                args.model, comments, workdir,
+                batch_size=args.batch_size,
+                max_new_tokens=args.max_new_tokens,
+                engine=args.engine,
+                schedule=args.schedule,
+                pipeline=args.pipeline,
+            )
+            report["parse"] = bench_parse(comments, workdir, args.parse_records, args.workers)
+            report["repair"] = benchmark_repair()
+            if args.prompt_comments:
+                report["prompts"] = bench_prompts(
+                    synthetic_corpus(args.prompt_comments, args.length_dist, args.mean_words, args.seed)
+                )
+            if args.cpu_modes:
+                report["cpu_modes"] = bench_cpu_modes(
+                    comments, workdir,
+                    dtypes=args.cpu_modes.split(","),
+                    threads=[int(n) for n in args.threads.split(",")] if args.threads else [None],
+                    compile_decode=args.compile,
+                    model_id=args.cpu_model,
+                    batch_size=args.batch_size,
+                    max_new_tokens=args.max_new_tokens,
+                )
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline runner/parser benchmarks")
+    parser.add_argument("--model", choices=["stub", "tiny"], default="stub")
+    parser.add_argument("--comments", type=int, default=500)
+    parser.add_argument("--length-dist", choices=["tweet", "uniform", "fixed"], default="tweet")
+    parser.add_argument("--mean-words", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--engine", choices=["static", "continuous"], default="static")
+    parser.add_argument("--schedule", choices=["fixed", "length"], default="fixed")
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--parse-records", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--prompt-comments", type=int, default=5000,
+                        help="comments for the prompt rendering benchmark (0 skips it)")
+    parser.add_argument("--cpu-modes", help="comma-separated CPU dtypes to compare (float32,bfloat16,int8)")
+    parser.add_argument("--threads", help="comma-separated thread counts for --cpu-modes")
+    parser.add_argument("--compile", action="store_true", help="also run --cpu-modes with torch.compile")
+    parser.add_argument("--cpu-model", help="hub id of a small causal LM for --cpu-modes (default: tiny)")
+    parser.add_argument("--output", help="write the JSON report here as well")
+    parser.add_argument("--compare", help="baseline report; prints current/baseline ratios")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    report = run_benchmarks(args)
+    if baseline is not None:
+        report["vs_baseline"] = compare_reports(baseline, report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
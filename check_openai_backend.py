@@ -0,0 +1,113 @@
+# Self-contained check of the "openai" backend against a local stub server
+# (no GPU, no model, no network). The stub answers the first request with
+# 503 and every later one with a fixed JSON completion. Checks:
+#   - the 503 is retried once and the run still writes every comment
+#   - every request (retry included) goes over one pooled keep-alive
+#     connection
+#   - a second run with the same output cache sends no request at all
+#
+#   python check_openai_backend.py
+
+import os
+import json
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from llm_runner import UnifiedLLMRunner
+
+COMPLETION = (
+    '{"contains_appearance": true, "appearance_sub_category": "body_features", '
+    '"appearance_valence": "negative", "segments": ["so fat"], "reason": "Insults her body."}'
+)
+
+COMMENTS = [(str(i), f"stub comment number {i}") for i in range(10)]
+
+
+# -------------------------
+# Stub server
+# -------------------------
+
+class StubServer:
+    """
+    OpenAI-compatible /v1/chat/completions on 127.0.0.1; the first
+    `failures` requests get a 503.
+    """
+
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.requests = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with server.lock:
+                    server.requests += 1
+                    server.connections.add(self.client_address)
+                    failing = server.requests <= server.failures
+
+                if failing:
+                    status, body = 503, {"error": "overloaded"}
+                else:
+                    status, body = 200, {"choices": [{"message": {"content": COMPLETION}}]}
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# -------------------------
+# Check
+# -------------------------
+
+def run(server, workdir):
+    runner = UnifiedLLMRunner(
+        task="appearance", batch_size=4,
+        backend="openai",
+        backend_options={"base_url": server.base_url, "max_concurrency": 1},
+        cache_path=os.path.join(workdir, "output_cache.sqlite"),
+        output_base=workdir
+    )
+    runner.run_all(COMMENTS, "stub", models={"llama_stub": "stub-model"})
+    with open(runner.output_path("llama_stub"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def main():
+    server = StubServer(failures=1)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            records = run(server, workdir)
+            assert sorted(record["cid"] for record in records) == sorted(cid for cid, _ in COMMENTS)
+            assert all(json.loads(record["raw_output"]) == json.loads(COMPLETION) for record in records)
+            assert server.requests == len(COMMENTS) + 1, f"expected one retry, saw {server.requests} requests"
+            assert len(server.connections) == 1, f"expected one pooled connection, saw {len(server.connections)}"
+            print(f"✅ 503 retried once, {server.requests} requests over 1 connection")
+
+            rerun = run(server, workdir)
+            assert server.requests == len(COMMENTS) + 1, "rerun reached the server instead of the cache"
+            assert rerun == records
+            print(f"✅ Rerun served all {len(rerun)} comments from the output cache")
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#------------------------------- Resumable results files -------------------------------#
+# Results JSONL is append-only. Each batch is written with a single write +
+# fsync, then committed to an index sidecar (<results>.idx) that records the
+# batch's cids and the byte offset the file ends at. On resume only bytes
+# past the last committed offset are parsed; a half-written tail line is
+# truncated away so it can never corrupt the file.
+
+import os
+import json
+
+
+class ResultsCheckpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+
+    # -------------------------
+    # Index sidecar
+    # -------------------------
+    def _read_index(self):
+        """
+        Returns (completed cids, committed offset, index was clean).
+        """
+        completed = set()
+        offset = 0
+        clean = True
+
+        if not os.path.exists(self.index_path):
+            return completed, offset, False
+
+        with open(self.index_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last entry from a crash mid-commit
+                    clean = False
+                    break
+                completed.update(entry["cids"])
+                offset = entry["offset"]
+
+        return completed, offset, clean
+
+    def _rewrite_index(self, completed, offset):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"offset": offset, "cids": sorted(completed, key=str)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def _commit(self, cids, offset):
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps({"offset": offset, "cids": list(cids)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def reset(self):
+        """
+        Start a fresh run: truncate the results file and drop the index.
+        """
+        with open(self.path, "w"):
+            pass
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def recover(self):
+        """
+        Set of cids already written. Parses only the un-indexed tail of the
+        results file and truncates it back to the last complete record.
+        """
+        if not os.path.exists(self.path):
+            self.reset()
+            return set()
+
+        completed, offset, clean = self._read_index()
+        size = os.path.getsize(self.path)
+
+        if offset > size:
+            # File was replaced or truncated behind the index's back
+            completed, offset, clean = set(), 0, False
+
+        recovered = []
+        good_end = offset
+
+        if size > offset:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    recovered.append(record["cid"])
+                    good_end += len(line)
+
+            if good_end < size:
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_end)
+
+        completed.update(recovered)
+
+        if not clean:
+            self._rewrite_index(completed, good_end)
+        elif recovered:
+            self._commit(recovered, good_end)
+
+        return completed
+
+    def append(self, records):
+        """
+        Append one batch of records atomically and commit their cids.
+        """
+        if not records:
+            return
+
+        data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+
+        self._commit([record["cid"] for record in records], offset)
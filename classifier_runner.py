@@ -0,0 +1,247 @@
+#------------------------------- Encoder classifier runner -------------------------------#
+# Produces the {cid, label, confidence} JSONL that
+# output_parser.parse_gbv_classifier_output_file reads, for the models in
+# CLASSIFIER_MODELS. Same dataset / output-file / resume conventions as
+# UnifiedLLMRunner.
+#   - models whose tokenizers are identical are grouped: each window of
+#     comments is tokenized once and every model in the group scores it
+#   - dynamic padding: rows are sorted by length inside a window and each
+#     batch is padded only to its own longest row
+#   - CPU: optional int8 dynamic quantization, or ONNX Runtime via optimum
+
+import os
+import gc
+import hashlib
+import json
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from tqdm import tqdm
+
+from model_registry import CLASSIFIER_MODELS
+from checkpoint import ResultsCheckpoint
+from comment_stream import batched, ExcludedComments
+
+TASK_NAME = "gbv_classifier"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Identical for tokenizers that produce the same ids for any text.
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        payload = backend.to_str()
+    else:
+        payload = json.dumps(
+            [type(tokenizer).__name__, sorted(tokenizer.get_vocab().items()),
+             tokenizer.init_kwargs.get("do_lower_case"),
+             tokenizer.init_kwargs.get("normalization")],
+            default=str
+        )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ClassifierRunner:
+
+    def __init__(self, batch_size=64, max_length=128, window=4096,
+                 device=None, quantize=False, onnx=False, resume=False,
+                 onnx_dir="/datasets/cl0059/outputs/onnx_models",
+                 output_base="/datasets/cl0059/outputs/llm_results"):
+        """
+        device: "cuda", "cuda:N" or "cpu"; defaults to cuda when available.
+        quantize: int8 dynamic quantization of Linear layers (CPU only; with
+        onnx=True the exported graph is quantized instead).
+        onnx: run with ONNX Runtime through optimum (CPU); models are
+        exported to onnx_dir once.
+        window: comments tokenized and length-sorted together.
+        """
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.window = window
+        self.quantize = quantize
+        self.onnx = onnx
+        self.onnx_dir = onnx_dir
+        self.resume = resume
+
+        if (quantize or onnx) and self.device != "cpu":
+            raise ValueError("quantize/onnx are CPU inference options")
+
+        self.datasetName = "unKNOWN"
+
+        # ⚠ Use absolute path in production; created by process_group
+        self.output_base = output_base
+
+    # -------------------------
+    # Loading
+    # -------------------------
+    def load_model(self, model_name, model_id):
+        if self.onnx:
+            return self.load_onnx_model(model_name, model_id)
+
+        dtype = torch.float16 if self.device.startswith("cuda") else torch.float32
+        model = AutoModelForSequenceClassification.from_pretrained(model_id, torch_dtype=dtype)
+        model.to(self.device)
+        model.eval()
+
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def load_onnx_model(self, model_name, model_id):
+        try:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+        except ImportError as exc:
+            raise ImportError("onnx=True needs optimum[onnxruntime]") from exc
+
+        export_dir = os.path.join(self.onnx_dir, model_name)
+        if not os.path.exists(os.path.join(export_dir, "model.onnx")):
+            model = ORTModelForSequenceClassification.from_pretrained(model_id, export=True)
+            model.save_pretrained(export_dir)
+
+        if not self.quantize:
+            return ORTModelForSequenceClassification.from_pretrained(export_dir)
+
+        quantized = os.path.join(export_dir, "model_quantized.onnx")
+        if not os.path.exists(quantized):
+            from optimum.onnxruntime import ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            quantizer = ORTQuantizer.from_pretrained(export_dir)
+            quantizer.quantize(
+                save_dir=export_dir,
+                quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            )
+        return ORTModelForSequenceClassification.from_pretrained(
+            export_dir, file_name="model_quantized.onnx"
+        )
+
+    def group_models(self, models):
+        """
+        [(tokenizer, {model_name: model_id})] with one entry per distinct
+        tokenizer.
+        """
+        groups = {}
+        for model_name, model_id in models.items():
+            tokenizer = AutoTokenizer.from_pretrained(model_id)
+            key = tokenizer_fingerprint(tokenizer)
+            if key not in groups:
+                groups[key] = (tokenizer, {})
+            groups[key][1][model_name] = model_id
+        return list(groups.values())
+
+    # -------------------------
+    # Output
+    # -------------------------
+    def output_path(self, model_name):
+        return os.path.join(
+            self.output_base,
+            f"{model_name}_{TASK_NAME}_results_{self.datasetName}.jsonl"
+        )
+
+    # -------------------------
+    # Inference
+    # -------------------------
+    def batches(self, tokenizer, comments):
+        """
+        Yields (window, [(row indices, padded inputs)]) per window:
+        rows sorted by token length, each batch padded to its own max.
+        """
+        max_length = min(self.max_length, tokenizer.model_max_length)
+
+        for window in batched(comments, self.window):
+            encoded = tokenizer(
+                [text for _, text in window],
+                truncation=True,
+                max_length=max_length
+            )
+            order = sorted(range(len(window)), key=lambda k: len(encoded["input_ids"][k]))
+
+            padded = []
+            for i in range(0, len(order), self.batch_size):
+                rows = order[i:i+self.batch_size]
+                inputs = tokenizer.pad(
+                    {name: [values[k] for k in rows] for name, values in encoded.items()},
+                    return_tensors="pt"
+                )
+                padded.append((rows, inputs))
+            yield window, padded
+
+    def predict(self, model, inputs):
+        if not self.onnx:
+            inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+        with torch.no_grad():
+            logits = model(**inputs).logits
+        probs = torch.softmax(torch.as_tensor(logits).float(), dim=-1)
+        confidence, label = probs.max(dim=-1)
+        return label.tolist(), confidence.tolist()
+
+    def process_group(self, comments, tokenizer, models):
+        os.makedirs(self.output_base, exist_ok=True)
+        checkpoints = {}
+        completed = {}
+        for model_name in list(models):
+            checkpoint = ResultsCheckpoint(self.output_path(model_name))
+            if self.resume:
+                completed[model_name] = checkpoint.recover()
+                if all(cid in completed[model_name] for cid, _ in comments):
+                    print(f"⏭ {model_name} already complete")
+                    del models[model_name]
+                    continue
+            else:
+                checkpoint.reset()
+                completed[model_name] = set()
+            checkpoints[model_name] = checkpoint
+
+        if not models:
+            return
+
+        if self.resume:
+            # Only what at least one model of the group still needs
+            done_by_all = set.intersection(*(set(completed[name]) for name in models))
+            comments = ExcludedComments(comments, done_by_all)
+
+        print(f"\n🚀 Running {', '.join(models)}")
+        loaded = {
+            model_name: self.load_model(model_name, model_id)
+            for model_name, model_id in models.items()
+        }
+
+        for window, padded in tqdm(self.batches(tokenizer, comments)):
+            results = {model_name: [None] * len(window) for model_name in loaded}
+
+            for rows, inputs in padded:
+                for model_name, model in loaded.items():
+                    labels, confidences = self.predict(model, inputs)
+                    for k, label, confidence in zip(rows, labels, confidences):
+                        results[model_name][k] = (label, confidence)
+
+            # Written in input order, whatever the length sort did
+            for model_name in loaded:
+                checkpoints[model_name].append([
+                    {
+                        "model": model_name,
+                        "cid": cid,
+                        "label": label,
+                        "confidence": confidence
+                    }
+                    for (cid, _), (label, confidence) in zip(window, results[model_name])
+                    if cid not in completed[model_name]
+                ])
+
+        for model_name in loaded:
+            print(f"✅ Completed {model_name}")
+
+        del loaded
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def run_all(self, comments, datasetName, models=None):
+        self.datasetName = datasetName
+        for tokenizer, group in self.group_models(dict(models or CLASSIFIER_MODELS)):
+            try:
+                self.process_group(comments, tokenizer, group)
+            except Exception as e:
+                print(f"❌ {', '.join(group)} failed: {e}")
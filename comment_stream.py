@@ -0,0 +1,212 @@
+#------------------------------- Streaming comment ingestion -------------------------------#
+# Generators over CSV, JSONL and large {cid: text} JSON files that never
+# hold the whole dataset in memory, plus an on-disk cid -> text lookup for
+# the output parsers (drop-in for the comment_lookup dict).
+
+import os
+import csv
+import json
+import sqlite3
+import itertools
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+# -------------------------
+# Readers
+# -------------------------
+
+def iter_comments_csv(path, id_field="tweet_id", text_field="tweet"):
+    with open(path, "r", newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            yield row[id_field], row[text_field]
+
+
+def iter_comments_jsonl(path, id_field="cid", text_field="text"):
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield record[id_field], record[text_field]
+
+
+def iter_comments_json(path, id_field=None, text_field=None, chunk_size=1 << 16):
+    """
+    Incrementally parse a top-level {cid: text, ...} object, reading
+    `chunk_size` characters at a time. For {key: {record}, ...} files,
+    text_field names the text in each record and id_field (optional) the
+    cid; without id_field the key is the cid.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = file.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                fill()
+
+        def expect(chars):
+            nonlocal pos
+            skip_whitespace()
+            if pos >= len(buffer) or buffer[pos] not in chars:
+                found = buffer[pos:pos+20] if pos < len(buffer) else "end of file"
+                raise ValueError(f"{path}: expected one of {chars!r}, found {found!r}")
+            pos += 1
+            return buffer[pos - 1]
+
+        def decode_value():
+            nonlocal pos
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = _DECODER.raw_decode(buffer, pos)
+                    # A number could continue in the next chunk
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect("{")
+        skip_whitespace()
+        if pos < len(buffer) and buffer[pos] == "}":
+            return
+
+        while True:
+            cid = decode_value()
+            expect(":")
+            value = decode_value()
+            if id_field is not None:
+                cid = value[id_field]
+            yield cid, value[text_field] if text_field is not None else value
+            if expect(",}") == "}":
+                return
+
+
+def iter_comments(path, **kwargs):
+    if path.endswith(".csv"):
+        return iter_comments_csv(path, **kwargs)
+    if path.endswith(".jsonl"):
+        return iter_comments_jsonl(path, **kwargs)
+    if path.endswith(".json"):
+        return iter_comments_json(path, **kwargs)
+    raise ValueError(f"Unsupported comment file: {path}")
+
+
+class CommentStream:
+    """
+    Re-iterable (cid, text) stream over a file: every iteration re-reads
+    it, so run_all can pass the same stream to each model.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter_comments(self.path, **self.kwargs)
+
+
+class ShardedComments:
+    """
+    Every `count`-th comment starting at `shard`, for list or stream input.
+    """
+
+    def __init__(self, comments, shard, count):
+        self.comments = comments
+        self.shard = shard
+        self.count = count
+
+    def __iter__(self):
+        return itertools.islice(iter(self.comments), self.shard, None, self.count)
+
+
+class ExcludedComments:
+    """
+    Comments whose cid is not in `done`.
+    """
+
+    def __init__(self, comments, done):
+        self.comments = comments
+        self.done = done
+
+    def __iter__(self):
+        return ((cid, text) for cid, text in self.comments if cid not in self.done)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# -------------------------
+# cid -> text lookup
+# -------------------------
+
+class CommentStore:
+    """
+    SQLite-backed {cid: text} mapping with the dict methods the parsers
+    use (get, [], in), built from a comment stream.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS comments (cid TEXT PRIMARY KEY, text TEXT)"
+        )
+
+    @classmethod
+    def from_stream(cls, comments, path, batch_size=10000):
+        if os.path.exists(path):
+            os.remove(path)
+        store = cls(path)
+        for batch in batched(comments, batch_size):
+            store._conn.executemany(
+                "INSERT OR REPLACE INTO comments (cid, text) VALUES (?, ?)",
+                [(str(cid), text) for cid, text in batch]
+            )
+        store._conn.commit()
+        return store
+
+    def get(self, cid, default=None):
+        row = self._conn.execute(
+            "SELECT text FROM comments WHERE cid = ?", (str(cid),)
+        ).fetchone()
+        return row[0] if row else default
+
+    def __getitem__(self, cid):
+        text = self.get(cid)
+        if text is None:
+            raise KeyError(cid)
+        return text
+
+    def __contains__(self, cid):
+        return self.get(cid) is not None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,434 @@
+#------------------------------- Continuous batching (retire finished rows early) -------------------------------#
+# Static batching keeps every row of a model.generate call alive until the
+# slowest row finishes. This engine keeps up to `max_slots` sequences in one
+# batched KV cache, drops a row as soon as it hits EOS / its token budget,
+# and prefills the next queued prompt into the freed slot.
+# Repetition penalty: applied to the row's real prompt and generated tokens.
+# HF applies it over the padded input_ids, so in a static batch a
+# left-padded row also penalizes the pad token (the EOS token in the
+# runner), which depends on which rows share its batch. compare_with_static
+# therefore reports padded and unpadded rows separately.
+
+import time
+import torch
+from transformers import DynamicCache
+from transformers import StoppingCriteriaList
+from transformers import LogitsProcessorList
+from json_stopping import JSONStopTracker, StopOnJSONEnd
+from json_grammar import GrammarState, JSONSchemaLogitsProcessor
+
+
+# -------------------------
+# KV cache helpers
+# -------------------------
+
+def cache_layers(cache):
+    """
+    [(keys, values), ...] per layer, each shaped [batch, heads, seq, dim].
+    Works for both the `layers` and the older `key_cache` DynamicCache layouts.
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def build_cache(layers):
+    cache = DynamicCache()
+    for idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, idx)
+    return cache
+
+
+def _left_pad(tensor, length, dim):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def merge_caches(cache_a, mask_a, cache_b, mask_b):
+    """
+    Stack two batched caches along the batch dim, left-padding the shorter
+    one so both share the same sequence length.
+    """
+    length = max(mask_a.shape[1], mask_b.shape[1])
+    layers = [
+        (
+            torch.cat([_left_pad(ka, length, 2), _left_pad(kb, length, 2)], dim=0),
+            torch.cat([_left_pad(va, length, 2), _left_pad(vb, length, 2)], dim=0),
+        )
+        for (ka, va), (kb, vb) in zip(cache_layers(cache_a), cache_layers(cache_b))
+    ]
+    mask = torch.cat([_left_pad(mask_a, length, 1), _left_pad(mask_b, length, 1)], dim=0)
+    return build_cache(layers), mask
+
+
+def select_rows(cache, mask, keep):
+    """
+    Keep only the rows in `keep` and drop leading columns that are
+    padding for every remaining row.
+    """
+    mask = mask[keep]
+    start = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+    layers = [
+        (keys[keep][:, :, start:], values[keep][:, :, start:])
+        for keys, values in cache_layers(cache)
+    ]
+    return build_cache(layers), mask[:, start:]
+
+
+# -------------------------
+# Engine
+# -------------------------
+
+class ContinuousBatchingEngine:
+
+    def __init__(self, model, tokenizer, max_slots=8, max_new_tokens=180,
+                 repetition_penalty=1.1, max_prompt_length=1024, stop_table=None,
+                 grammar=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_slots = max_slots
+        self.max_new_tokens = max_new_tokens
+        self.repetition_penalty = repetition_penalty
+        self.max_prompt_length = max_prompt_length
+        self.device = next(model.parameters()).device
+        self.eos_token_id = tokenizer.eos_token_id
+        # Optional build_json_stop_table() output: retire rows at JSON end
+        self.stop_table = stop_table
+        # Optional json_grammar.SchemaIndex: schema-constrained decoding
+        self.grammar = grammar
+        self.stats = {}
+
+    def _penalize(self, logits, seen):
+        """
+        HF repetition penalty over the `seen` tokens (real tokens only; pad
+        positions are not counted, unlike HF's padded input_ids).
+        """
+        if self.repetition_penalty == 1.0:
+            return logits
+        penalized = torch.where(
+            logits > 0,
+            logits / self.repetition_penalty,
+            logits * self.repetition_penalty
+        )
+        return torch.where(seen, penalized, logits)
+
+    def _next_tokens(self, logits, seen, grammar=None, states=None):
+        logits = self._penalize(logits.float(), seen)
+        if grammar is not None:
+            logits = grammar.apply(logits, states)
+        return logits.argmax(dim=-1)
+
+    def _prefill(self, prompts, grammar=None):
+        enc = self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=self.max_prompt_length
+        ).to(self.device)
+
+        mask = enc["attention_mask"]
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        out = self.model(
+            input_ids=enc["input_ids"],
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True
+        )
+
+        seen = torch.zeros(
+            len(prompts), out.logits.shape[-1],
+            dtype=torch.bool, device=self.device
+        )
+        # Real prompt tokens only. A scatter of the mask would write both
+        # True and False into the pad id when pad == a prompt token (EOS),
+        # and which write wins is undefined
+        rows, cols = mask.nonzero(as_tuple=True)
+        seen[rows, enc["input_ids"][rows, cols]] = True
+
+        # New rows start at the grammar's start state
+        states = grammar.start_states(len(prompts)) if grammar is not None else None
+        next_tokens = self._next_tokens(out.logits[:, -1, :], seen, grammar, states)
+        return out.past_key_values, mask, seen, next_tokens
+
+    def run(self, requests):
+        """
+        requests: iterable of (cid, prompt_text).
+        Yields (cid, generated_token_ids) in completion order.
+        Throughput and slot occupancy are left in self.stats.
+        """
+        queue = iter(requests)
+        exhausted = False
+
+        cids = []
+        generated = []
+        cache = None
+        mask = None
+        seen = None
+        tracker = None
+        if self.stop_table is not None:
+            tracker = JSONStopTracker(self.stop_table, 0, device=self.device)
+        grammar = None
+        if self.grammar is not None:
+            grammar = GrammarState(self.grammar, 0, device=self.device)
+
+        decode_steps = 0
+        occupied = 0
+        total_tokens = 0
+        finished_rows = 0
+        start = time.perf_counter()
+
+        def record(rows, tokens):
+            nonlocal total_tokens
+            if tracker is not None:
+                tracker.update(tokens, torch.tensor(list(rows), device=self.device))
+            if grammar is not None:
+                grammar.update(tokens, torch.tensor(list(rows)))
+            for row, token in zip(rows, tokens.tolist()):
+                generated[row].append(token)
+                seen[row, token] = True
+                total_tokens += 1
+
+        with torch.no_grad():
+            while True:
+
+                # Admit queued prompts into free slots
+                free = self.max_slots - len(cids)
+                if free > 0 and not exhausted:
+                    admitted = []
+                    for _ in range(free):
+                        try:
+                            admitted.append(next(queue))
+                        except StopIteration:
+                            exhausted = True
+                            break
+
+                    if admitted:
+                        new_cache, new_mask, new_seen, new_tokens = self._prefill(
+                            [prompt for _, prompt in admitted], grammar
+                        )
+                        if cache is None:
+                            cache, mask, seen = new_cache, new_mask, new_seen
+                        else:
+                            cache, mask = merge_caches(cache, mask, new_cache, new_mask)
+                            seen = torch.cat([seen, new_seen], dim=0)
+                        first = len(cids)
+                        cids.extend(cid for cid, _ in admitted)
+                        generated.extend([] for _ in admitted)
+                        if tracker is not None:
+                            tracker.extend(len(admitted))
+                        if grammar is not None:
+                            grammar.extend(len(admitted))
+                        record(range(first, len(cids)), new_tokens)
+
+                if not cids:
+                    break
+
+                # Retire rows that hit EOS or their token budget
+                keep = []
+                json_done = tracker.done.tolist() if tracker is not None else [False] * len(cids)
+                for row, tokens in enumerate(generated):
+                    if (tokens[-1] == self.eos_token_id
+                            or len(tokens) >= self.max_new_tokens
+                            or json_done[row]):
+                        finished_rows += 1
+                        yield cids[row], tokens
+                    else:
+                        keep.append(row)
+
+                if len(keep) < len(cids):
+                    cids = [cids[row] for row in keep]
+                    generated = [generated[row] for row in keep]
+                    if keep:
+                        index = torch.tensor(keep, device=self.device)
+                        cache, mask = select_rows(cache, mask, index)
+                        seen = seen[index]
+                        if tracker is not None:
+                            tracker.select(index)
+                        if grammar is not None:
+                            grammar.select(index)
+                    else:
+                        cache = mask = seen = None
+                        if tracker is not None:
+                            tracker.reset(0)
+                        if grammar is not None:
+                            grammar.reset(0)
+
+                    # Refill freed slots before the next decode step
+                    if not exhausted or not cids:
+                        continue
+
+                # One decode step for every active row
+                last_tokens = torch.tensor(
+                    [tokens[-1] for tokens in generated], device=self.device
+                )
+                mask = torch.cat([mask, mask.new_ones(len(cids), 1)], dim=1)
+                position_ids = mask.sum(dim=1, keepdim=True) - 1
+
+                out = self.model(
+                    input_ids=last_tokens[:, None],
+                    attention_mask=mask,
+                    position_ids=position_ids,
+                    past_key_values=cache,
+                    use_cache=True
+                )
+                cache = out.past_key_values
+                record(range(len(cids)), self._next_tokens(out.logits[:, -1, :], seen, grammar))
+
+                decode_steps += 1
+                occupied += len(cids)
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "mode": "continuous",
+            "sequences": finished_rows,
+            "generated_tokens": total_tokens,
+            "seconds": elapsed,
+            "tokens_per_sec": total_tokens / elapsed if elapsed else 0.0,
+            "decode_steps": decode_steps,
+            "slot_occupancy": occupied / (decode_steps * self.max_slots) if decode_steps else 0.0,
+        }
+
+
+# -------------------------
+# Static vs continuous comparison
+# -------------------------
+
+def trim_generated(token_ids, eos_token_id):
+    """
+    Cut a generated row at its first EOS (padding repeats EOS).
+    """
+    if eos_token_id in token_ids:
+        return token_ids[:token_ids.index(eos_token_id)]
+    return token_ids
+
+
+def static_generate_stats(model, tokenizer, prompts, batch_size=8, max_new_tokens=180,
+                          repetition_penalty=1.1, max_prompt_length=1024, stop_table=None,
+                          grammar=None):
+    """
+    Run the current fixed-batch model.generate path and report the same
+    metrics as ContinuousBatchingEngine.stats. Returns (outputs, stats).
+    """
+    device = next(model.parameters()).device
+    outputs = []
+    total_tokens = 0
+    decode_steps = 0
+    occupied = 0
+    slot_steps = 0
+    start = time.perf_counter()
+
+    for i in range(0, len(prompts), batch_size):
+        batch = prompts[i:i+batch_size]
+        inputs = tokenizer(
+            batch,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=max_prompt_length
+        ).to(device)
+
+        with torch.no_grad():
+            result = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                repetition_penalty=repetition_penalty,
+                use_cache=True,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList(
+                    [StopOnJSONEnd(stop_table)] if stop_table is not None else []
+                ),
+                logits_processor=LogitsProcessorList(
+                    [JSONSchemaLogitsProcessor(grammar)] if grammar is not None else []
+                )
+            )
+
+        rows = result[:, inputs["input_ids"].shape[1]:].tolist()
+        for row in rows:
+            row = trim_generated(row, tokenizer.eos_token_id)
+            outputs.append(row)
+            total_tokens += len(row)
+            occupied += len(row)
+
+        # Every row is carried for as many steps as the longest one
+        steps = result.shape[1] - inputs["input_ids"].shape[1]
+        decode_steps += steps
+        slot_steps += steps * len(batch)
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "mode": "static",
+        "sequences": len(prompts),
+        "generated_tokens": total_tokens,
+        "seconds": elapsed,
+        "tokens_per_sec": total_tokens / elapsed if elapsed else 0.0,
+        "decode_steps": decode_steps,
+        "slot_occupancy": occupied / slot_steps if slot_steps else 0.0,
+    }
+    return outputs, stats
+
+
+def compare_with_static(model, tokenizer, prompts, max_slots=8, max_new_tokens=180,
+                        repetition_penalty=1.1, max_prompt_length=1024, stop_table=None,
+                        grammar=None):
+    """
+    Run the same prompts through static batching and the continuous engine.
+    Returns {"static": stats, "continuous": stats, "matching_outputs": n,
+    "unpadded_rows": n, "matching_unpadded": n}. Static rows that were
+    left-padded had their pad token penalized as well (HF semantics; see
+    the module comment), so with repetition_penalty != 1.0 only unpadded
+    rows are expected to match exactly.
+    """
+    static_outputs, static_stats = static_generate_stats(
+        model, tokenizer, prompts,
+        batch_size=max_slots,
+        max_new_tokens=max_new_tokens,
+        repetition_penalty=repetition_penalty,
+        max_prompt_length=max_prompt_length,
+        stop_table=stop_table,
+        grammar=grammar
+    )
+
+    engine = ContinuousBatchingEngine(
+        model, tokenizer,
+        max_slots=max_slots,
+        max_new_tokens=max_new_tokens,
+        repetition_penalty=repetition_penalty,
+        max_prompt_length=max_prompt_length,
+        stop_table=stop_table,
+        grammar=grammar
+    )
+    continuous_outputs = dict(engine.run(enumerate(prompts)))
+
+    matches = [
+        trim_generated(continuous_outputs[i], tokenizer.eos_token_id) == static_outputs[i]
+        for i in range(len(prompts))
+    ]
+
+    # Rows shorter than the longest prompt of their static batch were padded
+    # (lengths as both paths truncated them)
+    lengths = [
+        len(ids) for ids in tokenizer(
+            prompts, truncation=True, max_length=engine.max_prompt_length
+        )["input_ids"]
+    ]
+    padded = [
+        lengths[i] < max(lengths[i - i % max_slots:i - i % max_slots + max_slots])
+        for i in range(len(prompts))
+    ]
+
+    return {
+        "static": static_stats,
+        "continuous": engine.stats,
+        "matching_outputs": sum(matches),
+        "unpadded_rows": padded.count(False),
+        "matching_unpadded": sum(match for match, pad in zip(matches, padded) if not pad),
+    }
@@ -0,0 +1,255 @@
+#------------------------------- Comment deduplication -------------------------------#
+# Reply scrapes repeat the same text under many cids (copies, "RT @user:"
+# retweets). CommentDeduper sits between the comment stream and the batch
+# scheduler:
+#   - comments are keyed by a hash of their normalized text; only the first
+#     comment of each key (the representative) is generated for
+#   - optionally ("near"), MinHash LSH over word shingles also maps
+#     near-identical texts to an earlier representative
+#   - the checkpoint is wrapped so every record written for a
+#     representative is copied to its duplicates' cids in the same append
+# Works on streams: a duplicate that shows up after its representative was
+# written is appended right away from the representative's records, which
+# are kept in a temporary SQLite file (WrittenRecords) rather than in
+# memory, so a long stream only holds keys and pending duplicates.
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import unicodedata
+import numpy as np
+
+_RETWEET = re.compile(r"^rt\s+@\w+:?\s*")
+_MENTIONS = re.compile(r"^(?:@\w+\s+)+")
+_URL = re.compile(r"https?://\S+")
+_SPACE = re.compile(r"\s+")
+
+DEDUP_MODES = ("exact", "near")
+
+
+def normalize_text(text):
+    """
+    Case, Unicode form, whitespace, URLs, a leading "RT @user:" and leading
+    @mentions do not change what the model is asked about.
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower().strip()
+    text = _RETWEET.sub("", text)
+    text = _MENTIONS.sub("", text)
+    text = _URL.sub("<url>", text)
+    return _SPACE.sub(" ", text).strip()
+
+
+def text_key(text):
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+
+
+# -------------------------
+# MinHash LSH
+# -------------------------
+
+_PRIME = (1 << 31) - 1
+
+
+class MinHashIndex:
+    """
+    Near-duplicate lookup: num_perm MinHash values over word shingles,
+    split into `bands` LSH bands; a candidate sharing any band is accepted
+    when its estimated Jaccard similarity is at least `threshold`.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle=3, seed=0):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def signature(self, normalized):
+        words = normalized.split()
+        if len(words) < self.shingle:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {
+                " ".join(words[i:i+self.shingle])
+                for i in range(len(words) - self.shingle + 1)
+            }
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+             for s in shingles],
+            dtype=np.uint64
+        )
+        # a < 2^31, h < 2^32: products fit in uint64
+        return ((hashes[:, None] * self.a[None, :] + self.b[None, :]) % _PRIME).min(axis=0)
+
+    def query_or_add(self, key, normalized):
+        """
+        Key of an indexed near-duplicate of `normalized`, or None after
+        indexing it under `key`.
+        """
+        signature = self.signature(normalized)
+        bands = [
+            signature[i * self.rows:(i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+        seen = set()
+        for band, bucket in zip(bands, self.buckets):
+            for candidate in bucket.get(band, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                    return candidate
+
+        self.signatures[key] = signature
+        for band, bucket in zip(bands, self.buckets):
+            bucket.setdefault(band, []).append(key)
+        return None
+
+
+# -------------------------
+# Written records
+# -------------------------
+
+class WrittenRecords:
+    """
+    Representative cid -> its written records, on disk.
+    """
+
+    def __init__(self, path=None):
+        self.owned = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="dedup-", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS records (cid TEXT, data TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS records_cid ON records (cid)")
+
+    def add(self, records):
+        self._conn.executemany(
+            "INSERT INTO records (cid, data) VALUES (?, ?)",
+            [
+                (str(record["cid"]), json.dumps(record, ensure_ascii=False))
+                for record in records
+            ]
+        )
+        self._conn.commit()
+
+    def get(self, cid):
+        """
+        The cid's records, or None if none were written.
+        """
+        rows = self._conn.execute(
+            "SELECT data FROM records WHERE cid = ? ORDER BY rowid", (str(cid),)
+        ).fetchall()
+        return [json.loads(data) for data, in rows] or None
+
+    def close(self):
+        self._conn.close()
+        if self.owned and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# -------------------------
+# Deduper
+# -------------------------
+
+class CommentDeduper:
+
+    def __init__(self, mode="exact", threshold=0.8):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Dedup mode must be one of {DEDUP_MODES}")
+        self.near = MinHashIndex(threshold) if mode == "near" else None
+        self._lock = threading.Lock()
+        # Late duplicates are written from the scheduling side, which may be
+        # another thread than the one finishing batches
+        self._write_lock = threading.Lock()
+        # normalized-text key -> representative cid
+        self.representatives = {}
+        # representative cid -> duplicate cids not written yet
+        self.followers = {}
+        # representative cid -> its written records (for late duplicates)
+        self.written = WrittenRecords()
+        self.checkpoint = None
+        self.stats = {"comments": 0, "unique": 0, "exact_duplicates": 0, "near_duplicates": 0}
+
+    def unique(self, comments):
+        """
+        Yields the (cid, text) of each representative; duplicates are
+        recorded and written when (or if already) their representative is.
+        """
+        for cid, text in comments:
+            self.stats["comments"] += 1
+            key = text_key(text)
+            rep = self.representatives.get(key)
+
+            if rep is not None:
+                self.stats["exact_duplicates"] += 1
+            elif self.near is not None:
+                near_key = self.near.query_or_add(key, normalize_text(text))
+                if near_key is not None:
+                    rep = self.representatives[near_key]
+                    # Later exact copies of this text resolve without LSH
+                    self.representatives[key] = rep
+                    self.stats["near_duplicates"] += 1
+
+            if rep is None:
+                self.representatives[key] = cid
+                self.stats["unique"] += 1
+                yield cid, text
+            else:
+                self.attach(rep, cid)
+
+    def attach(self, rep, cid):
+        with self._lock:
+            records = self.written.get(rep)
+            if records is None:
+                self.followers.setdefault(rep, []).append(cid)
+                return
+        with self._write_lock:
+            self.checkpoint.append([dict(record, cid=cid) for record in records])
+
+    def wrap(self, checkpoint):
+        """
+        Checkpoint whose append() also writes each record for the
+        representative's duplicates.
+        """
+        self.checkpoint = checkpoint
+        return _FanOutCheckpoint(self, checkpoint)
+
+    def summary(self):
+        stats = dict(self.stats)
+        stats["generations_saved"] = stats["exact_duplicates"] + stats["near_duplicates"]
+        return stats
+
+    def close(self):
+        self.written.close()
+
+
+class _FanOutCheckpoint:
+
+    def __init__(self, deduper, checkpoint):
+        self.deduper = deduper
+        self.checkpoint = checkpoint
+
+    def append(self, records):
+        deduper = self.deduper
+        copies = []
+        with deduper._lock:
+            deduper.written.add(records)
+            for record in records:
+                for follower in deduper.followers.pop(record["cid"], ()):
+                    copies.append(dict(record, cid=follower))
+        with deduper._write_lock:
+            self.checkpoint.append(list(records) + copies)
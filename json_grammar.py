@@ -0,0 +1,439 @@
+#------------------------------- Schema-constrained JSON decoding -------------------------------#
+# The appearance/GBV output schemas are compiled into a character-level DFA
+# that only accepts schema-valid JSON in a fixed key order (json.dumps
+# layout). For every DFA state the set of vocabulary tokens whose text keeps
+# the DFA alive is precomputed once per (schema, tokenizer) and shared by
+# every model with that vocabulary (walking a trie of the vocabulary, so
+# dead prefixes are pruned), together with the state each token leads to.
+# Allowed ids are stored sparsely per state; each decoding step scatters
+# the rows' ids into a dense mask and does one dict lookup per row.
+
+import torch
+from transformers import LogitsProcessor
+
+from json_stopping import _BYTE_TOKEN
+
+
+# -------------------------
+# Schemas
+# -------------------------
+# The first field is the boolean flag. Fields with "if_false" are forced to
+# that literal when the flag is false, as the prompts require.
+
+APPEARANCE_SUB_CATEGORIES = [
+    "facial_features",
+    "body_features",
+    "clothing_or_dress",
+    "cleanliness_or_grooming",
+    "evaluative_framing",
+]
+
+APPEARANCE_VALENCES = ["negative", "positive", "neutral"]
+
+GBV_CATEGORIES = [
+    "misogyny_or_sexism",
+    "sexual_harassment",
+    "threat_of_violence",
+    "slur_or_dehumanization",
+    "body_shaming",
+    "other",
+]
+
+GBV_TARGETS = ["individual", "group"]
+
+APPEARANCE_SCHEMA = [
+    {"key": "contains_appearance", "kind": "bool"},
+    {"key": "appearance_sub_category", "kind": "enum", "options": APPEARANCE_SUB_CATEGORIES, "if_false": "null"},
+    {"key": "appearance_valence", "kind": "enum", "options": APPEARANCE_VALENCES, "if_false": "null"},
+    {"key": "segments", "kind": "string_list", "if_false": "[]"},
+    {"key": "reason", "kind": "string"},
+]
+
+GBV_SCHEMA = [
+    {"key": "contains_gbv", "kind": "bool"},
+    {"key": "gbv_primary_category", "kind": "enum", "options": GBV_CATEGORIES, "if_false": "null"},
+    {"key": "gbv_secondary_categories", "kind": "enum_list", "options": GBV_CATEGORIES, "if_false": "[]"},
+    {"key": "target", "kind": "enum", "options": GBV_TARGETS, "if_false": "null"},
+    {"key": "segments", "kind": "string_list", "if_false": "[]"},
+    {"key": "reason", "kind": "string"},
+]
+
+SCHEMAS = {
+    "appearance": APPEARANCE_SCHEMA,
+    "gbv": GBV_SCHEMA,
+}
+
+_ESCAPABLE = '"\\/bfnrt'
+
+
+# -------------------------
+# Character automaton
+# -------------------------
+
+class CharAutomaton:
+    """
+    DFA over characters. Each state has explicit transitions plus an
+    optional default transition taken by any other printable character
+    (string bodies).
+    """
+
+    def __init__(self):
+        self.trans = []
+        self.default = []
+        self.start = self.new_state()
+        self.final = self.new_state()
+
+    def __len__(self):
+        return len(self.trans)
+
+    def new_state(self):
+        self.trans.append({})
+        self.default.append(None)
+        return len(self.trans) - 1
+
+    def step(self, state, ch):
+        target = self.trans[state].get(ch)
+        if target is None and self.default[state] is not None and ch >= " ":
+            target = self.default[state]
+        return target
+
+    def literal(self, state, text, end=None):
+        for i, ch in enumerate(text):
+            last = i == len(text) - 1
+            target = end if last and end is not None else self.new_state()
+            if ch in self.trans[state]:
+                raise ValueError(f"Ambiguous literal {text!r} at state {state}")
+            self.trans[state][ch] = target
+            state = target
+        return state
+
+    def choice(self, state, options, end=None):
+        """
+        Any one of several literals (none a prefix of another), sharing
+        common prefixes.
+        """
+        end = end if end is not None else self.new_state()
+        trie = {}
+        for option in options:
+            node = trie
+            for ch in option:
+                node = node.setdefault(ch, {})
+            node[None] = True
+
+        def build(node, state):
+            for ch, child in node.items():
+                if ch is None:
+                    continue
+                if None in child:
+                    self.trans[state][ch] = end
+                else:
+                    self.trans[state][ch] = self.new_state()
+                    build(child, self.trans[state][ch])
+
+        build(trie, state)
+        return end
+
+    def string(self, state, end=None):
+        """
+        A JSON string starting at its opening quote. Returns (end, body)
+        so lists can re-enter the same body.
+        """
+        end = end if end is not None else self.new_state()
+        body = self.new_state()
+        escape = self.new_state()
+        self.trans[state]['"'] = body
+        self.default[body] = body
+        self.trans[body]["\\"] = escape
+        self.trans[body]['"'] = end
+        for ch in _ESCAPABLE:
+            self.trans[escape][ch] = body
+        return end, body
+
+    def value(self, state, field):
+        kind = field["kind"]
+
+        if kind == "bool":
+            return self.choice(state, ["true", "false"])
+
+        if kind == "string":
+            return self.string(state)[0]
+
+        quoted = ['"' + option + '"' for option in field.get("options", [])]
+
+        if kind == "enum":
+            return self.choice(state, quoted + ["null"])
+
+        end = self.new_state()
+        opened = self.literal(state, "[")
+        self.trans[opened]["]"] = end
+
+        if kind == "string_list":
+            item_end, body = self.string(opened)
+            self.trans[item_end]["]"] = end
+            separator = self.literal(item_end, ", ")
+            self.trans[separator]['"'] = body
+            return end
+
+        if kind == "enum_list":
+            item_end = self.choice(opened, quoted)
+            self.trans[item_end]["]"] = end
+            separator = self.literal(item_end, ", ")
+            self.choice(separator, quoted, item_end)
+            return end
+
+        raise ValueError(f"Unknown field kind: {kind}")
+
+
+def build_object(automaton, state, schema, end):
+    """
+    One schema object from `state` to `end`.
+    """
+    flag = schema[0]
+    state = automaton.literal(state, '{"%s": ' % flag["key"])
+
+    for literal in ("true", "false"):
+        branch = automaton.literal(state, literal)
+        for field in schema[1:]:
+            branch = automaton.literal(branch, ', "%s": ' % field["key"])
+            if literal == "false" and "if_false" in field:
+                branch = automaton.literal(branch, field["if_false"])
+            else:
+                branch = automaton.value(branch, field)
+        automaton.literal(branch, "}", end)
+
+
+def build_schema_automaton(schema):
+    automaton = CharAutomaton()
+    build_object(automaton, automaton.start, schema, automaton.final)
+    return automaton
+
+
+def build_multitask_automaton(tasks):
+    """
+    {"<task>": <task object>, ...} in the given task order.
+    """
+    automaton = CharAutomaton()
+    state = automaton.start
+    for i, task in enumerate(tasks):
+        state = automaton.literal(state, ('{"%s": ' if i == 0 else ', "%s": ') % task)
+        end = automaton.new_state()
+        build_object(automaton, state, SCHEMAS[task], end)
+        state = end
+    automaton.literal(state, "}", automaton.final)
+    return automaton
+
+
+# -------------------------
+# Token index
+# -------------------------
+
+def _bytes_to_unicode():
+    # GPT-2 byte-level BPE alphabet
+    printable = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    codes = printable[:]
+    n = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            codes.append(256 + n)
+            n += 1
+    return {chr(code): b for b, code in zip(printable, codes)}
+
+
+def token_strings(tokenizer):
+    """
+    Decoded text of every vocabulary id, or None for special/added tokens.
+    Partial UTF-8 pieces decode to U+FFFD, which only string bodies accept.
+    """
+    vocab_size = len(tokenizer)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(vocab_size)))
+    excluded = set(tokenizer.all_special_ids)
+    excluded.update(getattr(tokenizer, "added_tokens_decoder", {}) or {})
+
+    byte_decoder = _bytes_to_unicode()
+    byte_level = any(token and "Ġ" in token for token in tokens)
+
+    strings = []
+    for token_id, token in enumerate(tokens):
+        if token is None or token_id in excluded:
+            strings.append(None)
+            continue
+
+        match = _BYTE_TOKEN.match(token)
+        if match:
+            value = int(match.group(1), 16)
+            strings.append(chr(value) if value < 0x80 else "�")
+        elif byte_level and all(ch in byte_decoder for ch in token):
+            raw = bytes(byte_decoder[ch] for ch in token)
+            strings.append(raw.decode("utf-8", errors="replace"))
+        else:
+            strings.append(token.replace("▁", " "))
+
+    return strings
+
+
+# (tasks, vocabulary strings, eos id) -> SchemaIndex
+_INDEXES = {}
+
+
+class SchemaIndex:
+    """
+    Per-state allowed token ids and token -> next-state maps for one
+    (schema, tokenizer) pair. Built once per vocabulary (for_tasks) and
+    shared across models and batches.
+    """
+
+    def __init__(self, automaton, tokenizer, strings=None):
+        self.automaton = automaton
+        self.eos_token_id = tokenizer.eos_token_id
+        if strings is None:
+            strings = token_strings(tokenizer)
+        self.vocab_size = len(strings)
+
+        trie = {}
+        for token_id, text in enumerate(strings):
+            if not text:
+                continue
+            node = trie
+            for ch in text:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append(token_id)
+
+        # One extra state for rows that left the grammar: EOS only
+        self.dead = len(automaton)
+        self.next = [dict() for _ in range(len(automaton) + 1)]
+
+        for state in range(len(automaton)):
+            if state == automaton.final:
+                continue
+            stack = [(trie, state)]
+            while stack:
+                node, current = stack.pop()
+                for ch, child in node.items():
+                    if ch is None:
+                        continue
+                    target = automaton.step(current, ch)
+                    if target is None:
+                        continue
+                    for token_id in child.get(None, ()):
+                        self.next[state][token_id] = target
+                    stack.append((child, target))
+
+        for state in (automaton.final, self.dead):
+            self.next[state][self.eos_token_id] = state
+
+        # Allowed ids of every state, concatenated (CSR layout)
+        counts = [len(nexts) for nexts in self.next]
+        self.offsets = torch.tensor([0] + counts).cumsum(0)
+        self.ids = torch.tensor(
+            [token_id for nexts in self.next for token_id in sorted(nexts)], dtype=torch.long
+        )
+        self._on_device = {}
+
+    @classmethod
+    def for_task(cls, task, tokenizer):
+        return cls.for_tasks((task,), tokenizer)
+
+    @classmethod
+    def for_tasks(cls, tasks, tokenizer):
+        """
+        One task: its schema. Several: the multi-task object wrapping them.
+        Cached per vocabulary, so models sharing a tokenizer share the index.
+        """
+        tasks = tuple(tasks)
+        strings = token_strings(tokenizer)
+        key = (tasks, tuple(strings), tokenizer.eos_token_id)
+        if key not in _INDEXES:
+            if len(tasks) == 1:
+                automaton = build_schema_automaton(SCHEMAS[tasks[0]])
+            else:
+                automaton = build_multitask_automaton(tasks)
+            _INDEXES[key] = cls(automaton, tokenizer, strings)
+        return _INDEXES[key]
+
+    def _tensors_on(self, device):
+        key = str(device)
+        if key not in self._on_device:
+            self._on_device[key] = (self.ids.to(device), self.offsets.to(device))
+        return self._on_device[key]
+
+    def mask(self, states, device, width=None):
+        """
+        [len(states), width] bool mask of the allowed tokens (width defaults
+        to the vocabulary size; ids past the vocabulary stay masked).
+        """
+        ids, offsets = self._tensors_on(device)
+        states = torch.tensor(states, device=device)
+        starts = offsets[states]
+        counts = offsets[states + 1] - starts
+
+        rows = torch.repeat_interleave(torch.arange(len(states), device=device), counts)
+        # Position of every (row, allowed id) pair inside the flat id list
+        firsts = torch.repeat_interleave(starts - (counts.cumsum(0) - counts), counts)
+        columns = ids[firsts + torch.arange(rows.numel(), device=device)]
+
+        allowed = torch.zeros(len(states), width or self.vocab_size, dtype=torch.bool, device=device)
+        allowed[rows, columns] = True
+        return allowed
+
+
+class GrammarState:
+    """
+    Per-row automaton state for a batch being generated. Same
+    reset/extend/select/update interface as JSONStopTracker.
+    """
+
+    def __init__(self, index, batch_size=0, device="cpu"):
+        self.index = index
+        self.device = device
+        self.reset(batch_size)
+
+    def reset(self, batch_size):
+        self.states = [self.index.automaton.start] * batch_size
+
+    def extend(self, count):
+        self.states.extend([self.index.automaton.start] * count)
+
+    def select(self, index):
+        self.states = [self.states[row] for row in index.tolist()]
+
+    def update(self, token_ids, rows=None):
+        rows = range(len(self.states)) if rows is None else rows.tolist()
+        nexts = self.index.next
+        dead = self.index.dead
+        for row, token_id in zip(rows, token_ids.tolist()):
+            self.states[row] = nexts[self.states[row]].get(token_id, dead)
+
+    def allowed(self, states=None, width=None):
+        states = self.states if states is None else states
+        return self.index.mask(states, self.device, width)
+
+    def apply(self, scores, states=None):
+        # Padded embedding rows past the tokenizer vocab stay masked
+        allowed = self.allowed(states, max(scores.shape[-1], self.index.vocab_size))
+        return scores.masked_fill(~allowed[:, :scores.shape[-1]], float("-inf"))
+
+    def start_states(self, count):
+        return [self.index.automaton.start] * count
+
+
+class JSONSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Masks every token that would leave the schema. Create one per
+    model.generate call; the index is shared.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.state = None
+
+    def __call__(self, input_ids, scores):
+        if self.state is None:
+            self.state = GrammarState(self.index, input_ids.shape[0], device=scores.device)
+        else:
+            self.state.update(input_ids[:, -1])
+        return self.state.apply(scores)
@@ -0,0 +1,343 @@
+#------------------------------- Single-pass JSON extraction + repair -------------------------------#
+# Shared by llm_runner (cleaning raw generations) and output_parser (parsing).
+# One left-to-right pass over the text from the first '{':
+#   - tracks string/escape state, so quotes and brackets inside text are kept
+#   - converts single-quoted strings to double-quoted ones (apostrophes inside
+#     double-quoted text are left alone)
+#   - unquotes "true"/"false" only in value position
+#   - stops at the end of the outermost object (markdown fences and trailing
+#     chatter are never part of it)
+#   - on truncation closes the open string, drops a dangling ',' (and a key
+#     cut off before its ':', with its ','), gives a key with ':' a null
+#     value, completes cut-off literals and numbers ("1." -> 1, "-" -> null)
+#     and closes brackets in the correct nesting order
+# Cost (benchmark_repair, sample_outputs): well-formed outputs go through
+# the C decoder and parse ~1.35x faster than the old extract/repair/load
+# chain; truncated ones go through the Python scanner, ~9x slower than the
+# old chain, which gave up on 98% of them (recovery 1.0 vs 0.02). On the
+# default half-truncated mix that is ~0.35x throughput for recovery 1.0 vs
+# 0.25; a parse pass is still >60k outputs/s, far below generation cost.
+
+import re
+import json
+import time
+from typing import Dict, Any
+
+_TOKEN = re.compile(
+    r'"(?:[^"\\]|\\.)*"'          # complete double-quoted string
+    r"|'(?:[^'\\]|\\.)*'"         # complete single-quoted string
+    r'|[{}\[\],:]'                # structure
+    r'|[^{}\[\],:"\']+'           # literals, numbers, whitespace
+    r'|["\']',                    # unterminated string start
+    re.DOTALL
+)
+_CONTROL = re.compile(r"[\x00-\x1f]")
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_LITERALS = ("true", "false", "null")
+_NUMBER_START = frozenset("-0123456789")
+_DECODER = json.JSONDecoder()
+
+# What the innermost container expects next
+KEY, COLON, VALUE, COMMA = range(4)
+
+
+def _escape_control(content):
+    if not _CONTROL.search(content):
+        return content
+    return _CONTROL.sub(
+        lambda m: _CONTROL_ESCAPES.get(m.group(), "\\u%04x" % ord(m.group())),
+        content
+    )
+
+
+def _convert_single_quoted(content):
+    # 'it\'s "x"'  ->  it's \"x\"
+    content = content.replace("\\'", "'")
+    return re.sub(r'(?<!\\)"', '\\"', content)
+
+
+def scan_json(text: str):
+    """
+    Returns (raw_span, repaired) for the outermost JSON object in text.
+    raw_span is the original text of the object (to the end of the text if
+    it never closes); repaired is valid-JSON-shaped text. Both are "" when
+    there is no '{'.
+    """
+    if not text:
+        return "", ""
+
+    start = text.find("{")
+    if start == -1:
+        return "", ""
+
+    out = []
+    closers = []
+    expecting = []
+    end = len(text)
+
+    for match in _TOKEN.finditer(text, start):
+        token = match.group()
+        first = token[0]
+
+        if first == "{" or first == "[":
+            out.append(token)
+            closers.append("}" if first == "{" else "]")
+            expecting.append(KEY if first == "{" else VALUE)
+
+        elif first == "}" or first == "]":
+            # Close anything left open inside (e.g. '[...}' -> '[...]}')
+            while closers and closers[-1] != token:
+                if token not in closers:
+                    break
+                out.append(closers.pop())
+                expecting.pop()
+            if closers and closers[-1] == token:
+                out.append(closers.pop())
+                expecting.pop()
+                if expecting:
+                    expecting[-1] = COMMA
+            if not closers:
+                end = match.end()
+                break
+
+        elif first == ",":
+            out.append(token)
+            expecting[-1] = KEY if closers[-1] == "}" else VALUE
+
+        elif first == ":":
+            out.append(token)
+            expecting[-1] = VALUE
+
+        elif first == '"' or first == "'":
+            if len(token) == 1:
+                # Unterminated: the rest of the text is the string's content
+                content = text[match.end():]
+                if content.endswith("\\") and not content.endswith("\\\\"):
+                    content = content[:-1]
+                closed = False
+            else:
+                content = token[1:-1]
+                closed = True
+
+            if first == "'":
+                content = _convert_single_quoted(content)
+            content = _escape_control(content)
+
+            if expecting[-1] == VALUE and content in ("true", "false"):
+                out.append(content)
+            else:
+                out.append('"' + content + '"')
+
+            expecting[-1] = COLON if expecting[-1] == KEY else COMMA
+            if not closed:
+                break
+
+        else:
+            out.append(token)
+            if not token.isspace() and expecting[-1] == VALUE:
+                expecting[-1] = COMMA
+
+    raw_span = text[start:end]
+
+    if not closers:
+        return raw_span, "".join(out)
+
+    # -------------------------
+    # Truncated: finish the innermost value, then close in nesting order
+    # -------------------------
+    while out and out[-1].isspace():
+        out.pop()
+
+    if out and out[-1][0] not in '{}[],:"':
+        # Complete a cut-off literal ("tr" -> "true")
+        tail = out[-1].strip()
+        for literal in _LITERALS:
+            if literal.startswith(tail) and tail != literal:
+                out[-1] = out[-1].rstrip()[:-len(tail)] + literal
+                break
+        else:
+            # Cut-off number: drop a dangling ".", "e", sign ("1." -> "1",
+            # "2e-" -> "2"); a lone "-" becomes null
+            if tail[:1] in _NUMBER_START:
+                number = tail.rstrip(".-+eE")
+                if number != tail:
+                    out[-1] = out[-1].rstrip()[:-len(tail)] + (number or "null")
+
+    state = expecting[-1]
+    if state == COLON:
+        # Key without its ':' (possibly cut mid-string): drop the whole pair
+        out.pop()
+        while out and out[-1].isspace():
+            out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+    elif state == VALUE and out and out[-1] == ":":
+        out.append(" null")
+
+    out.extend(reversed(closers))
+    return raw_span, "".join(out)
+
+
+def extract_json_span(text: str) -> str:
+    return scan_json(text)[0]
+
+
+def repair_json_object(text: str) -> str:
+    return scan_json(text)[1]
+
+
+def _unquote_booleans(value):
+    if isinstance(value, dict):
+        return {key: _unquote_booleans(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_unquote_booleans(item) for item in value]
+    if value == "true" or value == "false":
+        return value == "true"
+    return value
+
+
+def load_json_object(text: str) -> Dict[str, Any]:
+    """
+    Parsed outermost object of an LLM output, or {} if unrecoverable.
+    Well-formed objects are decoded directly by the C decoder; only the
+    rest go through the scanner.
+    """
+    start = text.find("{") if text else -1
+    if start == -1:
+        return {}
+    try:
+        parsed, _ = _DECODER.raw_decode(text, start)
+        if isinstance(parsed, dict):
+            return _unquote_booleans(parsed)
+    except json.JSONDecodeError:
+        pass
+
+    repaired = repair_json_object(text)
+    if not repaired:
+        return {}
+    try:
+        parsed = json.loads(repaired)
+    except json.JSONDecodeError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+# -------------------------
+# Microbenchmark
+# -------------------------
+
+def _legacy_load(text):
+    # extract_json_block + safe_json_load as they were before this module
+    text = (text or "").strip()
+    text = re.sub(r"^```json", "", text, flags=re.IGNORECASE).strip()
+    text = re.sub(r"^```", "", text).strip()
+    text = re.sub(r"```$", "", text).strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end == -1 or end <= start:
+        return {}
+    text = text[start:end+1].replace("'", '"')
+    text = text.replace('"true"', 'true').replace('"false"', 'false')
+    if text.count("{") > text.count("}"):
+        text += "}"
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        if text.count("{") > text.count("}"):
+            text += "}"
+        if text.count("[") > text.count("]"):
+            text += "]"
+        try:
+            return json.loads(text)
+        except Exception:
+            return {}
+
+
+def sample_outputs(n=2000, seed=0):
+    """
+    Synthetic generations in the shapes the models actually produce
+    (fences, preambles, single quotes, apostrophes, quoted booleans,
+    trailing chatter), each paired with a copy truncated mid-stream.
+    Returns [(text, truncated)].
+    """
+    import random
+    rng = random.Random(seed)
+    reasons = [
+        "Comments on her weight and says she's too big.",
+        "Mentions the dress {fit} and \"style\".",
+        "No reference to looks; it's about policy.",
+        "Calls her face [ugly], evaluative framing.",
+    ]
+    samples = []
+    for i in range(n):
+        contains = rng.random() < 0.5
+        record = {
+            "contains_appearance": contains,
+            "appearance_sub_category": rng.choice(["body_features", "facial_features", ""]),
+            "appearance_valence": rng.choice(["negative", "positive", "neutral"]),
+            "segments": rng.sample(["so fat", "ugly face", "nice dress", "her hair"], rng.randint(0, 3)),
+            "reason": rng.choice(reasons),
+        }
+        text = json.dumps(record, indent=rng.choice([None, 2]))
+        style = i % 5
+        if style == 1:
+            text = "```json\n" + text + "\n```"
+        elif style == 2:
+            text = "Here is the JSON:\n" + text + "\nHope this helps {ok}."
+        elif style == 3:
+            text = text.replace(
+                '"contains_appearance": ' + json.dumps(contains),
+                '"contains_appearance": "' + json.dumps(contains) + '"'
+            )
+        elif style == 4:
+            text = "{'contains_appearance': %s, 'reason': 'single quoted'}" % json.dumps(contains)
+        samples.append((text, False))
+        cut = rng.randint(len(text) // 2, max(len(text) - 2, len(text) // 2))
+        samples.append((text[:cut], True))
+        if i % 10 == 0:
+            # Cut inside a number
+            number = ["1.", "-", "2e", "-0.5E+"][i // 10 % 4]
+            samples.append(('{"contains_appearance": %s, "score": %s' % (json.dumps(contains), number), True))
+    return samples
+
+
+def benchmark_repair(outputs=None, key="contains_appearance", repeats=3):
+    """
+    Throughput and recovery rate of the scanner vs the previous
+    extract/repair/load chain. outputs: list of raw generations, or None
+    for sample_outputs(). An output counts as recovered when the loaded
+    object has `key`.
+    """
+    if outputs is None:
+        samples = sample_outputs()
+    else:
+        samples = [(text, False) for text in outputs]
+    texts = [text for text, _ in samples]
+    total_bytes = sum(len(text.encode("utf-8")) for text in texts)
+
+    report = {"outputs": len(texts)}
+    for name, load in (("legacy", _legacy_load), ("scanner", load_json_object)):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            parsed = [load(text) for text in texts]
+        seconds = (time.perf_counter() - start) / repeats
+
+        recovered = [key in record for record in parsed]
+        truncated = [ok for ok, (_, cut) in zip(recovered, samples) if cut]
+        report[name] = {
+            "outputs_per_sec": len(texts) / seconds if seconds else 0.0,
+            "mb_per_sec": total_bytes / seconds / 1e6 if seconds else 0.0,
+            "recovery_rate": sum(recovered) / len(texts) if texts else 0.0,
+            "truncated_recovery_rate": sum(truncated) / len(truncated) if truncated else 0.0,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # Real generations: a results JSONL with raw_output per line
+        with open(sys.argv[1], "r") as f:
+            outputs = [json.loads(line)["raw_output"] for line in f if line.strip()]
+        print(json.dumps(benchmark_repair(outputs, key=sys.argv[2] if len(sys.argv) > 2 else "contains_appearance"), indent=2))
+    else:
+        print(json.dumps(benchmark_repair(), indent=2))
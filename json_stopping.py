@@ -0,0 +1,177 @@
+#------------------------------- Stop generation once the top-level JSON object closes -------------------------------#
+# No per-step detokenization: each token id is mapped once per tokenizer to how it
+# moves a small JSON scanner (brace depth + string/escape state), so each
+# generation step is a couple of tensor lookups over the newly generated ids.
+
+import re
+import torch
+from transformers import StoppingCriteria
+
+# Scanner states
+BEFORE_OBJECT = 0   # leading garbage, nothing opened yet
+IN_OBJECT = 1       # inside the object, outside any string
+IN_STRING = 2       # inside a string literal
+IN_ESCAPE = 3       # right after a backslash inside a string
+
+NUM_STATES = 4
+NEVER_CLOSES = 1 << 30
+
+_BYTE_TOKEN = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+
+def _token_text(token):
+    """
+    Raw vocabulary piece -> the characters that matter for JSON scanning.
+    Byte-level BPE and SentencePiece keep ASCII punctuation as-is; byte
+    fallback pieces look like <0x7B>.
+    """
+    if token is None:
+        return ""
+    match = _BYTE_TOKEN.match(token)
+    if match:
+        return chr(int(match.group(1), 16))
+    return token
+
+
+def _scan(text, state):
+    """
+    Run the scanner over one token's text from `state` at relative depth 0.
+    Returns (depth delta, lowest depth reached by a '}', exit state).
+    """
+    depth = 0
+    lowest = NEVER_CLOSES
+
+    for ch in text:
+        if state == BEFORE_OBJECT:
+            if ch == "{":
+                depth += 1
+                state = IN_OBJECT
+        elif state == IN_OBJECT:
+            if ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                lowest = min(lowest, depth)
+            elif ch == '"':
+                state = IN_STRING
+        elif state == IN_STRING:
+            if ch == "\\":
+                state = IN_ESCAPE
+            elif ch == '"':
+                state = IN_OBJECT
+        else:
+            state = IN_STRING
+
+    return depth, lowest, state
+
+
+def build_json_stop_table(tokenizer):
+    """
+    Precompute, for every (scanner state, token id), the depth delta, the
+    lowest depth a closing brace reaches and the next scanner state.
+    Build once per tokenizer and share across batches.
+    """
+    vocab_size = len(tokenizer)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(vocab_size)))
+    special_ids = set(tokenizer.all_special_ids)
+
+    delta = torch.zeros(NUM_STATES, vocab_size, dtype=torch.long)
+    lowest = torch.full((NUM_STATES, vocab_size), NEVER_CLOSES, dtype=torch.long)
+    next_state = torch.arange(NUM_STATES, dtype=torch.long)[:, None].repeat(1, vocab_size)
+
+    for token_id, token in enumerate(tokens):
+        if token_id in special_ids:
+            continue
+
+        text = _token_text(token)
+        if not any(ch in text for ch in '{}"\\'):
+            # Ordinary text only changes state right after a backslash
+            if text:
+                next_state[IN_ESCAPE, token_id] = IN_STRING
+            continue
+
+        for state in range(NUM_STATES):
+            d, low, exit_state = _scan(text, state)
+            delta[state, token_id] = d
+            lowest[state, token_id] = low
+            next_state[state, token_id] = exit_state
+
+    return {"delta": delta, "lowest": lowest, "next_state": next_state}
+
+
+class JSONStopTracker:
+    """
+    Per-row scanner state for a batch of sequences being generated.
+    update() consumes one new token per row and returns which rows have
+    closed their top-level object.
+    """
+
+    def __init__(self, table, batch_size=0, device="cpu"):
+        self.table = {name: t.to(device) for name, t in table.items()}
+        self.vocab_size = self.table["delta"].shape[1]
+        self.device = device
+        self.reset(batch_size)
+
+    def reset(self, batch_size):
+        self.state = torch.full((batch_size,), BEFORE_OBJECT, dtype=torch.long, device=self.device)
+        self.depth = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        self.done = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+    def extend(self, count):
+        self.state = torch.cat([self.state, self.state.new_full((count,), BEFORE_OBJECT)])
+        self.depth = torch.cat([self.depth, self.depth.new_zeros(count)])
+        self.done = torch.cat([self.done, self.done.new_zeros(count)])
+
+    def select(self, index):
+        self.state = self.state[index]
+        self.depth = self.depth[index]
+        self.done = self.done[index]
+
+    def update(self, token_ids, rows=None):
+        """
+        token_ids: newest token per row (or per row in `rows` when given).
+        """
+        if rows is None:
+            rows = slice(None)
+        token_ids = token_ids.to(self.device)
+        state = self.state[rows]
+
+        # Ids past the tokenizer vocab (padded embeddings) are inert
+        known = token_ids < self.vocab_size
+        ids = token_ids.clamp(max=self.vocab_size - 1)
+
+        delta = torch.where(known, self.table["delta"][state, ids], 0)
+        lowest = torch.where(known, self.table["lowest"][state, ids], NEVER_CLOSES)
+        next_state = torch.where(known, self.table["next_state"][state, ids], state)
+
+        self.done[rows] |= self.depth[rows] + lowest <= 0
+        self.depth[rows] += delta
+        self.state[rows] = next_state
+        return self.done
+
+
+class StopOnJSONEnd(StoppingCriteria):
+    """
+    Marks each row done once its top-level JSON object closes.
+    Create one per model.generate call; the table is shared.
+    prompt_length: needed when a step can append several tokens (assisted
+    generation); without it each call consumes only the newest token.
+    """
+
+    def __init__(self, table, prompt_length=None):
+        self.table = table
+        self.tracker = None
+        self.seen = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.tracker is None:
+            self.tracker = JSONStopTracker(
+                self.table, input_ids.shape[0], device=input_ids.device
+            )
+        if self.seen is None:
+            self.seen = input_ids.shape[1] - 1
+
+        for position in range(self.seen, input_ids.shape[1]):
+            self.tracker.update(input_ids[:, position])
+        self.seen = input_ids.shape[1]
+        return self.tracker.done.clone()
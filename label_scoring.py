@@ -0,0 +1,246 @@
+#------------------------------- Label scoring instead of generation -------------------------------#
+# For one schema field, the rendered prompt is followed by the JSON the
+# model would have written up to that field's value (json.dumps layout,
+# as in json_grammar). A single batched forward pass then scores every
+# candidate label:
+#   - "first_token": every label starts with a distinct token -> read the
+#     next-token log-probabilities at the last position (one row per comment)
+#   - "sequence": labels share a first token -> one row per (comment, label),
+#     summing the label tokens' log-probabilities
+# Fields that follow a category (valence, target) are scored after each
+# valid value of that category and marginalized over it:
+#   log P(label) = logsumexp_c [log P(c) + log P(label | c)]
+# (one extra pass per category value), so the forced JSON never holds a
+# combination the schema forbids.
+# Only the prompt is truncated to max_prompt_length; the forced JSON and
+# label tokens are always kept.
+# Scores are turned into a confidence with a softmax at a calibration
+# temperature (fit_temperature on labelled data).
+
+import torch
+
+from json_grammar import (
+    APPEARANCE_SUB_CATEGORIES,
+    APPEARANCE_VALENCES,
+    GBV_CATEGORIES,
+    GBV_TARGETS,
+)
+
+# Fields that can be scored: forced JSON prefix + candidate labels.
+# Later fields are scored conditional on the flag being true; "<given>" in a
+# prefix is filled with each label of the "given" field.
+SCORE_FIELDS = {
+    "contains_appearance": {
+        "prefix": '{"contains_appearance": ',
+        "labels": ["false", "true"],
+    },
+    "appearance_sub_category": {
+        "prefix": '{"contains_appearance": true, "appearance_sub_category": "',
+        "labels": APPEARANCE_SUB_CATEGORIES,
+    },
+    "appearance_valence": {
+        "prefix": '{"contains_appearance": true, "appearance_sub_category": "<given>", "appearance_valence": "',
+        "labels": APPEARANCE_VALENCES,
+        "given": "appearance_sub_category",
+    },
+    "contains_gbv": {
+        "prefix": '{"contains_gbv": ',
+        "labels": ["false", "true"],
+    },
+    "gbv_primary_category": {
+        "prefix": '{"contains_gbv": true, "gbv_primary_category": "',
+        "labels": GBV_CATEGORIES,
+    },
+    "target": {
+        "prefix": '{"contains_gbv": true, "gbv_primary_category": "<given>", "gbv_secondary_categories": [], "target": "',
+        "labels": GBV_TARGETS,
+        "given": "gbv_primary_category",
+    },
+}
+
+
+def _common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixScorer:
+    """
+    Log-probabilities of candidate labels after one forced JSON prefix.
+    """
+
+    def __init__(self, model, tokenizer, prefix, labels, render, max_prompt_length=1024):
+        """
+        render(comment) -> full chat-templated prompt text.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.labels = list(labels)
+        # A trailing space belongs to the label's first token ("Ġtrue")
+        self.prefix = prefix.rstrip(" ")
+        self.candidates = [prefix[len(self.prefix):] + label for label in self.labels]
+        self.max_prompt_length = max_prompt_length
+        self.device = next(model.parameters()).device
+
+        # Label token ids after the forced prefix, checked once on a template
+        base_text = render("x") + self.prefix
+        base = tokenizer(base_text)["input_ids"]
+        continuations = []
+        for candidate in self.candidates:
+            full = tokenizer(base_text + candidate)["input_ids"]
+            continuations.append(full[len(base):] if full[:len(base)] == base else [])
+
+        first_tokens = [ids[0] for ids in continuations if ids]
+        if len(first_tokens) == len(self.labels) and len(set(first_tokens)) == len(self.labels):
+            self.mode = "first_token"
+            self.label_ids = torch.tensor(first_tokens, device=self.device)
+        else:
+            self.mode = "sequence"
+            self.label_ids = None
+
+    def _encode(self, prompts, texts):
+        """
+        Token ids of texts (each prompts[i] + forced JSON, len(texts) //
+        len(prompts) rows per prompt). Over-long prompts lose their end, as
+        in generation, but the tokens after the prompt are always kept.
+        """
+        bases = self.tokenizer(prompts)["input_ids"]
+        fulls = self.tokenizer(texts)["input_ids"]
+        per_prompt = len(texts) // len(prompts)
+
+        rows = []
+        for i, ids in enumerate(fulls):
+            prompt_length = _common_prefix(ids, bases[i // per_prompt])
+            if prompt_length > self.max_prompt_length:
+                ids = ids[:self.max_prompt_length] + ids[prompt_length:]
+            rows.append(ids)
+        return self.tokenizer.pad({"input_ids": rows}, return_tensors="pt")
+
+    def _forward(self, prompts, texts, keep):
+        enc = self._encode(prompts, texts).to(self.device)
+        mask = enc["attention_mask"]
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        with torch.no_grad():
+            out = self.model(
+                input_ids=enc["input_ids"],
+                attention_mask=mask,
+                position_ids=position_ids,
+                logits_to_keep=keep
+            )
+        return enc["input_ids"], out.logits[:, -keep:, :].float()
+
+    def scores(self, prompts):
+        """
+        [len(prompts), len(labels)] label log-probabilities.
+        """
+        texts = [prompt + self.prefix for prompt in prompts]
+
+        if self.mode == "first_token":
+            _, logits = self._forward(prompts, texts, 1)
+            log_probs = torch.log_softmax(logits[:, -1, :], dim=-1)
+            return log_probs[:, self.label_ids]
+
+        # One row per (prompt, label); only the label tokens are scored
+        rows = [text + candidate for text in texts for candidate in self.candidates]
+        bases = self.tokenizer(texts)["input_ids"]
+        fulls = self.tokenizer(rows)["input_ids"]
+        lengths = [
+            len(full) - _common_prefix(full, bases[i // len(self.labels)])
+            for i, full in enumerate(fulls)
+        ]
+
+        keep = max(lengths) + 1
+        input_ids, logits = self._forward(prompts, rows, keep)
+        log_probs = torch.log_softmax(logits[:, :-1, :], dim=-1)
+        targets = input_ids[:, -(keep - 1):]
+        token_scores = log_probs.gather(-1, targets[..., None]).squeeze(-1)
+
+        lengths = torch.tensor(lengths, device=token_scores.device)
+        columns = torch.arange(keep - 1, device=token_scores.device)
+        label_mask = columns[None, :] >= (keep - 1 - lengths)[:, None]
+        totals = (token_scores * label_mask).sum(dim=1)
+        return totals.view(len(prompts), len(self.labels))
+
+
+class LabelScorer:
+
+    def __init__(self, model, tokenizer, field, render, temperature=1.0,
+                 max_prompt_length=1024):
+        """
+        render(comment) -> full chat-templated prompt text.
+        """
+        if field not in SCORE_FIELDS:
+            raise ValueError(f"Cannot score field: {field}")
+
+        spec = SCORE_FIELDS[field]
+        self.field = field
+        self.labels = list(spec["labels"])
+        self.temperature = temperature
+
+        def scorer(prefix, labels):
+            return PrefixScorer(model, tokenizer, prefix, labels, render, max_prompt_length)
+
+        given = spec.get("given")
+        if given is None:
+            self.given = None
+            self.scorers = [scorer(spec["prefix"], self.labels)]
+        else:
+            self.given = scorer(SCORE_FIELDS[given]["prefix"], SCORE_FIELDS[given]["labels"])
+            self.scorers = [
+                scorer(spec["prefix"].replace("<given>", value), self.labels)
+                for value in SCORE_FIELDS[given]["labels"]
+            ]
+        self.mode = self.scorers[0].mode
+
+    def scores(self, prompts):
+        """
+        [len(prompts), len(labels)] label log-probabilities.
+        """
+        if self.given is None:
+            return self.scorers[0].scores(prompts)
+
+        # Marginalize over the preceding category, both normalized over
+        # their valid labels
+        given = torch.log_softmax(self.given.scores(prompts), dim=-1)
+        conditional = torch.stack([
+            torch.log_softmax(scorer.scores(prompts), dim=-1) for scorer in self.scorers
+        ], dim=1)
+        return torch.logsumexp(given[..., None] + conditional, dim=1)
+
+    def classify(self, prompts):
+        """
+        [(label index, confidence)] per prompt.
+        """
+        probs = torch.softmax(self.scores(prompts) / self.temperature, dim=-1)
+        confidence, label = probs.max(dim=-1)
+        return list(zip(label.tolist(), confidence.tolist()))
+
+
+# -------------------------
+# Calibration
+# -------------------------
+
+def fit_temperature(scores, labels, steps=200):
+    """
+    Temperature scaling: the T minimising the NLL of softmax(scores / T)
+    on labelled examples. scores: [N, L] from LabelScorer.scores;
+    labels: N gold label indices.
+    """
+    scores = torch.as_tensor(scores, dtype=torch.float32).detach().cpu()
+    labels = torch.as_tensor(labels, dtype=torch.long)
+    log_t = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=steps)
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.nn.functional.cross_entropy(scores / log_t.exp(), labels)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return float(log_t.detach().exp())
@@ -3,17 +3,51 @@ import torch
 import json
 import os
 import gc
+import time
+import copy
+from collections import deque
+from contextlib import nullcontext
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     BitsAndBytesConfig,
-    StoppingCriteria,
-    StoppingCriteriaList
+    StoppingCriteriaList,
+    LogitsProcessorList
 )
-from model_registry import LLM_MODELS
+from model_registry import LLM_MODELS, DRAFT_MODELS
 from tqdm import tqdm
-from prompts import build_prompt_appearance, build_prompt_gbv
+from prompts import build_prompt_appearance, build_prompt_gbv, build_prompt_multitask
+from continuous_batching import ContinuousBatchingEngine
+from json_stopping import StopOnJSONEnd, build_json_stop_table
+from json_scanner import repair_json_object, scan_json
+from json_grammar import SchemaIndex, JSONSchemaLogitsProcessor
+from label_scoring import LabelScorer, SCORE_FIELDS
+from model_cache import ModelLoadCache
+from adaptive_batch import AdaptiveBatchSizer, SafeBatchSizes, is_oom
+from dedup import CommentDeduper, DEDUP_MODES
+from backends import BACKENDS, make_backend
+from speculative import (
+    SPECULATIVE_MODES,
+    MIN_SPEEDUP,
+    new_stats,
+    summarize,
+    count_steps,
+    speculative_kwargs,
+    generate_rows,
+)
+from checkpoint import ResultsCheckpoint
+from output_cache import OutputCache
+from prefix_cache import PromptPrefixCache
+from prompt_renderer import PromptRenderer
+from multitask import normalize_tasks, TaskSplitCheckpoint
+from pipeline import run_pipeline
+from metrics import StageTimer, RunMetrics, FirstTokenClock, generated_lengths
+from comment_stream import batched, ExcludedComments
+
+MAX_PROMPT_LENGTH = 1024
 
+# CPU weights: "int8" = float32 load + dynamic int8 quantization of Linear layers
+CPU_DTYPES = ("float32", "bfloat16", "int8")
 
 # -------------------------
 # Utility
@@ -21,65 +55,50 @@ from prompts import build_prompt_appearance, build_prompt_gbv
 
 def clear_gpu_memory():
     gc.collect()
-    torch.cuda.empty_cache()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
 def repair_json(text: str) -> str:
     """
     Repair common LLM JSON truncation issues.
     """
+    return repair_json_object(text)
 
-    if not text:
-        return ""
-
-    text = text.strip()
-
-    # Replace single quotes
-    text = text.replace("'", '"')
 
-    # Fix quoted booleans
-    text = text.replace('"true"', 'true')
-    text = text.replace('"false"', 'false')
-
-    # Count brackets
-    open_curly = text.count("{")
-    close_curly = text.count("}")
-    open_square = text.count("[")
-    close_square = text.count("]")
-
-    # Close square brackets first
-    if open_square > close_square:
-        text += "]" * (open_square - close_square)
+def clean_output(output: str) -> str:
+    """
+    Trim leading garbage before the first '{' and repair truncation.
+    Text after the outermost object is dropped.
+    """
+    return repair_json_object(output)
 
-    # Then close curly brackets
-    if open_curly > close_curly:
-        text += "}" * (open_curly - close_curly)
 
-    return text
+def padding_totals(batch_lengths):
+    """
+    (padded token slots, real tokens) for batches padded to their max length.
+    """
+    padded = sum(max(lengths) * len(lengths) for lengths in batch_lengths if lengths)
+    real = sum(sum(lengths) for lengths in batch_lengths)
+    return padded, real
 
 
-# Stop generation once a JSON object closes
-# class StopOnJSONEnd(StoppingCriteria):
-#     def __init__(self, tokenizer):
-#         self.tokenizer = tokenizer
+def padding_waste(batch_lengths) -> float:
+    """
+    Fraction of prompt token slots that are padding, given the
+    per-row prompt lengths of each batch (padded to the batch max).
+    """
+    padded, real = padding_totals(batch_lengths)
+    return 1.0 - real / padded if padded else 0.0
 
-#     def __call__(self, input_ids, scores, **kwargs):
-#         decoded = self.tokenizer.decode(
-#             input_ids[0],
-#             skip_special_tokens=True
-#         )
-#         return decoded.strip().endswith("}")
-# This works but can be inefficient for long generations, so we can optimize by only decoding the last few tokens:   
-# class StopOnJSONEnd(StoppingCriteria):
-#     def __init__(self, tokenizer):
-#         self.tokenizer = tokenizer
 
-#     def __call__(self, input_ids, scores, **kwargs):
-#         # Only decode last 50 tokens for efficiency
-#         decoded = self.tokenizer.decode(
-#             input_ids[0][-50:],
-#             skip_special_tokens=True
-#         )
-#         return decoded.strip().endswith("}")
+def check_device_settings(device, cpu_dtype="float32"):
+    """
+    Raise ValueError for a cpu_dtype the device cannot load.
+    """
+    if cpu_dtype not in CPU_DTYPES:
+        raise ValueError(f"cpu_dtype must be one of {CPU_DTYPES}")
+    if cpu_dtype != "float32" and device != "cpu":
+        raise ValueError("cpu_dtype applies to device='cpu' only")
 
 
 # -------------------------
@@ -88,25 +107,174 @@ def repair_json(text: str) -> str:
 
 class UnifiedLLMRunner:
 
-    def __init__(self, task="appearance", batch_size=8, max_new_tokens=180):
-        self.device = "cuda"
+    def __init__(self, task="appearance", batch_size=8, max_new_tokens=180,
+                 schedule="fixed", token_budget=None, engine="static",
+                 stop_on_json_end=True, resume=False,
+                 cache_path=None, cache_max_bytes=2 * 1024 ** 3,
+                 reuse_prefix_kv=False, pipeline=False, prefetch=2,
+                 device="auto", schedule_window=None, constrained=False,
+                 mode="generate", score_field=None, score_temperature=1.0,
+                 load_cache_dir=None, keep_resident=0,
+                 metrics_path=None, prometheus_path=None,
+                 adaptive_batch=False, max_batch_size=None, adaptive_state_path=None,
+                 oom_injector=None, speculative=None, draft_models=None,
+                 prompt_lookup_tokens=10, dedup=None, near_dup_threshold=0.8,
+                 backend="transformers", backend_options=None,
+                 cpu_dtype="float32", num_threads=None, compile_decode=False,
+                 output_base="/datasets/cl0059/outputs/llm_results"):
+        # "cuda" spreads the model with device_map="auto"; "cuda:N" pins it
+        # to one GPU; "cpu" loads cpu_dtype weights on the CPU; "auto" is
+        # "cuda" when a GPU is visible, else "cpu"
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+
+        check_device_settings(device, cpu_dtype)
+        self.cpu_dtype = cpu_dtype
+
+        # Intra-op threads for CPU inference (default: torch's choice)
+        self.num_threads = num_threads
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        # torch.compile the model's forward (every decode step); the first
+        # batches pay the compilation
+        self.compile_decode = compile_decode
         self.batch_size = batch_size
         self.max_new_tokens = max_new_tokens
 
-        if task == "appearance":
+        # Per-row early stop once the top-level JSON object closes
+        self.stop_on_json_end = stop_on_json_end
+
+        # Keep existing results and only generate missing cids
+        self.resume = resume
+
+        # Optional persistent prompt -> output cache shared across runs
+        self.cache = OutputCache(cache_path, cache_max_bytes) if cache_path else None
+
+        # Save quantized weights once and warm-start from them; optionally
+        # keep loaded models resident across run_all calls (model_cache.py)
+        self.model_cache = ModelLoadCache(load_cache_dir, keep_resident)
+
+        # Per-batch timings / token counts / repair counters (metrics.py);
+        # more consumers via self.metrics.add_hook(fn)
+        self.metrics = RunMetrics(metrics_path, prometheus_path)
+
+        # Mask the logits so only schema-valid JSON can be generated
+        # (json_grammar.py); outputs are short and always parse. Server
+        # backends get response_format json_object instead
+        self.constrained = constrained
+
+        # Grow the batch while generation fits, halve and retry on OOM, and
+        # remember the safe size per model (adaptive_batch.py). batch_size
+        # is the starting size unless token_budget or a remembered size says
+        # otherwise. oom_injector(rows) runs before each generate (testing).
+        self.adaptive_batch = adaptive_batch
+        self.max_batch_size = max_batch_size or 4 * batch_size
+        self.safe_batch_sizes = SafeBatchSizes(adaptive_state_path)
+        self.oom_injector = oom_injector
+
+        # Who generates (backends.py): "transformers" in process, "openai"
+        # for an OpenAI-compatible server, "llamacpp" for a local GGUF file.
+        # backend_options go to the backend (base_url, max_concurrency, ...)
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend must be one of {BACKENDS}")
+        self.backend = backend
+        self.backend_options = backend_options or {}
+
+        # Generate once per distinct comment text and copy the record to
+        # every cid with that text (dedup.py): "exact" (normalized text
+        # hash) or "near" (also MinHash near-duplicates)
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError(f"Dedup must be one of {DEDUP_MODES}")
+        self.dedup = dedup
+        self.near_dup_threshold = near_dup_threshold
+
+        # Speculative decoding (speculative.py): "draft" pairs each model with
+        # a small one from draft_models (default DRAFT_MODELS); "prompt_lookup"
+        # drafts n-grams from the prompt. Greedy outputs are unchanged. Off by
+        # default; when set, it is timed against plain batched generation on
+        # the first batch and dropped unless MIN_SPEEDUP faster.
+        if speculative is not None and speculative not in SPECULATIVE_MODES:
+            raise ValueError(f"Speculative mode must be one of {SPECULATIVE_MODES}")
+        self.speculative = speculative
+        self.draft_models = DRAFT_MODELS if draft_models is None else draft_models
+        self.prompt_lookup_tokens = prompt_lookup_tokens
+
+        # Prefill the shared instruction prefix once per model (static engine)
+        self.reuse_prefix_kv = reuse_prefix_kv
+
+        # Overlap tokenization / decoding / writing with generation
+        self.pipeline = pipeline
+        self.prefetch = prefetch
+
+        # "fixed" keeps input order; "length" buckets by prompt length
+        if schedule not in ("fixed", "length"):
+            raise ValueError("Schedule must be 'fixed' or 'length'")
+        self.schedule = schedule
+        self.token_budget = token_budget
+        # Comments sorted together in length mode; bounds memory on streams
+        self.schedule_window = schedule_window or 64 * batch_size
+
+        # "static" = one model.generate per batch; "continuous" refills
+        # finished rows' slots (see continuous_batching.py)
+        if engine not in ("static", "continuous"):
+            raise ValueError("Engine must be 'static' or 'continuous'")
+        self.engine = engine
+
+        if adaptive_batch and (engine != "static" or pipeline or mode != "generate"):
+            raise ValueError("adaptive_batch needs the static engine, generate mode and no pipeline")
+
+        if backend != "transformers" and (
+            engine != "static" or mode != "generate" or schedule != "fixed" or pipeline
+            or adaptive_batch or speculative or reuse_prefix_kv
+        ):
+            raise ValueError(
+                f"backend={backend!r} supports the fixed schedule in generate mode only "
+                "(no continuous engine, pipeline, adaptive_batch, speculative or reuse_prefix_kv)"
+            )
+
+        if speculative and (engine != "static" or mode != "generate" or constrained or reuse_prefix_kv):
+            raise ValueError(
+                "speculative needs the static engine and generate mode, "
+                "without constrained decoding or reuse_prefix_kv"
+            )
+
+        # A list of tasks runs them all in one combined prompt and writes
+        # one results file per task (see multitask.py)
+        self.tasks = normalize_tasks(task)
+        self.task_name = "+".join(self.tasks)
+        if len(self.tasks) > 1:
+            self.build_prompt = build_prompt_multitask
+            # Every output holds one object per task
+            self.max_new_tokens = max_new_tokens * len(self.tasks)
+        elif self.task_name == "appearance":
             self.build_prompt = build_prompt_appearance
-            self.task_name = "appearance"
-        elif task == "gbv":
-            self.build_prompt = build_prompt_gbv
-            self.task_name = "gbv"
         else:
-            raise ValueError("Task must be 'appearance' or 'gbv'")
+            self.build_prompt = build_prompt_gbv
+
+        # "generate" writes raw_output JSON; "score" runs one forward pass
+        # per batch and writes {cid, label, confidence} for one field
+        # (label = index into SCORE_FIELDS[field]["labels"])
+        if mode not in ("generate", "score"):
+            raise ValueError("Mode must be 'generate' or 'score'")
+        if mode == "score" and len(self.tasks) > 1:
+            raise ValueError("Score mode runs one task")
+        self.mode = mode
+        self.score_field = score_field or f"contains_{self.task_name}"
+        if mode == "score" and self.score_field not in SCORE_FIELDS:
+            raise ValueError(f"Score field must be one of {sorted(SCORE_FIELDS)}")
+        # Softmax temperature for confidences (label_scoring.fit_temperature)
+        self.score_temperature = score_temperature
+
+        # model_name -> PromptRenderer: template rendered and its fixed
+        # parts tokenized once per model
+        self.renderers = {}
 
         self.datasetName = "unKNOWN"
 
-        # ⚠ Use absolute path in production
-        self.output_base = "/datasets/cl0059/outputs/llm_results"
-        os.makedirs(self.output_base, exist_ok=True)
+        # ⚠ Use absolute path in production; created by process_dataset
+        self.output_base = output_base
 
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.allow_tf32 = True
@@ -115,14 +283,42 @@ class UnifiedLLMRunner:
     # -------------------------
     # Load Model
     # -------------------------
-    def load_model(self, model_id):
+    def load_settings(self):
+        """
+        What changes the loaded weights; part of the load cache key.
+        """
+        if self.device == "cpu":
+            # int8 is applied after loading (optimize_model), on float32 weights
+            return {"device": "cpu", "dtype": str(self.cpu_torch_dtype()).replace("torch.", "")}
+        return {"device": "cuda", "quantization": "nf4", "double_quant": True, "dtype": "float16"}
+
+    def cpu_torch_dtype(self):
+        return torch.bfloat16 if self.cpu_dtype == "bfloat16" else torch.float32
 
-        quant_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_use_double_quant=True
+    def load_model(self, model_id):
+        model, tokenizer = self.model_cache.load(
+            model_id, self.load_settings(), self.load_pretrained, placement=self.device
         )
+        self.last_load_stats = self.model_cache.last_load
+        return self.optimize_model(model), tokenizer
+
+    def optimize_model(self, model):
+        """
+        Post-load steps that are not cached on disk: dynamic int8
+        quantization (CPU) and torch.compile of the forward pass.
+        """
+        if self.device == "cpu" and self.cpu_dtype == "int8":
+            # Returns a quantized copy; a resident float model stays intact
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        if self.compile_decode and not getattr(model, "_compiled_forward", False):
+            model.forward = torch.compile(model.forward, dynamic=True)
+            model._compiled_forward = True
+        return model
+
+    def load_pretrained(self, model_id):
 
         tokenizer = AutoTokenizer.from_pretrained(model_id)
 
@@ -132,176 +328,1073 @@ class UnifiedLLMRunner:
 
         tokenizer.padding_side = "left"
 
-        model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            device_map="auto",
-            quantization_config=quant_config,
-            torch_dtype=torch.float16,
-            trust_remote_code=True
-        )
+        if self.device == "cpu":
+            # bitsandbytes 4-bit needs CUDA; weights load on the CPU by default
+            model = AutoModelForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=self.cpu_torch_dtype(),
+                trust_remote_code=True
+            )
+        else:
+            quant_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.float16,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True
+            )
+
+            model = AutoModelForCausalLM.from_pretrained(
+                model_id,
+                device_map="auto" if self.device == "cuda" else {"": self.device},
+                quantization_config=quant_config,
+                torch_dtype=torch.float16,
+                trust_remote_code=True
+            )
 
         model.eval()
         return model, tokenizer
 
 
+    def load_draft(self, model_name, tokenizer):
+        """
+        Draft model for speculative="draft", or None (prompt lookup instead)
+        when the model has no entry or the tokenizers differ.
+        """
+        draft_id = self.draft_models.get(model_name)
+        if draft_id is None:
+            print(f"⚠ No draft model for {model_name}, using prompt lookup")
+            return None
+
+        draft, draft_tokenizer = self.model_cache.load(
+            draft_id, self.load_settings(), self.load_pretrained, placement=self.device
+        )
+        draft = self.optimize_model(draft)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            print(f"⚠ {draft_id} does not share {model_name}'s tokenizer, using prompt lookup")
+            return None
+        return draft
+
+
     # -------------------------
     # Build Inputs (Chat-aware)
     # -------------------------
     ### Updated to force JSON prefix anchor for better output consistency across models, especially those that may not follow instructions as strictly. This should help ensure that the model's response starts with a JSON object, improving parsing reliability.
-    def build_inputs(self, tokenizer, comments, model_name):
+    def render_prompt(self, tokenizer, comment, model_name):
 
-        prompts = []
+        if hasattr(tokenizer, "apply_chat_template") and tokenizer.chat_template:
+            return tokenizer.apply_chat_template(
+                self.build_messages(comment, model_name),
+                tokenize=False,
+                add_generation_prompt=True
+            )
 
-        for comment in comments:
+        return self.anchored_prompt(comment)
 
-            base_prompt = self.build_prompt(comment)
+    def anchored_prompt(self, comment):
 
-            # Force JSON prefix anchor
-            base_prompt = base_prompt + "\n\nReturn ONLY valid JSON.\nThe first character of your response MUST be '{'.\n"
+        base_prompt = self.build_prompt(comment)
 
-            if hasattr(tokenizer, "apply_chat_template") and tokenizer.chat_template:
+        # Force JSON prefix anchor
+        return base_prompt + "\n\nReturn ONLY valid JSON.\nThe first character of your response MUST be '{'.\n"
 
-                if "llama" in model_name.lower():
-                    messages = [
-                        {"role": "system", "content":
-                            "You are a strict information extraction system. "
-                            "You must output valid JSON only. "
-                            "Do not explain. Do not continue text. "
-                            f"If no {self.task_name}, return contains_{self.task_name}=false JSON."
-                        },
-                        {"role": "user", "content": base_prompt}
-                    ]
+    def build_messages(self, comment, model_name):
+        """
+        Chat messages for one comment (rendered with the tokenizer's chat
+        template, or sent as-is to a server backend).
+        """
+        base_prompt = self.anchored_prompt(comment)
 
-                elif "gemma" in model_name.lower():
-                    messages = [
-                        {"role": "user", "content": base_prompt}
-                    ]
+        if "llama" in model_name.lower():
+            if len(self.tasks) > 1:
+                absent = "For each task not present, return its contains_<task>=false object."
+            else:
+                absent = f"If no {self.task_name}, return contains_{self.task_name}=false JSON."
+            return [
+                {"role": "system", "content":
+                    "You are a strict information extraction system. "
+                    "You must output valid JSON only. "
+                    "Do not explain. Do not continue text. "
+                    + absent
+                },
+                {"role": "user", "content": base_prompt}
+            ]
+
+        if "gemma" in model_name.lower():
+            return [
+                {"role": "user", "content": base_prompt}
+            ]
+
+        return [
+            {"role": "system", "content":
+                "You are a strict JSON-only classifier."
+            },
+            {"role": "user", "content": base_prompt}
+        ]
+
+    def prompt_renderer(self, tokenizer, model_name):
+        """
+        Memoized render_prompt + tokenization for model_name's template.
+        """
+        renderer = self.renderers.get(model_name)
+        if renderer is None or renderer.tokenizer is not tokenizer:
+            renderer = PromptRenderer(
+                tokenizer,
+                lambda comment: self.render_prompt(tokenizer, comment, model_name),
+                max_length=MAX_PROMPT_LENGTH
+            )
+            if not renderer.fast:
+                print(f"⚠ {model_name}: prompt template not splittable, tokenizing full prompts")
+            self.renderers[model_name] = renderer
+        return renderer
 
-                else:
-                    messages = [
-                        {"role": "system", "content":
-                            "You are a strict JSON-only classifier."
-                        },
-                        {"role": "user", "content": base_prompt}
-                    ]
+    def build_inputs(self, tokenizer, comments, model_name):
 
-                prompt = tokenizer.apply_chat_template(
-                    messages,
-                    tokenize=False,
-                    add_generation_prompt=True
-                )
+        renderer = self.prompt_renderer(tokenizer, model_name)
 
-            else:
-                prompt = base_prompt
+        return renderer.encode(comments).to(self.device)
 
-            prompts.append(prompt)
+    def tokenize_prompts(self, tokenizer, prompts):
 
         inputs = tokenizer(
             prompts,
             return_tensors="pt",
             padding=True,
             truncation=True,
-            max_length=1024
+            max_length=MAX_PROMPT_LENGTH
         ).to(self.device)
 
         return inputs
 
 
     # -------------------------
-    # Batch Processing
+    # Batch Scheduling
     # -------------------------
-    def process_dataset(self, comments, model_name, model_id):
+    def prompt_lengths(self, tokenizer, comments, model_name):
+        """
+        Tokenized (truncated) prompt length for each comment.
+        """
+        renderer = self.prompt_renderer(tokenizer, model_name)
+        lengths = []
+        for i in range(0, len(comments), 256):
+            lengths.extend(renderer.lengths(comments[i:i+256]))
+        return lengths
+
+    def schedule_batches(self, tokenizer, comments, model_name):
+        """
+        Lazily split a (cid, text) iterable into batches.
+
+        schedule="fixed": input order, batch_size rows per batch.
+        schedule="length": within each window of schedule_window comments,
+        longest prompts first, each batch filled while
+        rows * (longest prompt + max_new_tokens) stays within token_budget.
+        The default budget is what a fixed batch of the window's longest
+        prompts costs.
+
+        Returns (batches, stats). batches is a generator; stats is filled in
+        as it runs with the padding-waste ratio of the fixed split
+        ("before") and of the scheduled split ("after").
+        """
+        stats = {}
+
+        if self.schedule == "fixed":
+            return batched(comments, self.batch_size), stats
+
+        totals = {"before": [0, 0, 0], "after": [0, 0, 0]}
+
+        def tally(name, batch_lengths):
+            padded, real = padding_totals(batch_lengths)
+            totals[name][0] += len(batch_lengths)
+            totals[name][1] += padded
+            totals[name][2] += real
+            stats["batches_" + name] = totals[name][0]
+            stats["padding_waste_" + name] = (
+                1.0 - totals[name][2] / totals[name][1] if totals[name][1] else 0.0
+            )
+
+        def generate():
+            for window in batched(comments, self.schedule_window):
+                lengths = self.prompt_lengths(
+                    tokenizer, [text for _, text in window], model_name
+                )
+
+                budget = self.token_budget
+                if budget is None:
+                    budget = self.batch_size * (max(lengths) + self.max_new_tokens)
 
-        output_file = os.path.join(
+                order = sorted(range(len(window)), key=lambda k: lengths[k], reverse=True)
+
+                batches = []
+                current = []
+                for k in order:
+                    # Sorted descending, so the first row sets the padded length
+                    longest = lengths[current[0]] if current else lengths[k]
+                    if current and (len(current) + 1) * (longest + self.max_new_tokens) > budget:
+                        batches.append(current)
+                        current = []
+                    current.append(k)
+                if current:
+                    batches.append(current)
+
+                tally("before", [
+                    lengths[i:i+self.batch_size]
+                    for i in range(0, len(lengths), self.batch_size)
+                ])
+                tally("after", [[lengths[j] for j in batch] for batch in batches])
+
+                for batch in batches:
+                    yield [window[j] for j in batch]
+
+        return generate(), stats
+
+
+    # -------------------------
+    # Batch Processing
+    # -------------------------
+    def output_path(self, model_name, task=None):
+        task = task or self.task_name
+        if self.mode == "score":
+            return os.path.join(
+                self.output_base,
+                f"{model_name}_{task}_{self.score_field}_scores_{self.datasetName}.jsonl"
+            )
+        return os.path.join(
             self.output_base,
-            f"{model_name}_{self.task_name}_results_{self.datasetName}.jsonl"
+            f"{model_name}_{task}_results_{self.datasetName}.jsonl"
         )
 
-        # Check if file exists and has content
-        if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-            # 'w' mode opens for writing and truncates the file to zero length
-            with open(output_file, 'w') as f:
-                pass
+    def output_paths(self, model_name):
+        """
+        {task: results file}; one entry per configured task.
+        """
+        return {task: self.output_path(model_name, task) for task in self.tasks}
+
+    def open_checkpoint(self, model_name):
+        if len(self.tasks) == 1:
+            return ResultsCheckpoint(self.output_path(model_name))
+        return TaskSplitCheckpoint({
+            task: ResultsCheckpoint(path) for task, path in self.output_paths(model_name).items()
+        })
+
+    def open_session(self, model_name, model_id):
+        """
+        Load the model and build everything the batch stages need for it
+        (stop table, grammar, prefix KV, speculative settings). The caller
+        sets session["checkpoint"] before writing records.
+        """
+        model, tokenizer = self.load_model(model_id)
+
+        # Token-id -> brace/string scanner table, built once per tokenizer
+        stop_table = build_json_stop_table(tokenizer) if self.stop_on_json_end else None
+
+        # Schema automaton + per-state token masks, built once per tokenizer
+        grammar = SchemaIndex.for_tasks(self.tasks, tokenizer) if self.constrained else None
+
+        # KV cache of the instruction block shared by every prompt
+        prefix = None
+        if self.reuse_prefix_kv and self.mode == "generate":
+            prefix = PromptPrefixCache.from_template(
+                model, tokenizer,
+                lambda comment: self.render_prompt(tokenizer, comment, model_name),
+                max_prompt_length=MAX_PROMPT_LENGTH
+            )
+            print(f"🧩 Cached {len(prefix)} shared prefix tokens")
+
+        speculative = None
+        draft = None
+        if self.speculative:
+            mode = self.speculative
+            if mode == "draft":
+                draft = self.load_draft(model_name, tokenizer)
+                if draft is None:
+                    mode = "prompt_lookup"
+            speculative = speculative_kwargs(mode, draft, self.prompt_lookup_tokens)
+            self.speculative_stats = new_stats()
+            print(f"🎯 Speculative decoding: {mode}")
+
+        return {
+            "model": model,
+            "tokenizer": tokenizer,
+            "model_name": model_name,
+            "model_id": model_id,
+            "renderer": self.prompt_renderer(tokenizer, model_name),
+            "stop_table": stop_table,
+            "grammar": grammar,
+            "prefix": prefix,
+            "speculative": speculative,
+            # Set once the first batch has timed speculative vs plain
+            "speculative_measured": False,
+            "checkpoint": None,
+        }
+
+    def open_backend_session(self, model_name, model_id):
+        """
+        Session for a non-transformers backend; model_id is what the backend
+        loads (server model name, GGUF path).
+        """
+        backend = make_backend(self.backend, self.backend_options)
+        backend.open(model_name, model_id, {
+            "max_new_tokens": self.max_new_tokens,
+            "json_mode": self.constrained,
+        })
+        print(f"🔌 {model_name} via {self.backend} backend")
+        return {
+            "backend": backend,
+            "model_name": model_name,
+            "model_id": model_id,
+            "checkpoint": None,
+        }
+
+    def process_dataset(self, comments, model_name, model_id):
+
+        os.makedirs(self.output_base, exist_ok=True)
+        checkpoint = self.open_checkpoint(model_name)
+
+        if self.resume:
+            # Keep what is already written, generate only missing cids
+            completed = checkpoint.recover()
+            if all(cid in completed for cid, _ in comments):
+                print(f"⏭ {model_name} already complete")
+                return
+            if completed:
+                print(f"↩ Resuming {model_name}: {len(completed)} already done")
+            comments = ExcludedComments(comments, completed)
+        else:
+            checkpoint.reset()
 
         print(f"\n🚀 Running {model_name}")
         clear_gpu_memory()
+        if self.metrics.enabled:
+            self.metrics.start_run(model_name, self.task_name)
 
-        model, tokenizer = self.load_model(model_id)
+        if self.backend == "transformers":
+            session = self.open_session(model_name, model_id)
+        else:
+            session = self.open_backend_session(model_name, model_id)
+
+        deduper = None
+        if self.dedup:
+            deduper = CommentDeduper(self.dedup, self.near_dup_threshold)
+            comments = deduper.unique(comments)
+            checkpoint = deduper.wrap(checkpoint)
+
+        # The deduper's temporary SQLite file goes even if the run fails
+        try:
+            batches, schedule_stats = self.schedule_batches(session.get("tokenizer"), comments, model_name)
+            session["checkpoint"] = checkpoint
+
+            timer = StageTimer()
+
+            if self.backend != "transformers":
+                self.run_backend(session, batches, timer)
+            elif self.mode == "score":
+                self.run_scoring(session, batches, timer)
+            elif self.engine == "continuous":
+                self.run_continuous(session, batches)
+            elif self.pipeline:
+                self.run_pipelined(session, batches, timer)
+            elif self.adaptive_batch:
+                self.run_adaptive(session, batches, timer)
+            else:
+                for batch in tqdm(batches):
+                    with timer.stage("prepare"):
+                        job = self.prepare_batch(session, batch)
+                    with timer.stage("generate"):
+                        self.generate_batch(session, job)
+                    with timer.stage("finish"):
+                        self.finish_batch(session, job)
+        finally:
+            if deduper is not None:
+                deduper.close()
+
+        self.last_schedule_stats = schedule_stats
+        if schedule_stats:
+            print(
+                f"📦 Length schedule: {schedule_stats['batches_before']} → "
+                f"{schedule_stats['batches_after']} batches, padding waste "
+                f"{schedule_stats['padding_waste_before']:.1%} → "
+                f"{schedule_stats['padding_waste_after']:.1%}"
+            )
 
-        # stopping_criteria = StoppingCriteriaList([
-        #     StopOnJSONEnd(tokenizer)
-        # ])
-
-        for i in tqdm(range(0, len(comments), self.batch_size)):
-
-            batch = comments[i:i+self.batch_size]
-            batch_cids = [cid for cid, _ in batch]
-            batch_comments = [text for _, text in batch]
-
-            inputs = self.build_inputs(tokenizer, batch_comments, model_name)
-
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=self.max_new_tokens,
-                    do_sample=False,
-                    temperature=0.0,
-                    top_p=1.0,
-                    repetition_penalty=1.1,
-                    use_cache=True,
-                    eos_token_id=tokenizer.eos_token_id,
-                    pad_token_id=tokenizer.eos_token_id,
-                    # stopping_criteria=stopping_criteria
-                )
+        self.last_stage_times = timer.summary()
+        # The speculative probe generated its batch a second time
+        self.last_speculative_probe = session.get("speculative_probe")
+        if self.last_speculative_probe and "generate" in self.last_stage_times:
+            probe_seconds = self.last_speculative_probe["speculative_seconds"]
+            self.last_stage_times["generate"]["seconds"] -= probe_seconds
+            self.last_stage_times["speculative_probe"] = {"seconds": probe_seconds, "calls": 1}
+        if self.last_stage_times:
+            print("⏱ " + ", ".join(
+                f"{name} {stats['seconds']:.2f}s" for name, stats in self.last_stage_times.items()
+            ))
+
+        self.last_dedup_stats = None
+        if deduper is not None:
+            self.last_dedup_stats = deduper.summary()
+            print(
+                f"🧬 Dedup: {self.last_dedup_stats['comments']} comments → "
+                f"{self.last_dedup_stats['unique']} generations "
+                f"({self.last_dedup_stats['exact_duplicates']} exact, "
+                f"{self.last_dedup_stats['near_duplicates']} near duplicates)"
+            )
 
-            # Only decode generated part of the sequence for efficiency and to avoid decoding the prompt
-            generated_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        self.last_speculative_stats = None
+        if session.get("speculative") is not None:
+            self.last_speculative_stats = summarize(self.speculative_stats)
+            print(
+                f"🎯 Acceptance {self.last_speculative_stats['acceptance_rate']:.1%}, "
+                f"{self.last_speculative_stats['tokens_per_step']:.2f} tokens per target step"
+            )
 
-            decoded = tokenizer.batch_decode(
-                generated_tokens,
-                skip_special_tokens=True
+        if self.metrics.enabled:
+            self.metrics.finish_run(
+                model_name, self.task_name,
+                mode=self.mode,
+                engine=self.engine,
+                stages=self.last_stage_times,
+                schedule=schedule_stats,
+                load=getattr(self, "last_load_stats", None),
+                continuous=self.last_engine_stats
+                if self.mode == "generate" and self.engine == "continuous" else None,
+                speculative=self.last_speculative_stats,
+                dedup=self.last_dedup_stats
             )
 
-            cleaned_outputs = []
+        if "backend" in session:
+            session["backend"].close()
+        session.clear()
+        self.renderers.pop(model_name, None)
+        clear_gpu_memory()
+
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"💾 Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evicted")
+
+        print(f"✅ Completed {model_name}")
+
+    # -------------------------
+    # Generation
+    # -------------------------
+    def generation_settings(self):
+        """
+        Everything besides model and prompt that changes the generated text.
+        Part of the output cache key.
+        """
+        settings = {
+            "max_new_tokens": self.max_new_tokens,
+            "do_sample": False,
+            "repetition_penalty": 1.1,
+            "max_prompt_length": MAX_PROMPT_LENGTH,
+            "stop_on_json_end": self.stop_on_json_end,
+        }
+        if self.constrained:
+            settings["constrained"] = self.task_name
+        if self.backend == "transformers":
+            # Weight precision and device change the logits, so every load
+            # setting gets its own cache entries
+            settings.update(self.load_settings())
+            if self.device == "cpu" and self.cpu_dtype == "int8":
+                settings["quantization"] = "int8_dynamic"
+        return settings
+
+    def generate_kwargs(self, tokenizer, stop_table=None, grammar=None, prompt_length=None):
+        return dict(
+            max_new_tokens=self.max_new_tokens,
+            do_sample=False,
+            temperature=0.0,
+            top_p=1.0,
+            repetition_penalty=1.1,
+            use_cache=True,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList(
+                [StopOnJSONEnd(stop_table, prompt_length)] if stop_table is not None else []
+            ),
+            logits_processor=LogitsProcessorList(
+                [JSONSchemaLogitsProcessor(grammar)] if grammar is not None else []
+            )
+        )
 
-            for output in decoded:
-                output = output.strip()
+    def prepare_batch(self, session, batch, tokenizer=None):
+        """
+        CPU stage: render prompts, look them up in the output cache and
+        tokenize the misses. Returns a job dict for generate_batch().
+        """
+        tokenizer = tokenizer or session["tokenizer"]
+        timer = StageTimer() if self.metrics.enabled else None
+        with self.batch_stage(timer, "template"):
+            texts = [text for _, text in batch]
+            prompts = session["renderer"].render_many(texts)
+        return self.prepare_prompts(
+            session, [cid for cid, _ in batch], prompts, tokenizer, timer=timer, texts=texts
+        )
 
-                # If model did not start JSON, discard garbage
-                # Trim leading garbage
-                if "{" in output:
-                    output = output[output.find("{"):]
+    def batch_stage(self, timer, name):
+        """
+        Per-batch stage timing when metrics are enabled (timer is None otherwise).
+        """
+        return timer.stage(name) if timer is not None else nullcontext()
+
+    def prepare_prompts(self, session, cids, prompts, tokenizer=None, timer=None, texts=None):
+        """
+        texts: the comments the prompts were rendered from; when given, only
+        they are tokenized (session renderer) instead of the whole prompts.
+        """
+        tokenizer = tokenizer or session["tokenizer"]
+        prefix = session["prefix"]
+        if timer is None and self.metrics.enabled:
+            timer = StageTimer()
+
+        job = {
+            "cids": cids,
+            "prompts": prompts,
+            "keys": None,
+            "outputs": {},
+            "missing": list(range(len(prompts))),
+            "inputs": None,
+            "use_prefix": False,
+            # Metrics only (None when disabled)
+            "timer": timer,
+            "counts": {} if timer is not None else None,
+        }
+
+        if self.cache is not None:
+            settings = self.generation_settings()
+            job["keys"] = [
+                OutputCache.make_key(session["model_id"], prompt, settings)
+                for prompt in prompts
+            ]
+            hits = self.cache.get_many(job["keys"])
+            job["outputs"] = {
+                k: hits[key] for k, key in enumerate(job["keys"]) if key in hits
+            }
+            job["missing"] = [k for k in range(len(prompts)) if k not in job["outputs"]]
+
+        if job["missing"]:
+            missing_prompts = [prompts[k] for k in job["missing"]]
+
+            with self.batch_stage(timer, "tokenize"):
+                # Only the comment suffix is prefilled when the prefix KV is cached
+                suffixes = prefix.split(missing_prompts) if prefix is not None else None
+                if suffixes is not None:
+                    input_ids, attention_mask = prefix.build_inputs(suffixes)
+                    job["inputs"] = {"input_ids": input_ids, "attention_mask": attention_mask}
+                    job["use_prefix"] = True
+                elif texts is not None:
+                    job["inputs"] = session["renderer"].encode(
+                        [texts[k] for k in job["missing"]], tokenizer
+                    ).to(self.device)
                 else:
-                    output = ""
-                # Do NOT cut at first }
-                # Let repair_json handle bracket balancing
+                    job["inputs"] = self.tokenize_prompts(tokenizer, missing_prompts)
+
+        if job["counts"] is not None:
+            mask = job["inputs"]["attention_mask"] if job["inputs"] is not None else None
+            prompt_tokens = int(mask.sum()) if mask is not None else 0
+            job["counts"].update(
+                rows=len(prompts),
+                cache_hits=len(prompts) - len(job["missing"]),
+                prompt_tokens=prompt_tokens,
+                padding_tokens=mask.numel() - prompt_tokens if mask is not None else 0,
+            )
+
+        return job
+
+    def generate_batch(self, session, job):
+        """
+        Accelerator stage: model.generate over the job's cache misses.
+        """
+        if not job["missing"]:
+            job["generated"] = None
+            return job
+
+        if session["speculative"] is not None:
+            if not session["speculative_measured"]:
+                return self.measure_speculative(session, job)
+            return self.generate_speculative(session, job)
+        return self.generate_plain(session, job)
+
+    def generate_plain(self, session, job):
+        """
+        One batched model.generate over the job's cache misses.
+        """
+        inputs = job["inputs"]
+        kwargs = self.generate_kwargs(
+            session["tokenizer"], session["stop_table"], session["grammar"]
+        )
+        if job["use_prefix"]:
+            kwargs["past_key_values"] = session["prefix"].expanded_cache(len(job["missing"]))
+
+        clock = None
+        if job["timer"] is not None:
+            # Prefill ends when the first token's logits are processed
+            clock = FirstTokenClock()
+            kwargs["logits_processor"].append(clock)
+            start = time.perf_counter()
+
+        if self.oom_injector is not None:
+            self.oom_injector(len(job["missing"]))
+
+        with torch.no_grad():
+            outputs = session["model"].generate(**inputs, **kwargs)
+
+        # Only decode generated part of the sequence for efficiency and to avoid decoding the prompt
+        job["generated"] = outputs[:, inputs["input_ids"].shape[1]:].cpu()
+        job["inputs"] = None
+
+        if clock is not None:
+            end = time.perf_counter()
+            first = clock.first or end
+            job["timer"].add("prefill", first - start)
+            job["timer"].add("decode", end - first)
+            job["counts"]["generated_tokens"] = int(
+                generated_lengths(job["generated"], session["tokenizer"].eos_token_id).sum()
+            )
+        return job
+
+    def generate_speculative(self, session, job):
+        """
+        generate_batch with draft / prompt-lookup candidates, one row at a time.
+        """
+        tokenizer = session["tokenizer"]
+        inputs = job["inputs"]
+
+        def row_kwargs(prompt_length):
+            kwargs = self.generate_kwargs(tokenizer, session["stop_table"], prompt_length=prompt_length)
+            kwargs.update(session["speculative"])
+            return kwargs
+
+        if self.oom_injector is not None:
+            self.oom_injector(len(job["missing"]))
+
+        start = time.perf_counter()
+        with count_steps(session["model"], self.speculative_stats):
+            generated = generate_rows(
+                session["model"], inputs["input_ids"], inputs["attention_mask"],
+                row_kwargs, tokenizer.eos_token_id, self.speculative_stats
+            )
+
+        job["generated"] = generated.cpu()
+        job["inputs"] = None
+
+        if job["timer"] is not None:
+            job["timer"].add("decode", time.perf_counter() - start)
+            job["counts"]["generated_tokens"] = int(
+                generated_lengths(job["generated"], tokenizer.eos_token_id).sum()
+            )
+        return job
+
+    def measure_speculative(self, session, job):
+        """
+        First batch: speculative row by row as a probe, then plain batched
+        generation, whose outputs the batch keeps (greedy, so they are the
+        same). Speculative decoding stays on for the session only if it was
+        at least MIN_SPEEDUP faster. The probe's time goes to
+        session["speculative_probe"], not to the batch.
+        """
+        session["speculative_measured"] = True
+
+        start = time.perf_counter()
+        self.generate_speculative(session, dict(job, timer=None))
+        speculative_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        job = self.generate_plain(session, job)
+        plain_seconds = time.perf_counter() - start
+
+        speedup = plain_seconds / speculative_seconds if speculative_seconds else 0.0
+        kept = speedup >= MIN_SPEEDUP
+        if not kept:
+            session["speculative"] = None
+        session["speculative_probe"] = {
+            "plain_seconds": plain_seconds,
+            "speculative_seconds": speculative_seconds,
+            "speedup": speedup,
+            "kept": kept,
+            **summarize(self.speculative_stats),
+        }
+        print(
+            f"{'🎯' if kept else '⚠'} Speculative decoding {speedup:.2f}× vs batched generation, "
+            f"acceptance {session['speculative_probe']['acceptance_rate']:.1%}"
+            f"{'' if kept else ', turned off'} (probe {speculative_seconds:.2f}s, not counted)"
+        )
+        return job
+
+    def collect_outputs(self, session, job, tokenizer=None):
+        """
+        Decode generated ids, store them in the output cache and merge with
+        the cache hits. Returns decoded text per prompt, in batch order.
+        """
+        tokenizer = tokenizer or session["tokenizer"]
+
+        if job["generated"] is not None:
+            decoded = tokenizer.batch_decode(
+                job["generated"],
+                skip_special_tokens=True
+            )
+            fresh = dict(zip(job["missing"], decoded))
+            if self.cache is not None:
+                self.cache.put_many({job["keys"][k]: text for k, text in fresh.items()})
+            job["outputs"].update(fresh)
+
+        return [job["outputs"][k] for k in range(len(job["prompts"]))]
+
+    def finish_batch(self, session, job, tokenizer=None):
+        """
+        CPU stage: decode, clean/repair and append the batch's records.
+        """
+        timer = job["timer"]
+        if timer is None:
+            decoded = self.collect_outputs(session, job, tokenizer)
+            cleaned_outputs = [clean_output(output) for output in decoded]
+            self.write_records(
+                session["checkpoint"], session["model_name"], job["cids"], cleaned_outputs
+            )
+            return
+
+        with timer.stage("batch_decode"):
+            decoded = self.collect_outputs(session, job, tokenizer)
+        with timer.stage("repair"):
+            cleaned_outputs, repaired, discarded = self.clean_outputs_counted(decoded)
+        with timer.stage("write"):
+            self.write_records(
+                session["checkpoint"], session["model_name"], job["cids"], cleaned_outputs
+            )
 
-                output = repair_json(output)
-                cleaned_outputs.append(output)
+        job["counts"].update(repaired=repaired, discarded=discarded)
+        self.metrics.record_batch(session["model_name"], self.task_name, job["counts"], timer)
+
+    def clean_outputs_counted(self, outputs):
+        """
+        clean_output over outputs, plus how many needed JSON repair and how
+        many had no JSON object at all (written as empty raw_output).
+        """
+        cleaned_outputs = []
+        repaired = discarded = 0
+        for output in outputs:
+            span, cleaned = scan_json(output)
+            if not cleaned:
+                discarded += 1
+            elif cleaned != span:
+                repaired += 1
+            cleaned_outputs.append(cleaned)
+        return cleaned_outputs, repaired, discarded
+
+    def generate_cached(self, session, prompts, texts=None):
+        """
+        All three stages for a list of prompts, without writing records.
+        """
+        job = self.prepare_prompts(session, [None] * len(prompts), prompts, texts=texts)
+        self.generate_batch(session, job)
+        return self.collect_outputs(session, job)
+
+    def run_pipelined(self, session, batches, timer):
+        """
+        Overlap CPU and accelerator work: a producer thread prepares the
+        next batches while the main thread generates, and a consumer thread
+        decodes, repairs and writes finished batches. Queues are bounded by
+        `prefetch` batches so memory stays flat.
+        """
+        # Separate tokenizer instances: fast tokenizers are not safe to
+        # encode and decode concurrently from several threads
+        prepare_tokenizer = copy.deepcopy(session["tokenizer"])
+        finish_tokenizer = copy.deepcopy(session["tokenizer"])
+
+        progress = tqdm()
+
+        def finish(job):
+            self.finish_batch(session, job, finish_tokenizer)
+            progress.update(1)
+
+        run_pipeline(
+            batches,
+            prepare=lambda batch: self.prepare_batch(session, batch, prepare_tokenizer),
+            generate=lambda job: self.generate_batch(session, job),
+            finish=finish,
+            prefetch=self.prefetch,
+            timer=timer
+        )
+        progress.close()
+
+    def initial_batch_size(self, model_id):
+        remembered = self.safe_batch_sizes.get(model_id)
+        if remembered:
+            return remembered["safe"]
+        if self.token_budget:
+            # Worst case: every row at the prompt limit plus a full generation
+            return max(1, self.token_budget // (MAX_PROMPT_LENGTH + self.max_new_tokens))
+        return self.batch_size
+
+    def run_adaptive(self, session, batches, timer):
+        """
+        Static generation with AdaptiveBatchSizer choosing each batch's size.
+        Rows of a batch that ran out of memory go back to the front of the
+        queue and are retried at half the size; nothing is skipped.
+        """
+        model_id = session["model_id"]
+        remembered = self.safe_batch_sizes.get(model_id) or {}
+        sizer = AdaptiveBatchSizer(
+            self.initial_batch_size(model_id), self.max_batch_size,
+            ceiling=remembered.get("ceiling")
+        )
+        rows = (row for batch in batches for row in batch)
+        pending = deque()
+        progress = tqdm(unit="comments")
+
+        while True:
+            while len(pending) < sizer.size:
+                row = next(rows, None)
+                if row is None:
+                    break
+                pending.append(row)
+            if not pending:
+                break
+
+            batch = [pending.popleft() for _ in range(min(sizer.size, len(pending)))]
+            try:
+                with timer.stage("prepare"):
+                    job = self.prepare_batch(session, batch)
+                with timer.stage("generate"):
+                    self.generate_batch(session, job)
+            except Exception as e:
+                if not is_oom(e):
+                    raise
+                job = None
+                clear_gpu_memory()
+                retry = sizer.failure(len(batch))
+                print(f"⚠ OOM at {len(batch)} rows, retrying with {retry}")
+                if self.metrics.enabled:
+                    self.metrics.emit({
+                        "event": "oom",
+                        "model": session["model_name"],
+                        "task": self.task_name,
+                        "rows": len(batch),
+                        "retry_rows": retry,
+                    })
+                pending.extendleft(reversed(batch))
+                continue
+
+            with timer.stage("finish"):
+                self.finish_batch(session, job)
+            sizer.success(len(batch))
+            progress.update(len(batch))
+
+        progress.close()
+
+        self.safe_batch_sizes.update(model_id, sizer)
+        self.last_adaptive_stats = sizer.stats()
+        print(
+            f"📦 Adaptive batching: size {sizer.size}, safe {sizer.safe}, "
+            f"{sizer.ooms} OOM retries"
+        )
 
-            with open(output_file, "a") as f:
-                # for cid, output in zip(batch_cids, decoded):
-                for cid, output in zip(batch_cids, cleaned_outputs):
-                    record = {
+    def write_records(self, checkpoint, model_name, cids, outputs):
+        checkpoint.append([
+            {
+                "model": model_name,
+                "cid": cid,
+                "raw_output": output.strip()
+            }
+            for cid, output in zip(cids, outputs)
+        ])
+
+    def run_backend(self, session, batches, timer):
+        """
+        Batches through a backends.py backend: chat messages in, text out,
+        then the same cleaning and records as the transformers path.
+        """
+        backend = session["backend"]
+        model_name = session["model_name"]
+        settings = dict(self.generation_settings(), backend=self.backend)
+
+        for batch in tqdm(batches):
+            batch_timer = StageTimer() if self.metrics.enabled else None
+            with timer.stage("prepare"), self.batch_stage(batch_timer, "template"):
+                cids = [cid for cid, _ in batch]
+                conversations = [self.build_messages(text, model_name) for _, text in batch]
+
+                outputs = {}
+                keys = None
+                if self.cache is not None:
+                    keys = [
+                        OutputCache.make_key(session["model_id"], json.dumps(messages), settings)
+                        for messages in conversations
+                    ]
+                    hits = self.cache.get_many(keys)
+                    outputs = {k: hits[key] for k, key in enumerate(keys) if key in hits}
+                missing = [k for k in range(len(batch)) if k not in outputs]
+
+            with timer.stage("generate"), self.batch_stage(batch_timer, "request"):
+                if missing:
+                    fresh = dict(zip(missing, backend.generate([conversations[k] for k in missing])))
+                    if self.cache is not None:
+                        self.cache.put_many({keys[k]: text for k, text in fresh.items()})
+                    outputs.update(fresh)
+
+            with timer.stage("finish"):
+                decoded = [outputs[k] for k in range(len(batch))]
+                if batch_timer is None:
+                    self.write_records(
+                        session["checkpoint"], model_name, cids,
+                        [clean_output(output) for output in decoded]
+                    )
+                    continue
+                with batch_timer.stage("repair"):
+                    cleaned_outputs, repaired, discarded = self.clean_outputs_counted(decoded)
+                with batch_timer.stage("write"):
+                    self.write_records(session["checkpoint"], model_name, cids, cleaned_outputs)
+                self.metrics.record_batch(model_name, self.task_name, {
+                    "rows": len(cids),
+                    "cache_hits": len(cids) - len(missing),
+                    "repaired": repaired,
+                    "discarded": discarded,
+                }, batch_timer)
+
+    def run_scoring(self, session, batches, timer):
+        """
+        One forward pass per batch over the candidate labels of
+        self.score_field; no generation.
+        """
+        tokenizer = session["tokenizer"]
+        model_name = session["model_name"]
+        renderer = session["renderer"]
+
+        scorer = LabelScorer(
+            session["model"], tokenizer, self.score_field,
+            renderer.render,
+            temperature=self.score_temperature,
+            max_prompt_length=MAX_PROMPT_LENGTH
+        )
+        print(f"🧮 Scoring {self.score_field} ({scorer.mode}): {', '.join(scorer.labels)}")
+
+        for batch in tqdm(batches):
+            batch_timer = StageTimer() if self.metrics.enabled else None
+            with timer.stage("prepare"), self.batch_stage(batch_timer, "template"):
+                cids = [cid for cid, _ in batch]
+                prompts = renderer.render_many([text for _, text in batch])
+            with timer.stage("score"), self.batch_stage(batch_timer, "score"):
+                results = scorer.classify(prompts)
+            with timer.stage("finish"), self.batch_stage(batch_timer, "write"):
+                session["checkpoint"].append([
+                    {
                         "model": model_name,
                         "cid": cid,
-                        "raw_output": output.strip()
+                        "label": label,
+                        "confidence": confidence
                     }
-                    f.write(json.dumps(record) + "\n")
+                    for cid, (label, confidence) in zip(cids, results)
+                ])
+            if batch_timer is not None:
+                self.metrics.record_batch(model_name, self.task_name, {"rows": len(cids)}, batch_timer)
+
+    def run_continuous(self, session, batches):
+        """
+        Feed every comment through ContinuousBatchingEngine (batch_size slots)
+        and write records in completion order, batch_size at a time.
+        """
+        model = session["model"]
+        tokenizer = session["tokenizer"]
+        model_name = session["model_name"]
+        model_id = session["model_id"]
+        checkpoint = session["checkpoint"]
+
+        engine = ContinuousBatchingEngine(
+            model, tokenizer,
+            max_slots=self.batch_size,
+            max_new_tokens=self.max_new_tokens,
+            repetition_penalty=1.1,
+            max_prompt_length=MAX_PROMPT_LENGTH,
+            stop_table=session["stop_table"],
+            grammar=session["grammar"]
+        )
 
-        del model
-        del tokenizer
-        clear_gpu_memory()
+        pending_cids = []
+        pending_outputs = []
+        pending_tokens = [0]
+        settings = self.generation_settings()
+        keys = {}
+        fresh = {}
+
+        def requests():
+            # Cache hits skip the engine and are written with the next flush;
+            # one cache lookup (one transaction) per scheduling window
+            for batch in batches:
+                prompts = [session["renderer"].render(text) for _, text in batch]
+                if self.cache is None:
+                    yield from ((cid, prompt) for (cid, _), prompt in zip(batch, prompts))
+                    continue
+                batch_keys = [OutputCache.make_key(model_id, prompt, settings) for prompt in prompts]
+                hits = self.cache.get_many(batch_keys)
+                for (cid, _), prompt, key in zip(batch, prompts, batch_keys):
+                    if key in hits:
+                        pending_cids.append(cid)
+                        pending_outputs.append(hits[key])
+                        continue
+                    keys[cid] = key
+                    yield cid, prompt
+
+        def flush():
+            if fresh:
+                self.cache.put_many(fresh)
+                fresh.clear()
+            if not self.metrics.enabled:
+                self.write_records(checkpoint, model_name, pending_cids, [
+                    clean_output(output) for output in pending_outputs
+                ])
+                return
+            timer = StageTimer()
+            with timer.stage("repair"):
+                cleaned_outputs, repaired, discarded = self.clean_outputs_counted(pending_outputs)
+            with timer.stage("write"):
+                self.write_records(checkpoint, model_name, pending_cids, cleaned_outputs)
+            self.metrics.record_batch(model_name, self.task_name, {
+                "rows": len(pending_cids),
+                "generated_tokens": pending_tokens[0],
+                "repaired": repaired,
+                "discarded": discarded,
+            }, timer)
+            pending_tokens[0] = 0
+
+        for cid, token_ids in tqdm(engine.run(requests())):
+            decoded = tokenizer.decode(token_ids, skip_special_tokens=True)
+            if cid in keys:
+                fresh[keys.pop(cid)] = decoded
+            pending_cids.append(cid)
+            pending_outputs.append(decoded)
+            pending_tokens[0] += len(token_ids)
+
+            if len(pending_cids) >= self.batch_size:
+                flush()
+                pending_cids, pending_outputs = [], []
+
+        if pending_cids:
+            flush()
+
+        self.last_engine_stats = engine.stats
+        print(
+            f"⚡ Continuous batching: {engine.stats['tokens_per_sec']:.1f} tokens/sec, "
+            f"slot occupancy {engine.stats['slot_occupancy']:.1%}"
+        )
 
-        print(f"✅ Completed {model_name}")
+
+    def is_complete(self, model_name, comments):
+        if not all(os.path.exists(path) for path in self.output_paths(model_name).values()):
+            return False
+        completed = self.open_checkpoint(model_name).recover()
+        return all(cid in completed for cid, _ in comments)
 
 
     # -------------------------
     # Run All
     # -------------------------
-    def run_all(self, comments, datasetName):
+    def run_all(self, comments, datasetName, models=None):
+        """
+        models: {name: model id} (default LLM_MODELS); for the llamacpp
+        backend the ids are GGUF paths.
+        """
         self.datasetName = datasetName
-        for name, model_id in LLM_MODELS.items():
+        for name, model_id in (models or LLM_MODELS).items():
+            if self.resume and self.is_complete(name, comments):
+                print(f"⏭ {name} already complete")
+                continue
             try:
                 self.process_dataset(comments, name, model_id)
             except Exception as e:
@@ -0,0 +1,276 @@
+#------------------------------- Run metrics -------------------------------#
+# StageTimer: wall time per named stage (used by every run).
+# RunMetrics: opt-in per-batch records (stage timings, token counts, peak
+# memory, repair/discard counters) written to a JSONL file, passed to hooks
+# and summed into an optional Prometheus textfile. With no path and no
+# hooks it is disabled and the runner skips all of the bookkeeping.
+# Peak memory: CUDA peak stats are reset after every record, so a batch
+# record has the peak since the previous record (that batch, unless
+# batches overlap in the pipeline) and a run record the peak of its run.
+# On CPU ru_maxrss cannot be reset and is the process peak so far.
+
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+class StageTimer:
+    """
+    Accumulates wall time per named stage. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.calls = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                for name in self.seconds
+            }
+
+
+class FirstTokenClock:
+    """
+    Logits processor that only records when it is first called, i.e. when
+    the prefill forward pass has produced the first token's logits.
+    """
+
+    def __init__(self):
+        self.first = None
+
+    def __call__(self, input_ids, scores):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return scores
+
+
+# -------------------------
+# Measurements
+# -------------------------
+
+def generated_lengths(generated, eos_token_id):
+    """
+    Per-row generated tokens (up to and including the first EOS) of a
+    [rows, steps] tensor padded with EOS after each row finished.
+    """
+    not_eos = generated != eos_token_id
+    return torch.where(
+        not_eos.all(dim=1),
+        not_eos.shape[1],
+        (~not_eos).int().argmax(dim=1) + 1
+    )
+
+
+def peak_memory_bytes():
+    """
+    Peak allocated CUDA memory over all devices, or peak process RSS on CPU.
+    """
+    if torch.cuda.is_available():
+        return sum(
+            torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())
+        )
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory():
+    """
+    Start a new CUDA peak measurement (no-op on CPU).
+    """
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(i)
+
+
+# -------------------------
+# Per-batch metrics
+# -------------------------
+
+COUNTERS = (
+    "batches",
+    "rows",
+    "cache_hits",
+    "prompt_tokens",
+    "padding_tokens",
+    "generated_tokens",
+    "repaired",
+    "discarded",
+)
+
+PROMETHEUS_HELP = {
+    "batches": "Batches processed",
+    "rows": "Comments processed",
+    "cache_hits": "Outputs served from the output cache",
+    "prompt_tokens": "Non-padding prompt tokens",
+    "padding_tokens": "Padding tokens in prompt batches",
+    "generated_tokens": "Generated tokens",
+    "repaired": "Outputs whose JSON needed repair",
+    "discarded": "Outputs without any JSON object",
+}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RunMetrics:
+
+    def __init__(self, path=None, prometheus_path=None, hooks=None, prefix="freellm"):
+        """
+        path: metrics JSONL, appended to (one record per batch and per run).
+        prometheus_path: textfile rewritten after every run (node_exporter
+        textfile collector format).
+        hooks: callables receiving every record dict.
+        """
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.hooks = list(hooks or [])
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # (model, task) -> counter totals / stage seconds, for Prometheus
+        self.totals = {}
+        self.stage_totals = {}
+        # (model, task) -> peak memory of the current run; process peak
+        self.run_peaks = {}
+        self.process_peak = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path or self.prometheus_path or self.hooks)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, record):
+        with self._lock:
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            for hook in self.hooks:
+                hook(record)
+
+    def take_peak_memory(self, key):
+        """
+        Peak memory since the last call, folded into the run and process
+        peaks; starts the next measurement.
+        """
+        with self._lock:
+            peak = peak_memory_bytes()
+            reset_peak_memory()
+            self.run_peaks[key] = max(self.run_peaks.get(key, 0), peak)
+            self.process_peak = max(self.process_peak, peak)
+        return peak
+
+    def start_run(self, model, task):
+        """
+        Call before loading the model: the run's peak starts here.
+        """
+        with self._lock:
+            self.process_peak = max(self.process_peak, peak_memory_bytes())
+            reset_peak_memory()
+            self.run_peaks.pop((model, task), None)
+
+    def record_batch(self, model, task, counts, timer):
+        """
+        counts: subset of COUNTERS for one batch; timer: its StageTimer.
+        """
+        seconds = {name: stats["seconds"] for name, stats in timer.summary().items()}
+        key = (model, task)
+        peak = self.take_peak_memory(key)
+
+        with self._lock:
+            totals = self.totals.setdefault(key, dict.fromkeys(COUNTERS, 0))
+            totals["batches"] += 1
+            for name, value in counts.items():
+                totals[name] += value
+            stages = self.stage_totals.setdefault(key, {})
+            for name, value in seconds.items():
+                stages[name] = stages.get(name, 0.0) + value
+
+        self.emit({
+            "event": "batch",
+            "time": time.time(),
+            "model": model,
+            "task": task,
+            **counts,
+            "seconds": seconds,
+            "peak_memory_bytes": peak,
+        })
+
+    def finish_run(self, model, task, **fields):
+        """
+        Emit the run summary and rewrite the Prometheus textfile.
+        """
+        self.take_peak_memory((model, task))
+        with self._lock:
+            totals = dict(self.totals.get((model, task), dict.fromkeys(COUNTERS, 0)))
+            peak = self.run_peaks.pop((model, task))
+
+        self.emit({
+            "event": "run",
+            "time": time.time(),
+            "model": model,
+            "task": task,
+            **totals,
+            **fields,
+            "peak_memory_bytes": peak,
+        })
+
+        if self.prometheus_path:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        with self._lock:
+            totals = {key: dict(values) for key, values in self.totals.items()}
+            stages = {key: dict(values) for key, values in self.stage_totals.items()}
+            process_peak = max(self.process_peak, peak_memory_bytes())
+
+        lines = []
+        for name in COUNTERS:
+            metric = f"{self.prefix}_{name}_total"
+            lines.append(f"# HELP {metric} {PROMETHEUS_HELP[name]}")
+            lines.append(f"# TYPE {metric} counter")
+            for (model, task), values in sorted(totals.items()):
+                lines.append(f'{metric}{{model="{_label(model)}",task="{_label(task)}"}} {values[name]}')
+
+        metric = f"{self.prefix}_stage_seconds_total"
+        lines.append(f"# HELP {metric} Wall time per runner stage")
+        lines.append(f"# TYPE {metric} counter")
+        for (model, task), values in sorted(stages.items()):
+            for stage, seconds in sorted(values.items()):
+                lines.append(f'{metric}{{model="{_label(model)}",task="{_label(task)}",stage="{stage}"}} {seconds:.6f}')
+
+        metric = f"{self.prefix}_peak_memory_bytes"
+        lines.append(f"# HELP {metric} Peak CUDA memory (or CPU RSS) of the runner process")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {process_peak}")
+
+        # Written aside and renamed, so the collector never reads half a file
+        tmp = self.prometheus_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prometheus_path)
@@ -0,0 +1,119 @@
+#------------------------------- Model load cache / warm start -------------------------------#
+# Loading a hub checkpoint means reading fp16 shards and quantizing them to
+# nf4 on every run. The first (cold) load saves the already-quantized model
+# and its tokenizer as safetensors under cache_dir; later (warm) loads read
+# that directory directly (safetensors is mmapped, nothing is re-quantized).
+# Optionally a few loaded (model, tokenizer) pairs stay resident in the
+# process, so repeated run_all calls skip loading entirely.
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+from collections import OrderedDict
+
+COMPLETE_MARKER = "load_cache.json"
+
+# (model_id, settings, placement) -> (model, tokenizer); shared by every runner
+_RESIDENT = OrderedDict()
+
+
+def cache_key(model_id, settings):
+    digest = hashlib.sha256(
+        json.dumps([model_id, settings], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:12]
+    name = re.sub(r"[^A-Za-z0-9._-]+", "--", model_id).strip("-")
+    return f"{name}__{digest}"
+
+
+def clear_resident():
+    _RESIDENT.clear()
+
+
+class ModelLoadCache:
+
+    def __init__(self, cache_dir=None, keep_resident=0):
+        """
+        cache_dir: where quantized checkpoints are saved (None: no disk cache).
+        keep_resident: loaded models kept in this process (0: none).
+        """
+        self.cache_dir = cache_dir
+        self.keep_resident = keep_resident
+        self.last_load = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cached_path(self, model_id, settings):
+        if not self.cache_dir:
+            return None
+        path = os.path.join(self.cache_dir, cache_key(model_id, settings))
+        if os.path.exists(os.path.join(path, COMPLETE_MARKER)):
+            return path
+        return None
+
+    def load(self, model_id, settings, load_pretrained, placement=None):
+        """
+        load_pretrained(source) -> (model, tokenizer), where source is the
+        hub id or a cached directory. settings: everything that changes the
+        loaded weights (device kind, quantization), part of the cache key.
+        placement: where the model lives (e.g. "cuda:1"); resident models
+        are only reused for the same placement.
+        Returns (model, tokenizer); timing is left in self.last_load.
+        """
+        key = (model_id, json.dumps(settings, sort_keys=True, default=str), placement)
+        start = time.perf_counter()
+
+        if key in _RESIDENT:
+            _RESIDENT.move_to_end(key)
+            model, tokenizer = _RESIDENT[key]
+            self.last_load = {"source": "resident", "seconds": time.perf_counter() - start}
+        else:
+            path = self.cached_path(model_id, settings)
+            if path:
+                model, tokenizer = load_pretrained(path)
+                self.last_load = {"source": "warm", "seconds": time.perf_counter() - start}
+            else:
+                model, tokenizer = load_pretrained(model_id)
+                self.last_load = {"source": "cold", "seconds": time.perf_counter() - start}
+
+            if self.keep_resident:
+                _RESIDENT[key] = (model, tokenizer)
+                while len(_RESIDENT) > self.keep_resident:
+                    _RESIDENT.popitem(last=False)
+
+        self.last_load["model_id"] = model_id
+        print(f"⏱ Loaded {model_id} ({self.last_load['source']}) in {self.last_load['seconds']:.1f}s")
+
+        if self.last_load["source"] == "cold" and self.cache_dir:
+            self.last_load["save_seconds"] = self.save(model_id, settings, model, tokenizer)
+        return model, tokenizer
+
+    def save(self, model_id, settings, model, tokenizer):
+        """
+        Write model + tokenizer to the cache; the marker file is written
+        last, so an interrupted save is never loaded.
+        """
+        start = time.perf_counter()
+        path = os.path.join(self.cache_dir, cache_key(model_id, settings))
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+
+        try:
+            model.save_pretrained(tmp, safe_serialization=True)
+            tokenizer.save_pretrained(tmp)
+        except Exception as e:
+            # e.g. a bitsandbytes build without 4-bit serialization
+            shutil.rmtree(tmp, ignore_errors=True)
+            print(f"⚠ Not caching {model_id}: {e}")
+            return 0.0
+
+        with open(os.path.join(tmp, COMPLETE_MARKER), "w") as f:
+            json.dump({"model_id": model_id, "settings": settings}, f, default=str)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        seconds = time.perf_counter() - start
+        print(f"💾 Cached {model_id} at {path} ({seconds:.1f}s)")
+        return seconds
@@ -13,3 +13,21 @@ LLM_MODELS = {
     "qwen_14b": "Qwen/Qwen2.5-14B-Instruct",               # Updated to Qwen2
     "gemma_7b": "google/gemma-2-9b-it"                  # Updated to Gemma 2
 }
+
+# Sequence classifiers for classifier_runner.py; keys match
+# output_parser.GBV_CLASSIFIER_LABEL_MAP
+CLASSIFIER_MODELS = {
+    "hate_explain": "Hate-speech-CNERG/bert-base-uncased-hatexplain",
+    "cardiff_hate": "cardiffnlp/twitter-roberta-base-hate",
+    "sexism_edos_tum": "tum-nlp/bertweet-sexism",
+    "sexism_edos_ltu": "NLP-LTU/bertweet-large-sexism-detector"
+}
+
+# Draft models for speculative decoding (UnifiedLLMRunner(speculative="draft")),
+# keyed like LLM_MODELS; each shares its target's tokenizer. Models without
+# an entry fall back to prompt-lookup drafting.
+DRAFT_MODELS = {
+    "llama3_8b": "meta-llama/Llama-3.2-1B-Instruct",
+    "qwen_14b": "Qwen/Qwen2.5-0.5B-Instruct",
+    "gemma_7b": "google/gemma-2-2b-it"
+}
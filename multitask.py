@@ -0,0 +1,83 @@
+#------------------------------- Multi-task single pass -------------------------------#
+# UnifiedLLMRunner(task=["appearance", "gbv"]) asks for every task in one
+# prompt (prompts.build_prompt_multitask) and one generation:
+#   {"appearance": {...appearance schema...}, "gbv": {...gbv schema...}}
+# so each model is loaded once and each comment is prefilled once. (Both
+# task prompts end with the comment, so sharing the comment's KV cache
+# between them would need reordered prompts; the combined schema keeps one
+# prompt per comment instead.)
+# TaskSplitCheckpoint turns every combined record into one record per task
+# and writes it to that task's usual results file
+# ({model}_{task}_results_{dataset}.jsonl), which parse_appearance_output_file
+# and parse_gbv_output_file read unchanged.
+
+import json
+
+TASKS = ("appearance", "gbv")
+
+
+def normalize_tasks(task):
+    """
+    "appearance" | "gbv" | a list of them -> tuple in TASKS order.
+    """
+    tasks = [task] if isinstance(task, str) else list(task)
+    if not tasks or any(t not in TASKS for t in tasks):
+        raise ValueError(f"Task must be one of {TASKS} or a list of them")
+    return tuple(t for t in TASKS if t in tasks)
+
+
+def split_output(text, tasks):
+    """
+    {task: raw_output} for one combined output. A task whose object is
+    missing (or an output that is not a JSON object) gets the whole text,
+    so the parsers' fallbacks still see it.
+    """
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        parsed = None
+
+    outputs = {}
+    for task in tasks:
+        part = parsed.get(task) if isinstance(parsed, dict) else None
+        outputs[task] = json.dumps(part, ensure_ascii=False) if isinstance(part, dict) else text
+    return outputs
+
+
+class TaskSplitCheckpoint:
+    """
+    ResultsCheckpoint interface over one ResultsCheckpoint per task.
+    """
+
+    def __init__(self, checkpoints):
+        """
+        checkpoints: {task: ResultsCheckpoint}.
+        """
+        self.checkpoints = checkpoints
+        self.tasks = tuple(checkpoints)
+        # Per task cids already written (after a crash between two task
+        # appends), skipped so no file gets a cid twice
+        self.completed = {task: set() for task in self.tasks}
+
+    def reset(self):
+        for task, checkpoint in self.checkpoints.items():
+            checkpoint.reset()
+            self.completed[task] = set()
+
+    def recover(self):
+        """
+        cids written for every task.
+        """
+        for task, checkpoint in self.checkpoints.items():
+            self.completed[task] = checkpoint.recover()
+        return set.intersection(*self.completed.values())
+
+    def append(self, records):
+        parts = [split_output(record["raw_output"], self.tasks) for record in records]
+        for task, checkpoint in self.checkpoints.items():
+            done = self.completed[task]
+            checkpoint.append([
+                dict(record, raw_output=part[task])
+                for record, part in zip(records, parts)
+                if record["cid"] not in done
+            ])
@@ -0,0 +1,154 @@
+#------------------------------- Persistent prompt -> output cache -------------------------------#
+# Content-addressed: the key is a hash of (model_id, rendered chat-templated
+# prompt, generation settings), so identical prompts are shared across runs
+# and datasets. Stored in SQLite with size-based LRU eviction; the stored
+# byte total is tracked in memory so puts only scan the table when the cap
+# is exceeded.
+
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class OutputCache:
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # Several runner processes may share one cache file
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            " key TEXT PRIMARY KEY,"
+            " output TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)"
+        )
+        self._conn.commit()
+
+        # Running total of stored bytes, kept up to date by put_many / _evict
+        self.total_bytes = self._stored_bytes()
+
+    def _stored_bytes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_id, prompt, generation_kwargs):
+        payload = json.dumps(
+            [model_id, prompt, generation_kwargs],
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        {key: output} for the keys present; bumps their LRU timestamp.
+        """
+        if not keys:
+            return {}
+
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = self._conn.execute(
+                    f"SELECT key, output FROM outputs WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE outputs SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+
+        return found
+
+    def put_many(self, items):
+        """
+        items: {key: output}. Evicts least recently used entries when the
+        total stored size exceeds max_bytes.
+        """
+        if not items:
+            return
+
+        now = time.time()
+        rows = [
+            (key, output, len(output.encode("utf-8")), now)
+            for key, output in items.items()
+        ]
+        keys = list(items)
+        with self._lock:
+            # Replaced entries give their old size back
+            replaced = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                replaced += self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM outputs WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchone()[0]
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO outputs (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.total_bytes += sum(row[2] for row in rows) - replaced
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Other processes may share the file: resync before deleting
+        total = self.total_bytes = self._stored_bytes()
+        if total <= self.max_bytes:
+            return
+
+        doomed = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM outputs ORDER BY last_used ASC"
+        ):
+            doomed.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        self._conn.executemany("DELETE FROM outputs WHERE key = ?", doomed)
+        self.evictions += len(doomed)
+        self.total_bytes = total
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outputs"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
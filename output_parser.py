@@ -4,6 +4,8 @@ import re
 import csv
 from typing import Dict, Any
 
+from json_scanner import extract_json_span, repair_json_object, load_json_object
+
 GBV_CLASSIFIER_LABEL_MAP = {
     # Hate-speech-CNERG/bert-base-uncased-hatexplain
     # 0 = hate speech, 1 = normal, 2 = offensive
@@ -36,70 +38,41 @@ GBV_CLASSIFIER_LABEL_MAP = {
 }
 
 
+def score_label_map(field: str) -> dict:
+    """
+    Raw label index -> label for UnifiedLLMRunner(mode="score") outputs of
+    one scored field, from label_scoring.SCORE_FIELDS[field]["labels"]
+    ("true" / "false" as booleans).
+    """
+    # Imported here: label_scoring pulls in torch, plain parsing does not need it
+    from label_scoring import SCORE_FIELDS
+
+    if field not in SCORE_FIELDS:
+        raise ValueError(f"Not a scored field: {field}")
+    return {
+        index: {"true": True, "false": False}.get(label, label)
+        for index, label in enumerate(SCORE_FIELDS[field]["labels"])
+    }
+
+
 ###-  Strip markdown fences, Extract the FULL outermost JSON block -###
 def extract_json_block(text: str) -> str:
     """
     Extract full JSON block from LLM output.
-    Handles markdown fences and multi-line JSON.
+    Handles markdown fences and multi-line JSON; a block that never
+    closes runs to the end of the text (repair_json closes it).
     """
-
-    if not text:
-        return ""
-
-    # Remove markdown fences if present
-    text = text.strip()
-    text = re.sub(r"^```json", "", text, flags=re.IGNORECASE).strip()
-    text = re.sub(r"^```", "", text).strip()
-    text = re.sub(r"```$", "", text).strip()
-
-    # Find first { and last }
-    start = text.find("{")
-    end = text.rfind("}")
-
-    if start != -1 and end != -1 and end > start:
-        return text[start:end+1]
-
-    return ""
+    return extract_json_span(text)
 
 def repair_json(text: str) -> str:
     """
     Attempt minimal repair for common LLM JSON errors.
+    See json_scanner for what is repaired.
     """
-    if not text:
-        return ""
-
-    # Replace single quotes
-    text = text.replace("'", '"')
-
-    # Fix lowercase booleans accidentally quoted
-    text = text.replace('"true"', 'true')
-    text = text.replace('"false"', 'false')
-
-    # If JSON missing closing brace
-    if text.count("{") > text.count("}"):
-        text += "}"
-
-    return text
+    return repair_json_object(text)
 
 def safe_json_load(text: str) -> Dict[str, Any]:
-    if not text:
-        return {}
-
-    text = repair_json(text)
-
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        # Try to close common truncation
-        if text.count("{") > text.count("}"):
-            text += "}"
-        if text.count("[") > text.count("]"):
-            text += "]"
-
-        try:
-            return json.loads(text)
-        except:
-            return {}
+    return load_json_object(text)
 
 def fallback_boolean_detection(text: str) -> bool:
     """
@@ -136,6 +109,51 @@ def infer_sub_category_from_reason(reason: str) -> str:
     return ""
 
 
+APPEARANCE_COLUMNS = [
+    "comment_id",
+    "comment",
+    "contains_appearance",
+    "sub_category",
+    "appearance_valence",
+    "segments",
+    "reason"
+]
+
+
+def appearance_row(record: Dict[str, Any], original_comments: Dict[str, str]) -> list:
+    cid = record["cid"]
+    raw_output = record["raw_output"]
+
+    parsed = load_json_object(raw_output)
+
+    if not parsed:
+        contains = fallback_boolean_detection(raw_output)
+        sub_category = ""
+        valence = ""
+        segments = []
+        reason = ""
+    else:
+        contains = parsed.get("contains_appearance", "")
+        sub_category = parsed.get("appearance_sub_category", "")
+        valence = parsed.get("appearance_valence", "")
+        segments = parsed.get("segments", [])
+        reason = parsed.get("reason", "")
+
+        # If model didn't provide sub_category but reason exists
+        if not sub_category and reason:
+            sub_category = infer_sub_category_from_reason(reason)
+
+    return [
+        cid,
+        original_comments.get(cid, ""),
+        contains,
+        sub_category,
+        valence,
+        "; ".join(segments) if isinstance(segments, list) else segments,
+        reason
+    ]
+
+
 def parse_appearance_output_file(input_jsonl: str,
                                   original_comments: Dict[str, str],
                                   output_csv: str):
@@ -146,55 +164,44 @@ def parse_appearance_output_file(input_jsonl: str,
          open(output_csv, "w", newline="", encoding="utf-8") as outfile:
 
         writer = csv.writer(outfile)
-        writer.writerow([
-            "comment_id",
-            "comment",
-            "contains_appearance",
-            "sub_category",
-            "appearance_valence",
-            "segments",
-            "reason"
-        ])
-
-        for line in infile:
-            record = json.loads(line)
-
-            cid = record["cid"]
-            raw_output = record["raw_output"]
-
-            json_block = extract_json_block(raw_output)
-            parsed = safe_json_load(json_block)
-
-            if not parsed:
-                contains = fallback_boolean_detection(raw_output)
-                sub_category = ""
-                valence = ""
-                segments = []
-                reason = ""
-            else:
-                contains = parsed.get("contains_appearance", "")
-                sub_category = parsed.get("appearance_sub_category", "")
-                valence = parsed.get("appearance_valence", "")
-                segments = parsed.get("segments", [])
-                reason = parsed.get("reason", "")
-
-                # If model didn't provide sub_category but reason exists
-                if not sub_category and reason:
-                    sub_category = infer_sub_category_from_reason(reason)
-
-            writer.writerow([
-                cid,
-                original_comments.get(cid, ""),
-                contains,
-                sub_category,
-                valence,
-                "; ".join(segments) if isinstance(segments, list) else segments,
-                reason
-            ])
+        writer.writerow(APPEARANCE_COLUMNS)
+        writer.writerows(iter_rows("appearance", infile, original_comments))
 
     print(f"✅ Appearance parsed file saved to {output_csv}")
 
 ###-- New function for GBV parsing with more fields --###
+GBV_CLASSIFIER_COLUMNS = [
+    "comment_id",
+    "comment",
+    "contains_gbv",
+    "gbv_category",
+    "raw_label",
+    "confidence"
+]
+
+
+def gbv_classifier_row(record: Dict[str, Any],
+                       original_comments: dict,
+                       label_map: dict) -> list:
+    cid = record.get("cid")
+    raw_label = record.get("label")
+    confidence = record.get("confidence")
+
+    mapping = label_map.get(raw_label, {
+        "contains_gbv": "",
+        "category": "unknown"
+    })
+
+    return [
+        cid,
+        original_comments.get(cid, ""),
+        mapping["contains_gbv"],
+        mapping["category"],
+        raw_label,
+        confidence
+    ]
+
+
 def parse_gbv_classifier_output_file(input_jsonl: str,
                                      original_comments: dict,
                                      output_csv: str,
@@ -206,49 +213,64 @@ def parse_gbv_classifier_output_file(input_jsonl: str,
 
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
 
-    label_map = GBV_CLASSIFIER_LABEL_MAP.get(model_name, {})
-
     with open(input_jsonl, "r") as infile, \
          open(output_csv, "w", newline="", encoding="utf-8") as outfile:
 
         writer = csv.writer(outfile)
-
-        writer.writerow([
-            "comment_id",
-            "comment",
-            "contains_gbv",
-            "gbv_category",
-            "raw_label",
-            "confidence"
-        ])
-
-        for line in infile:
-            record = json.loads(line)
-
-            cid = record.get("cid")
-            raw_label = record.get("label")
-            confidence = record.get("confidence")
-
-            mapping = label_map.get(raw_label, {
-                "contains_gbv": "",
-                "category": "unknown"
-            })
-
-            contains_gbv = mapping["contains_gbv"]
-            category = mapping["category"]
-
-            writer.writerow([
-                cid,
-                original_comments.get(cid, ""),
-                contains_gbv,
-                category,
-                raw_label,
-                confidence
-            ])
+        writer.writerow(GBV_CLASSIFIER_COLUMNS)
+        writer.writerows(iter_rows("gbv_classifier", infile, original_comments, model_name))
 
     print(f"✅ Parsed classifier output saved to {output_csv}")
 
 
+###-- Label-scoring outputs (UnifiedLLMRunner(mode="score")) --###
+SCORE_COLUMNS = [
+    "comment_id",
+    "comment",
+    "field",
+    "label",
+    "raw_label",
+    "confidence"
+]
+
+
+def score_row(record: Dict[str, Any],
+              original_comments: dict,
+              field: str,
+              label_map: dict) -> list:
+    cid = record.get("cid")
+    raw_label = record.get("label")
+
+    return [
+        cid,
+        original_comments.get(cid, ""),
+        field,
+        label_map.get(raw_label, ""),
+        raw_label,
+        record.get("confidence")
+    ]
+
+
+def parse_score_output_file(input_jsonl: str,
+                            original_comments: dict,
+                            output_csv: str,
+                            field: str):
+    """
+    Parse {cid, label, confidence} records of one scored field.
+    """
+
+    os.makedirs(os.path.dirname(output_csv), exist_ok=True)
+
+    with open(input_jsonl, "r") as infile, \
+         open(output_csv, "w", newline="", encoding="utf-8") as outfile:
+
+        writer = csv.writer(outfile)
+        writer.writerow(SCORE_COLUMNS)
+        writer.writerows(iter_rows("score", infile, original_comments, field))
+
+    print(f"✅ Parsed {field} scores saved to {output_csv}")
+
+
 ### -- Improved fallback function for GBV boolean detection --###
 def fallback_gbv_boolean_detection(text: str):
     """
@@ -278,17 +300,110 @@ def fallback_gbv_boolean_detection(text: str):
     return ""
 
 
-def parse_gbv_output_file(input_jsonl: str,
-                          original_comments: Dict[str, str],
-                          output_csv: str):
+GBV_COLUMNS = [
+    "comment_id",
+    "comment",
+    "contains_gbv",
+    "gbv_primary_category",
+    "gbv_secondary_categories",
+    "target",
+    "segments",
+    "reason"
+]
+
+
+def gbv_row(record: Dict[str, Any], original_comments: Dict[str, str]) -> list:
     """
-    Parse outputs from LLM-based GBV detection.
     Robust to:
     - key drift (secondary vs subcategories)
     - target vs target_group
     - truncated JSON
     - non-list segments
     """
+    cid = record.get("cid")
+    raw_output = record.get("raw_output", "")
+
+    parsed = load_json_object(raw_output)
+
+    # ------------------------
+    # CASE 1: JSON FAILED
+    # ------------------------
+    if not parsed:
+        contains = fallback_gbv_boolean_detection(raw_output)
+        primary = ""
+        secondary = []
+        target = ""
+        segments = []
+        reason = ""
+
+    # ------------------------
+    # CASE 2: JSON PARSED
+    # ------------------------
+    else:
+        contains = parsed.get("contains_gbv", "")
+
+        # Robust key handling
+        primary = (
+            parsed.get("gbv_primary_category")
+            or parsed.get("primary_category")
+            or ""
+        )
+
+        secondary = (
+            parsed.get("gbv_secondary_categories")
+            or parsed.get("gbv_subcategories")
+            or parsed.get("secondary_categories")
+            or []
+        )
+
+        target = (
+            parsed.get("target")
+            or parsed.get("target_group")
+            or ""
+        )
+
+        segments = parsed.get("segments", [])
+        reason = parsed.get("reason", "")
+
+        # Normalize list fields safely
+        if isinstance(secondary, str):
+            secondary = [secondary]
+
+        if not isinstance(secondary, list):
+            secondary = []
+
+        if isinstance(segments, str):
+            segments = [segments]
+
+        if not isinstance(segments, list):
+            segments = []
+
+        # If model says contains_gbv = False
+        # force structural consistency
+        if contains is False:
+            primary = ""
+            secondary = []
+            target = ""
+            segments = []
+
+    return [
+        cid,
+        original_comments.get(cid, ""),
+        contains,
+        primary,
+        "; ".join(secondary),
+        target,
+        "; ".join(segments),
+        reason
+    ]
+
+
+def parse_gbv_output_file(input_jsonl: str,
+                          original_comments: Dict[str, str],
+                          output_csv: str):
+    """
+    Parse outputs from LLM-based GBV detection.
+    """
 
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
 
@@ -296,97 +411,40 @@ def parse_gbv_output_file(input_jsonl: str,
          open(output_csv, "w", newline="", encoding="utf-8") as outfile:
 
         writer = csv.writer(outfile)
+        writer.writerow(GBV_COLUMNS)
+        writer.writerows(iter_rows("gbv", infile, original_comments))
+
+    print(f"✅ GBV parsed file saved to {output_csv}")
+
+
+###-- Row generators shared by the serial and parallel parsers --###
+PARSE_COLUMNS = {
+    "appearance": APPEARANCE_COLUMNS,
+    "gbv": GBV_COLUMNS,
+    "gbv_classifier": GBV_CLASSIFIER_COLUMNS,
+    "score": SCORE_COLUMNS,
+}
+
 
-        writer.writerow([
-            "comment_id",
-            "comment",
-            "contains_gbv",
-            "gbv_primary_category",
-            "gbv_secondary_categories",
-            "target",
-            "segments",
-            "reason"
-        ])
-
-        for line in infile:
-            record = json.loads(line)
-
-            cid = record.get("cid")
-            raw_output = record.get("raw_output", "")
-
-            json_block = extract_json_block(raw_output)
-            parsed = safe_json_load(json_block)
-
-            # ------------------------
-            # CASE 1: JSON FAILED
-            # ------------------------
-            if not parsed:
-                contains = fallback_gbv_boolean_detection(raw_output)
-                primary = ""
-                secondary = []
-                target = ""
-                segments = []
-                reason = ""
-
-            # ------------------------
-            # CASE 2: JSON PARSED
-            # ------------------------
-            else:
-                contains = parsed.get("contains_gbv", "")
-
-                # Robust key handling
-                primary = (
-                    parsed.get("gbv_primary_category")
-                    or parsed.get("primary_category")
-                    or ""
-                )
-
-                secondary = (
-                    parsed.get("gbv_secondary_categories")
-                    or parsed.get("gbv_subcategories")
-                    or parsed.get("secondary_categories")
-                    or []
-                )
-
-                target = (
-                    parsed.get("target")
-                    or parsed.get("target_group")
-                    or ""
-                )
-
-                segments = parsed.get("segments", [])
-                reason = parsed.get("reason", "")
-
-                # Normalize list fields safely
-                if isinstance(secondary, str):
-                    secondary = [secondary]
-
-                if not isinstance(secondary, list):
-                    secondary = []
-
-                if isinstance(segments, str):
-                    segments = [segments]
-
-                if not isinstance(segments, list):
-                    segments = []
-
-                # If model says contains_gbv = False
-                # force structural consistency
-                if contains is False:
-                    primary = ""
-                    secondary = []
-                    target = ""
-                    segments = []
-
-            writer.writerow([
-                cid,
-                original_comments.get(cid, ""),
-                contains,
-                primary,
-                "; ".join(secondary),
-                target,
-                "; ".join(segments),
-                reason
-            ])
-
-    print(f"✅ GBV parsed file saved to {output_csv}")
\ No newline at end of file
+def iter_rows(task: str, lines, original_comments, model_name: str = None):
+    """
+    Yield parsed rows (in input order) for an iterable of JSONL lines.
+    model_name: the classifier model ("gbv_classifier") or the scored
+    field ("score").
+    """
+    if task == "appearance":
+        for line in lines:
+            yield appearance_row(json.loads(line), original_comments)
+    elif task == "gbv":
+        for line in lines:
+            yield gbv_row(json.loads(line), original_comments)
+    elif task == "gbv_classifier":
+        label_map = GBV_CLASSIFIER_LABEL_MAP.get(model_name, {})
+        for line in lines:
+            yield gbv_classifier_row(json.loads(line), original_comments, label_map)
+    elif task == "score":
+        label_map = score_label_map(model_name)
+        for line in lines:
+            yield score_row(json.loads(line), original_comments, model_name, label_map)
+    else:
+        raise ValueError(f"Unknown parse task: {task}")
@@ -0,0 +1,196 @@
+#------------------------------- Parallel output parsing -------------------------------#
+# Spreads the per-model result JSONLs, and line-aligned byte ranges inside
+# big ones, over a process pool. Chunks come back in submission order and
+# are written in that order, so every CSV is byte-identical to the serial
+# parse_*_output_file output. Optionally also writes a Parquet file per
+# input with typed columns (pyarrow, imported only when asked for).
+
+import os
+import csv
+import multiprocessing as mp
+
+from output_parser import PARSE_COLUMNS, iter_rows
+from comment_stream import CommentStore
+
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# Parquet column types; everything else is a string column
+BOOL_COLUMNS = {"contains_appearance", "contains_gbv"}
+INT_COLUMNS = {"raw_label"}
+FLOAT_COLUMNS = {"confidence"}
+
+_comments = None
+
+
+# -------------------------
+# Chunking
+# -------------------------
+
+def chunk_ranges(path, chunk_bytes=CHUNK_BYTES):
+    """
+    [(start, end)] byte ranges covering the file, each ending on a line
+    boundary.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        # Still yields a (header-only) output file
+        return [(0, 0)]
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+# -------------------------
+# Worker
+# -------------------------
+
+def _init_worker(comments):
+    global _comments
+    # A CommentStore travels as its path; each worker opens its own connection
+    _comments = CommentStore(comments) if isinstance(comments, str) else comments
+
+
+def _parse_chunk(args):
+    task, path, start, end, model_name = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start).decode("utf-8")
+    lines = [line for line in data.split("\n") if line.strip()]
+    return list(iter_rows(task, lines, _comments, model_name))
+
+
+# -------------------------
+# Writers
+# -------------------------
+
+def _parquet_value(column, value):
+    if value == "" or value is None:
+        return None
+    if column in BOOL_COLUMNS:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ("true", "false"):
+            return str(value).lower() == "true"
+        return None
+    try:
+        if column in INT_COLUMNS:
+            return int(value)
+        if column in FLOAT_COLUMNS:
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+class ParquetRowWriter:
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as exc:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow") from exc
+
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([
+            (column,
+             pa.bool_() if column in BOOL_COLUMNS
+             else pa.int64() if column in INT_COLUMNS
+             else pa.float64() if column in FLOAT_COLUMNS
+             else pa.string())
+            for column in columns
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        arrays = {
+            column: [_parquet_value(column, row[i]) for row in rows]
+            for i, column in enumerate(self.columns)
+        }
+        self.writer.write_table(self.pa.table(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# -------------------------
+# Driver
+# -------------------------
+
+def parse_output_files(jobs, original_comments, workers=None,
+                       chunk_bytes=CHUNK_BYTES, parquet=False, csv_output=True):
+    """
+    jobs: list of dicts with "task" ("appearance", "gbv",
+    "gbv_classifier" or "score"), "input" (results JSONL), "output" (CSV
+    path) and, for classifier jobs, "model_name" (for score jobs, "field").
+    The Parquet file sits next to the
+    CSV with a .parquet suffix.
+    original_comments: {cid: text} dict or a CommentStore.
+    """
+    jobs = [job for job in jobs if os.path.exists(job["input"])]
+    if not jobs:
+        return
+
+    chunks = []
+    for number, job in enumerate(jobs):
+        for start, end in chunk_ranges(job["input"], chunk_bytes):
+            chunks.append((number, (job["task"], job["input"], start, end, job.get("model_name") or job.get("field"))))
+
+    comments = original_comments
+    if isinstance(original_comments, CommentStore):
+        comments = original_comments.path
+
+    workers = workers or min(os.cpu_count() or 1, len(chunks))
+    ctx = mp.get_context("spawn")
+
+    current = None
+    csv_file = writer = parquet_writer = None
+
+    def close_outputs():
+        if csv_file:
+            csv_file.close()
+        if parquet_writer:
+            parquet_writer.close()
+        if current is not None:
+            print(f"✅ Parsed {jobs[current]['input']} -> {os.path.splitext(jobs[current]['output'])[0]}")
+
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(comments,)) as pool:
+        results = pool.imap(_parse_chunk, [args for _, args in chunks])
+
+        for (number, _), rows in zip(chunks, results):
+            if number != current:
+                close_outputs()
+                current = number
+                job = jobs[number]
+                columns = PARSE_COLUMNS[job["task"]]
+                os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+
+                csv_file = writer = parquet_writer = None
+                if csv_output:
+                    csv_file = open(job["output"], "w", newline="", encoding="utf-8")
+                    writer = csv.writer(csv_file)
+                    writer.writerow(columns)
+                if parquet:
+                    parquet_writer = ParquetRowWriter(
+                        os.path.splitext(job["output"])[0] + ".parquet",
+                        columns
+                    )
+
+            if writer:
+                writer.writerows(rows)
+            if parquet_writer:
+                parquet_writer.write_rows(rows)
+
+        close_outputs()
@@ -0,0 +1,326 @@
+#------------------------------- Multi-device data-parallel runner -------------------------------#
+# run_all() loads one model at a time on device_map="auto". This scheduler
+# packs models (and optional replicas of each model, each on a shard of the
+# comments) onto the available devices by estimated memory footprint and
+# runs every placed job in its own worker process. Replica shards are merged
+# back into the usual per-model JSONL.
+
+import os
+import re
+import json
+import multiprocessing as mp
+import torch
+
+from model_registry import LLM_MODELS
+from llm_runner import UnifiedLLMRunner, check_device_settings
+from checkpoint import ResultsCheckpoint
+from comment_stream import ShardedComments, ExcludedComments
+
+GIB = 1024 ** 3
+
+# Bytes per parameter for each weight format (UnifiedLLMRunner.load_settings)
+BYTES_PER_PARAM = {
+    "nf4": 0.5,        # bitsandbytes 4-bit, GPUs
+    "int8": 1.0,       # CPU dynamic int8 quantization
+    "bfloat16": 2.0,
+    "float32": 4.0,
+}
+
+# Runner settings that only apply to CPU workers
+CPU_ONLY_SETTINGS = ("cpu_dtype",)
+
+# Headroom for KV cache, activations and the CUDA context
+OVERHEAD_FACTOR = 1.2
+OVERHEAD_BYTES = 1.5 * GIB
+
+
+# -------------------------
+# Footprint estimates
+# -------------------------
+
+def estimate_params(model_id):
+    """
+    Parameter count from the model name ("8B", "8x7B", "0.5B"), falling back
+    to the model config when the name has no size in it.
+    """
+    name = model_id.lower()
+
+    match = re.search(r"(\d+)x(\d+(?:\.\d+)?)b", name)
+    if match:
+        return int(match.group(1)) * float(match.group(2)) * 1e9
+
+    match = re.search(r"(\d+(?:\.\d+)?)b(?:[-_.]|$)", name)
+    if match:
+        return float(match.group(1)) * 1e9
+
+    try:
+        from transformers import AutoConfig
+        config = AutoConfig.from_pretrained(model_id)
+        hidden = config.hidden_size
+        layers = config.num_hidden_layers
+        return 12 * layers * hidden ** 2 + 2 * config.vocab_size * hidden
+    except Exception:
+        return 8e9
+
+
+def weight_format(device, cpu_dtype="float32"):
+    """
+    Weights a worker on device loads: nf4 on a GPU, cpu_dtype on the CPU.
+    """
+    return cpu_dtype if device == "cpu" else "nf4"
+
+
+def estimate_footprint(model_id, device, cpu_dtype="float32"):
+    params = estimate_params(model_id)
+    bytes_per_param = BYTES_PER_PARAM[weight_format(device, cpu_dtype)]
+    return params * bytes_per_param * OVERHEAD_FACTOR + OVERHEAD_BYTES
+
+
+def available_devices():
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def device_capacity(device):
+    if device == "cpu":
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    index = int(device.split(":")[1]) if ":" in device else 0
+    return torch.cuda.get_device_properties(index).total_memory
+
+
+# -------------------------
+# Placement
+# -------------------------
+
+def plan_waves(jobs, capacities, footprints):
+    """
+    First-fit decreasing bin packing.
+
+    jobs: list of job dicts with a "key" used to look up footprints[key][device].
+    capacities: {device: bytes}.
+    Returns a list of waves; each wave is [(job, device), ...] that fit
+    on their devices at the same time. Waves run one after another.
+    """
+    pending = sorted(
+        jobs,
+        key=lambda job: max(footprints[job["key"]].values()),
+        reverse=True
+    )
+    waves = []
+
+    while pending:
+        free = dict(capacities)
+        wave = []
+        waiting = []
+
+        for job in pending:
+            fits = [
+                device for device in free
+                if footprints[job["key"]][device] <= free[device]
+            ]
+            if not fits:
+                waiting.append(job)
+                continue
+            # Most free memory first keeps devices evenly loaded
+            device = max(fits, key=lambda d: free[d])
+            free[device] -= footprints[job["key"]][device]
+            wave.append((job, device))
+
+        if not wave:
+            names = ", ".join(job["model_name"] for job in waiting)
+            raise ValueError(f"Models do not fit on any device: {names}")
+
+        waves.append(wave)
+        pending = waiting
+
+    return waves
+
+
+# -------------------------
+# Worker
+# -------------------------
+
+def _run_job(runner_kwargs, dataset_name, job, device, comments):
+    runner = UnifiedLLMRunner(device=device, **runner_kwargs)
+    runner.datasetName = dataset_name
+    runner.process_dataset(comments, job["model_name"], job["model_id"])
+
+
+class ParallelRunner:
+
+    def __init__(self, devices=None, replicas=1, capacities=None, footprints=None,
+                 output_base=None, **runner_kwargs):
+        """
+        Comments may be a list or a re-iterable CommentStream; workers
+        receive their shard lazily either way.
+
+        devices: e.g. ["cuda:0", "cuda:1"] or ["cpu", "cpu"]; defaults to every
+        visible GPU, else one CPU "device".
+        replicas: workers per model, each generating a shard of the comments.
+        capacities / footprints: byte overrides ({device: bytes} and
+        {model_name: bytes}) for the packing estimates.
+        runner_kwargs: forwarded to UnifiedLLMRunner in each worker
+        (CPU_ONLY_SETTINGS to CPU workers only).
+        """
+        self.devices = devices or available_devices()
+        self.replicas = replicas
+        self.capacity_overrides = capacities or {}
+        self.footprint_overrides = footprints or {}
+        if output_base:
+            runner_kwargs = dict(runner_kwargs, output_base=output_base)
+        self.runner_kwargs = runner_kwargs
+
+        # Fail before any worker starts: GPU workers drop cpu_dtype, so it
+        # only has to suit the CPU workers (and needs at least one)
+        check_device_settings(
+            "cpu" if "cpu" in self.devices else self.devices[0],
+            runner_kwargs.get("cpu_dtype", "float32")
+        )
+
+        # Reuse the runner's naming and resume logic in the parent process;
+        # it never loads a model, so it is built for the CPU whatever the
+        # workers' devices
+        self.runner = UnifiedLLMRunner(device="cpu", **runner_kwargs)
+
+        # Duplicate entries ("cpu", "cpu") become separate slots
+        self.slots = [f"{device}#{i}" for i, device in enumerate(self.devices)]
+
+    def _device(self, slot):
+        return slot.split("#")[0]
+
+    def worker_kwargs(self, device):
+        if device == "cpu":
+            return self.runner_kwargs
+        return {
+            key: value for key, value in self.runner_kwargs.items()
+            if key not in CPU_ONLY_SETTINGS
+        }
+
+    # Overrides win without probing the device or the model config
+    def capacity(self, device):
+        if device in self.capacity_overrides:
+            return self.capacity_overrides[device]
+        return device_capacity(device)
+
+    def footprint(self, model_name, model_id, device):
+        if model_name in self.footprint_overrides:
+            return self.footprint_overrides[model_name]
+        cpu_dtype = self.worker_kwargs(device).get("cpu_dtype", "float32")
+        return estimate_footprint(model_id, device, cpu_dtype)
+
+    def plan(self, models):
+        jobs = []
+        for model_name, model_id in models.items():
+            for shard in range(self.replicas):
+                jobs.append({
+                    "key": model_name,
+                    "model_name": model_name,
+                    "model_id": model_id,
+                    "shard": shard,
+                })
+
+        capacities = {slot: self.capacity(self._device(slot)) for slot in self.slots}
+        footprints = {
+            model_name: {
+                slot: self.footprint(model_name, model_id, self._device(slot))
+                for slot in self.slots
+            }
+            for model_name, model_id in models.items()
+        }
+        return plan_waves(jobs, capacities, footprints)
+
+    def shard_name(self, dataset_name, shard):
+        if self.replicas == 1:
+            return dataset_name
+        return f"{dataset_name}.shard{shard}of{self.replicas}"
+
+    def merge_shards(self, model_name, dataset_name):
+        """
+        Append every replica's records to the per-model JSONL (one per
+        task) and remove the shard files.
+        """
+        for task in self.runner.tasks:
+            self.runner.datasetName = dataset_name
+            target = ResultsCheckpoint(self.runner.output_path(model_name, task))
+            if not self.runner.resume:
+                target.reset()
+
+            for shard in range(self.replicas):
+                self.runner.datasetName = self.shard_name(dataset_name, shard)
+                shard_path = self.runner.output_path(model_name, task)
+                if not os.path.exists(shard_path):
+                    continue
+
+                with open(shard_path, "r") as f:
+                    records = []
+                    for line in f:
+                        records.append(json.loads(line))
+                        if len(records) >= 1000:
+                            target.append(records)
+                            records = []
+                    target.append(records)
+
+                os.remove(shard_path)
+                if os.path.exists(shard_path + ".idx"):
+                    os.remove(shard_path + ".idx")
+
+        self.runner.datasetName = dataset_name
+
+    def run_all(self, comments, datasetName, models=None):
+        models = dict(models or LLM_MODELS)
+        self.runner.datasetName = datasetName
+
+        if self.runner.resume:
+            for model_name in list(models):
+                if self.runner.is_complete(model_name, comments):
+                    print(f"⏭ {model_name} already complete")
+                    del models[model_name]
+            if self.replicas > 1:
+                # Shards only cover what the merged file is still missing
+                remaining = {}
+                for model_name in models:
+                    done = self.runner.open_checkpoint(model_name).recover()
+                    remaining[model_name] = ExcludedComments(comments, done)
+
+        if not models:
+            return
+
+        waves = self.plan(models)
+        ctx = mp.get_context("spawn")
+
+        for number, wave in enumerate(waves, 1):
+            print(f"\n🧮 Wave {number}/{len(waves)}: " + ", ".join(
+                f"{job['model_name']}[{job['shard']}]@{self._device(slot)}" for job, slot in wave
+            ))
+
+            processes = []
+            for job, slot in wave:
+                shard_comments = comments
+                if self.replicas > 1:
+                    if self.runner.resume:
+                        shard_comments = remaining[job["model_name"]]
+                    shard_comments = ShardedComments(shard_comments, job["shard"], self.replicas)
+
+                process = ctx.Process(
+                    target=_run_job,
+                    args=(
+                        self.worker_kwargs(self._device(slot)),
+                        self.shard_name(datasetName, job["shard"]),
+                        job,
+                        self._device(slot),
+                        shard_comments,
+                    ),
+                    name=f"{job['model_name']}-{job['shard']}"
+                )
+                process.start()
+                processes.append((job, process))
+
+            for job, process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    print(f"❌ {job['model_name']}[{job['shard']}] failed (exit {process.exitcode})")
+
+        if self.replicas > 1:
+            for model_name in models:
+                self.merge_shards(model_name, datasetName)
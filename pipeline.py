@@ -0,0 +1,92 @@
+#------------------------------- Three-stage batch pipeline -------------------------------#
+# prepare (producer thread) -> generate (calling thread) -> finish (consumer thread)
+# connected by bounded queues, so the accelerator is not idle while the CPU
+# renders/tokenizes the next batch or decodes/writes the previous one.
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def _put(q, item, stop):
+    # Bounded put that gives up once the pipeline is being torn down
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(items, prepare, generate, finish, prefetch=2, timer=None):
+    """
+    Run prepare(item) -> generate(job) -> finish(job) for every item with
+    the three stages overlapped. Items are finished in input order.
+    Exceptions from any stage are re-raised in the calling thread.
+    """
+    prepared = queue.Queue(maxsize=prefetch)
+    generated = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    errors = []
+
+    def timed(name, fn, arg):
+        if timer is None:
+            return fn(arg)
+        with timer.stage(name):
+            return fn(arg)
+
+    def producer():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                if not _put(prepared, timed("prepare", prepare, item), stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(prepared, _DONE, stop)
+
+    def consumer():
+        try:
+            while True:
+                job = generated.get()
+                if job is _DONE:
+                    return
+                timed("finish", finish, job)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            # Keep draining so the generating thread never blocks forever
+            while generated.get() is not _DONE:
+                pass
+
+    producer_thread = threading.Thread(target=producer, name="pipeline-prepare", daemon=True)
+    consumer_thread = threading.Thread(target=consumer, name="pipeline-finish", daemon=True)
+    producer_thread.start()
+    consumer_thread.start()
+
+    try:
+        while not stop.is_set():
+            try:
+                job = prepared.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if job is _DONE:
+                break
+            job = timed("generate", generate, job)
+            generated.put(job)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        generated.put(_DONE)
+        consumer_thread.join()
+        stop.set()
+        producer_thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,173 @@
+#------------------------------- Shared prompt-prefix KV cache -------------------------------#
+# Every rendered prompt of a model starts with the same chat header, system
+# message and ~40-line instruction block; only the comment at the end
+# differs. The prefix is prefilled once per model and its KV cache is copied
+# into each batch, so only the per-comment suffix is prefilled per row.
+
+import time
+import torch
+from continuous_batching import cache_layers, build_cache
+
+SENTINEL = "<<<COMMENT_SLOT>>>"
+
+
+class PromptPrefixCache:
+
+    def __init__(self, model, tokenizer, prefix_ids, max_prompt_length=1024):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_ids = list(prefix_ids)
+        self.max_prompt_length = max_prompt_length
+        self.device = next(model.parameters()).device
+
+        with torch.no_grad():
+            out = self.model(
+                input_ids=torch.tensor([self.prefix_ids], device=self.device),
+                use_cache=True
+            )
+        self.layers = cache_layers(out.past_key_values)
+
+    @classmethod
+    def from_template(cls, model, tokenizer, render, margin=4, max_prompt_length=1024):
+        """
+        render(comment) -> full prompt text. The shared prefix is the text in
+        front of the comment, minus `margin` tokens so a merge across the
+        comment boundary can never leak into the cached part.
+        """
+        prompt = render(SENTINEL)
+        prefix_text = prompt[:prompt.index(SENTINEL)]
+        prefix_ids = tokenizer(prefix_text)["input_ids"]
+        prefix_ids = prefix_ids[:max(len(prefix_ids) - margin, 0)]
+        return cls(model, tokenizer, prefix_ids, max_prompt_length)
+
+    def __len__(self):
+        return len(self.prefix_ids)
+
+    def split(self, prompts):
+        """
+        Per-prompt suffix ids after the cached prefix, or None if any prompt
+        does not tokenize to the cached prefix.
+        """
+        encoded = self.tokenizer(
+            prompts,
+            truncation=True,
+            max_length=self.max_prompt_length
+        )["input_ids"]
+
+        size = len(self.prefix_ids)
+        if any(ids[:size] != self.prefix_ids or len(ids) <= size for ids in encoded):
+            return None
+        return [ids[size:] for ids in encoded]
+
+    def expanded_cache(self, batch_size):
+        return build_cache([
+            (keys.expand(batch_size, -1, -1, -1).contiguous(),
+             values.expand(batch_size, -1, -1, -1).contiguous())
+            for keys, values in self.layers
+        ])
+
+    def build_inputs(self, suffixes):
+        """
+        [prefix | left-padded suffix] ids and mask; padding sits between the
+        cached prefix and each row's suffix.
+        """
+        pad_id = self.tokenizer.pad_token_id
+        width = max(len(ids) for ids in suffixes)
+        batch_size = len(suffixes)
+
+        input_ids = torch.full((batch_size, len(self.prefix_ids) + width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+
+        input_ids[:, :len(self.prefix_ids)] = torch.tensor(self.prefix_ids)
+        attention_mask[:, :len(self.prefix_ids)] = 1
+
+        for row, ids in enumerate(suffixes):
+            input_ids[row, input_ids.shape[1] - len(ids):] = torch.tensor(ids)
+            attention_mask[row, input_ids.shape[1] - len(ids):] = 1
+
+        return input_ids.to(self.device), attention_mask.to(self.device)
+
+    def generate(self, prompts, **generate_kwargs):
+        """
+        model.generate over prompts reusing the prefix KV cache.
+        Returns only the generated token ids, or None when the prompts do
+        not share the cached prefix (caller falls back to a full prefill).
+        """
+        suffixes = self.split(prompts)
+        if suffixes is None:
+            return None
+
+        input_ids, attention_mask = self.build_inputs(suffixes)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=self.expanded_cache(len(prompts)),
+                **generate_kwargs
+            )
+
+        return outputs[:, input_ids.shape[1]:]
+
+
+# -------------------------
+# Prefill benchmark
+# -------------------------
+
+def benchmark_prefill(prefix_cache, prompts, batch_size=8, repeats=3):
+    """
+    Prefill latency per batch: full prompt vs cached prefix + suffix only.
+    """
+    model = prefix_cache.model
+    tokenizer = prefix_cache.tokenizer
+    device = prefix_cache.device
+
+    full_seconds = 0.0
+    cached_seconds = 0.0
+    batches = 0
+
+    with torch.no_grad():
+        for i in range(0, len(prompts), batch_size):
+            batch = prompts[i:i+batch_size]
+            suffixes = prefix_cache.split(batch)
+            if suffixes is None:
+                continue
+
+            enc = tokenizer(
+                batch,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=prefix_cache.max_prompt_length
+            ).to(device)
+            input_ids, attention_mask = prefix_cache.build_inputs(suffixes)
+            position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+            size = len(prefix_cache)
+
+            for _ in range(repeats):
+                start = time.perf_counter()
+                model(**enc, use_cache=True)
+                full_seconds += time.perf_counter() - start
+
+                start = time.perf_counter()
+                model(
+                    input_ids=input_ids[:, size:],
+                    attention_mask=attention_mask,
+                    position_ids=position_ids[:, size:],
+                    past_key_values=prefix_cache.expanded_cache(len(batch)),
+                    use_cache=True
+                )
+                cached_seconds += time.perf_counter() - start
+
+            batches += 1
+
+    runs = batches * repeats
+    full_ms = 1000 * full_seconds / runs if runs else 0.0
+    cached_ms = 1000 * cached_seconds / runs if runs else 0.0
+    return {
+        "prefix_tokens": len(prefix_cache),
+        "batches": batches,
+        "full_prefill_ms": full_ms,
+        "cached_prefill_ms": cached_ms,
+        "speedup": full_ms / cached_ms if cached_ms else 0.0,
+    }
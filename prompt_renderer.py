@@ -0,0 +1,209 @@
+#------------------------------- Memoized prompt rendering -------------------------------#
+# Every prompt of a model is the same chat template and instruction block
+# around one comment. PromptRenderer renders the template once (with a
+# sentinel in the comment slot) and then:
+#   - render(comment) is prefix text + comment + suffix text
+#   - encode(comments) tokenizes the fixed head / tail of the prompt once
+#     and, per comment, only the comment plus the few template lines around
+#     it (fast tokenizer batch call); input_ids are the cached head ids +
+#     comment ids + cached tail ids
+# The split points are newline positions chosen so that, on a set of probe
+# comments, the concatenated ids equal the ids of the fully rendered
+# prompt. When no split passes (e.g. a tokenizer that merges across
+# lines), or the template does not render the comment verbatim, the
+# renderer falls back to full rendering and tokenization.
+
+import time
+
+SENTINEL = "<<<COMMENT_SLOT>>>"
+
+# Comment edges that could merge with the template text around them
+PROBES = [
+    "",
+    "hello",
+    "She looks great today",
+    " leading space",
+    "trailing space ",
+    "ends with punctuation!",
+    "what?!?",
+    '"quoted"',
+    '"""',
+    "'single' it's",
+    "line one\nline two",
+    "\n",
+    "\n\nblank lines\n\n",
+    "\ttab",
+    "12345",
+    "emoji 😍🔥",
+    "RT @user: look https://t.co/abc123",
+    "ünïcödé ñ 中文 العربية",
+    "{\"contains\": true}",
+    "...",
+]
+
+
+class PromptRenderer:
+
+    def __init__(self, tokenizer, render, max_length=1024, probes=PROBES, context_lines=4):
+        """
+        render(comment) -> full prompt text (the reference rendering).
+        context_lines: how many template lines on each side of the comment
+        may be tokenized together with it.
+        """
+        self.tokenizer = tokenizer
+        self.render_full = render
+        self.max_length = max_length
+
+        prompt = render(SENTINEL)
+        self.templated = prompt.count(SENTINEL) == 1
+        if self.templated:
+            self.prefix_text, self.suffix_text = prompt.split(SENTINEL)
+            self.templated = all(
+                render(probe) == self.prefix_text + probe + self.suffix_text
+                for probe in probes
+            )
+
+        self.split = self.calibrate(probes, context_lines) if self.templated else None
+
+    @property
+    def fast(self):
+        return self.split is not None
+
+    def calibrate(self, probes, context_lines):
+        """
+        Closest (head ids, left text, right text, tail ids) split whose
+        concatenation reproduces the full tokenization of every probe.
+        """
+        tokenizer = self.tokenizer
+        full = tokenizer([self.prefix_text + p + self.suffix_text for p in probes])["input_ids"]
+
+        # Either side of a newline: pre-tokenizers differ in which token
+        # the newline joins
+        newlines = [i for i in range(len(self.prefix_text) - 1, -1, -1) if self.prefix_text[i] == "\n"]
+        lefts = [len(self.prefix_text)] + [
+            cut for i in newlines[:context_lines] for cut in (i + 1, i)
+        ]
+        newlines = [i for i, char in enumerate(self.suffix_text) if char == "\n"]
+        rights = [0] + [
+            cut for i in newlines[:context_lines] for cut in (i, i + 1)
+        ]
+        splits = sorted(
+            ((left, right) for left in lefts for right in rights),
+            key=lambda split: len(self.prefix_text) - split[0] + split[1]
+        )
+
+        for left, right in splits:
+            head = tokenizer(self.prefix_text[:left])["input_ids"]
+            tail = tokenizer(self.suffix_text[right:], add_special_tokens=False)["input_ids"]
+            left_text = self.prefix_text[left:]
+            right_text = self.suffix_text[:right]
+            middles = tokenizer(
+                [left_text + p + right_text for p in probes], add_special_tokens=False
+            )["input_ids"]
+            if all(head + middle + tail == ids for middle, ids in zip(middles, full)):
+                return head, left_text, right_text, tail
+        return None
+
+    def render(self, comment):
+        if self.templated:
+            return self.prefix_text + comment + self.suffix_text
+        return self.render_full(comment)
+
+    def render_many(self, comments):
+        return [self.render(comment) for comment in comments]
+
+    def token_ids(self, comments, tokenizer=None):
+        """
+        Truncated prompt ids per comment, as tokenizer(prompts,
+        truncation=True, max_length=max_length) returns them.
+        """
+        tokenizer = tokenizer or self.tokenizer
+        if self.split is None:
+            return tokenizer(
+                self.render_many(comments), truncation=True, max_length=self.max_length
+            )["input_ids"]
+
+        head, left_text, right_text, tail = self.split
+        middles = tokenizer(
+            [left_text + comment + right_text for comment in comments], add_special_tokens=False
+        )["input_ids"]
+        ids = [head + middle + tail for middle in middles]
+
+        # Over-long prompts: the tokenizer's own truncation (side, special tokens)
+        long_rows = [row for row, row_ids in enumerate(ids) if len(row_ids) > self.max_length]
+        if long_rows:
+            truncated = tokenizer(
+                [self.render(comments[row]) for row in long_rows],
+                truncation=True,
+                max_length=self.max_length
+            )["input_ids"]
+            for row, row_ids in zip(long_rows, truncated):
+                ids[row] = row_ids
+        return ids
+
+    def encode(self, comments, tokenizer=None):
+        """
+        Padded input_ids / attention_mask tensors for the comments' prompts.
+        """
+        tokenizer = tokenizer or self.tokenizer
+        if self.split is None:
+            return tokenizer(
+                self.render_many(comments),
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=self.max_length
+            )
+        return tokenizer.pad(
+            {"input_ids": self.token_ids(comments, tokenizer)}, return_tensors="pt"
+        )
+
+    def lengths(self, comments):
+        return [len(ids) for ids in self.token_ids(comments)]
+
+
+# -------------------------
+# Equality check / benchmark
+# -------------------------
+
+def compare_with_full(renderer, comments, batch_size=16):
+    """
+    Full render + tokenize per batch (the reference path) vs the renderer's
+    encode(). Reports token-for-token equality and the speedup.
+    """
+    tokenizer = renderer.tokenizer
+    full_seconds = fast_seconds = 0.0
+    mismatches = 0
+
+    for i in range(0, len(comments), batch_size):
+        batch = comments[i:i+batch_size]
+
+        start = time.perf_counter()
+        full = tokenizer(
+            [renderer.render_full(comment) for comment in batch],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=renderer.max_length
+        )
+        full_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast = renderer.encode(batch)
+        fast_seconds += time.perf_counter() - start
+
+        if full["input_ids"].shape != fast["input_ids"].shape:
+            mismatches += len(batch)
+        else:
+            differs = (full["input_ids"] != fast["input_ids"]) | (full["attention_mask"] != fast["attention_mask"])
+            mismatches += int(differs.any(dim=1).sum())
+
+    return {
+        "comments": len(comments),
+        "fast_path": renderer.fast,
+        "full_seconds": full_seconds,
+        "memoized_seconds": fast_seconds,
+        "speedup": full_seconds / fast_seconds if fast_seconds else 0.0,
+        "identical": mismatches == 0,
+        "mismatches": mismatches,
+    }
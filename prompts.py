@@ -47,3 +47,141 @@ def build_prompt_appearance(comment: str) -> str:
     Text:
     \"\"\"{comment}\"\"\"
     """
+
+
+###--  GBV prompt; categories match the constrained-decoding schema --###
+def build_prompt_gbv(comment: str) -> str:
+    return f"""
+    You are an information extraction system.
+
+    Task:
+    Detect gender-based violence (GBV) in the text.
+
+    Rules:
+    - If GBV is detected (contains_gbv = true),
+    you MUST assign exactly ONE gbv_primary_category
+    and a target.
+    - gbv_secondary_categories lists any further categories that apply
+    (possibly empty).
+    - If GBV is NOT detected (contains_gbv = false),
+    gbv_primary_category MUST be null,
+    gbv_secondary_categories MUST be an empty list,
+    target MUST be null,
+    and segments MUST be an empty list.
+
+    Definition:
+    Gender-based violence refers to content that attacks, threatens,
+    degrades or harasses a person because of their gender, including:
+    - Misogynistic or sexist insults and stereotypes
+    - Sexual harassment or objectification
+    - Threats of physical or sexual violence
+    - Slurs and dehumanizing language
+    - Body shaming
+
+    Output format (STRICT JSON ONLY):
+    {{
+    "contains_gbv": true or false,
+    "gbv_primary_category":
+        "misogyny_or_sexism" or
+        "sexual_harassment" or
+        "threat_of_violence" or
+        "slur_or_dehumanization" or
+        "body_shaming" or
+        "other" or null,
+    "gbv_secondary_categories": [zero or more of the categories above],
+    "target": "individual" or "group" or null,
+    "segments": ["exact text spans"],
+    "reason": "short explanation"
+    }}
+
+    Text:
+    \"\"\"{comment}\"\"\"
+    """
+
+
+###--  Both tasks in one prompt (UnifiedLLMRunner(task=["appearance", "gbv"])) --###
+def build_prompt_multitask(comment: str) -> str:
+    return f"""
+    You are an information extraction system.
+
+    Tasks:
+    1. appearance: Detect appearance-related content in the text and determine its valence.
+    2. gbv: Detect gender-based violence (GBV) in the text.
+
+    Rules (appearance):
+    - If appearance is detected (contains_appearance = true),
+    you MUST assign exactly ONE appearance_sub_category.
+    - If appearance is NOT detected (contains_appearance = false),
+    appearance_sub_category MUST be null,
+    appearance_valence MUST be null,
+    and segments MUST be an empty list.
+
+    Rules (gbv):
+    - If GBV is detected (contains_gbv = true),
+    you MUST assign exactly ONE gbv_primary_category
+    and a target.
+    - gbv_secondary_categories lists any further categories that apply
+    (possibly empty).
+    - If GBV is NOT detected (contains_gbv = false),
+    gbv_primary_category MUST be null,
+    gbv_secondary_categories MUST be an empty list,
+    target MUST be null,
+    and segments MUST be an empty list.
+
+    Definitions:
+    Appearance-related content refers to descriptions of a person's:
+    - Facial features
+    - Body features
+    - Clothing or dress
+    - Cleanliness or grooming
+    - Evaluative framing of physical looks
+
+    Valence categories:
+    - negative (insulting, mocking, degrading)
+    - positive (complimenting but appearance-focused, may reinforce objectification)
+    - neutral (descriptive without evaluative tone)
+
+    Gender-based violence refers to content that attacks, threatens,
+    degrades or harasses a person because of their gender, including:
+    - Misogynistic or sexist insults and stereotypes
+    - Sexual harassment or objectification
+    - Threats of physical or sexual violence
+    - Slurs and dehumanizing language
+    - Body shaming
+
+    Each task is answered independently; segments and reason refer to
+    that task only.
+
+    Output format (STRICT JSON ONLY):
+    {{
+    "appearance": {{
+        "contains_appearance": true or false,
+        "appearance_sub_category":
+            "facial_features" or
+            "body_features" or
+            "clothing_or_dress" or
+            "cleanliness_or_grooming" or
+            "evaluative_framing" or null,
+        "appearance_valence": "negative" or "positive" or "neutral" or null,
+        "segments": ["exact text spans"],
+        "reason": "short explanation"
+    }},
+    "gbv": {{
+        "contains_gbv": true or false,
+        "gbv_primary_category":
+            "misogyny_or_sexism" or
+            "sexual_harassment" or
+            "threat_of_violence" or
+            "slur_or_dehumanization" or
+            "body_shaming" or
+            "other" or null,
+        "gbv_secondary_categories": [zero or more of the gbv categories above],
+        "target": "individual" or "group" or null,
+        "segments": ["exact text spans"],
+        "reason": "short explanation"
+    }}
+    }}
+
+    Text:
+    \"\"\"{comment}\"\"\"
+    """
@@ -0,0 +1,385 @@
+#------------------------------- Online classification service -------------------------------#
+# Keeps one model resident and classifies comments as they arrive:
+#   python serve.py --model llama3_8b --task appearance --port 8080
+#   python serve.py --model llama3_8b --stdin < replies.jsonl
+# Requests ({"cid", "text"}, a list of them, or {"comments": [...]}) are
+# queued per comment; MicroBatcher coalesces whatever is waiting into one
+# batch of up to max_batch_size, waiting at most max_wait after the first
+# comment arrived. Batches run through the runner's prepare / generate /
+# decode stages in one worker thread and come back as parsed records
+# (output_parser row logic), e.g. POST /classify -> {"results": [...]}.
+# GET /stats reports latency percentiles and batch fill.
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_runner import UnifiedLLMRunner, clean_output
+from model_registry import LLM_MODELS
+from output_parser import iter_rows, PARSE_COLUMNS
+
+
+# -------------------------
+# Model side
+# -------------------------
+
+class LLMService:
+    """
+    One resident model; classify() is blocking and runs a whole batch.
+    """
+
+    def __init__(self, runner, model_name, model_id):
+        if runner.mode != "generate" or len(runner.tasks) > 1:
+            raise ValueError("The service runs generate mode for one task")
+        self.runner = runner
+        self.session = runner.open_session(model_name, model_id)
+        self.model_name = model_name
+
+    def classify(self, comments):
+        """
+        [(cid, text)] -> parsed record dict per comment, in order.
+        """
+        runner = self.runner
+        texts = [text for _, text in comments]
+        prompts = self.session["renderer"].render_many(texts)
+        outputs = runner.generate_cached(self.session, prompts, texts)
+
+        lines = [
+            json.dumps({"model": self.model_name, "cid": cid, "raw_output": clean_output(output).strip()})
+            for (cid, _), output in zip(comments, outputs)
+        ]
+        columns = PARSE_COLUMNS[runner.task_name]
+        rows = iter_rows(runner.task_name, lines, dict(comments))
+        return [dict(zip(columns, row)) for row in rows]
+
+
+# -------------------------
+# Micro-batching
+# -------------------------
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ServiceStats:
+
+    def __init__(self, max_batch_size, window=10000):
+        self.max_batch_size = max_batch_size
+        # Latest `window` request latencies (seconds)
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.comments = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def summary(self):
+        latencies = list(self.latencies)
+        batches = sum(self.batch_sizes.values())
+        rows = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "requests": self.requests,
+            "comments": self.comments,
+            "errors": self.errors,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50) * 1000,
+                "p90": percentile(latencies, 0.90) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+                "max": max(latencies, default=0.0) * 1000,
+            },
+            "batches": batches,
+            "mean_batch_size": rows / batches if batches else 0.0,
+            "batch_fill": rows / (batches * self.max_batch_size) if batches else 0.0,
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+class MicroBatcher:
+
+    def __init__(self, handler, max_batch_size=8, max_wait=0.02):
+        """
+        handler([(cid, text)]) -> [result]: blocking, run in one worker thread.
+        max_wait: seconds a comment may wait for others to join its batch.
+        """
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-batch")
+        self.stats = ServiceStats(max_batch_size)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, comments):
+        """
+        Results for a list of (cid, text), once every comment's batch ran.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        futures = []
+        for comment in comments:
+            future = loop.create_future()
+            self.queue.put_nowait((comment, future))
+            futures.append(future)
+
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            self.stats.requests += 1
+            self.stats.comments += len(comments)
+            self.stats.latencies.append(time.perf_counter() - start)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.stats.batch_sizes[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.handler, [comment for comment, _ in batch]
+                )
+            except Exception as e:
+                self.stats.errors += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+        self.executor.shutdown(wait=True)
+
+
+def parse_request(payload, next_cid):
+    """
+    {"cid", "text"} | [{...}, ...] | {"comments": [...]} | "text"
+    -> [(cid, text)]; missing cids come from next_cid().
+    """
+    if isinstance(payload, dict) and "comments" in payload:
+        payload = payload["comments"]
+    if not isinstance(payload, list):
+        payload = [payload]
+
+    comments = []
+    for item in payload:
+        if isinstance(item, str):
+            item = {"text": item}
+        if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+            raise ValueError("Each comment needs a string 'text'")
+        cid = item.get("cid")
+        comments.append((str(cid) if cid is not None else next_cid(), item["text"]))
+    return comments
+
+
+# -------------------------
+# HTTP / stdin front ends
+# -------------------------
+
+class ClassificationServer:
+
+    def __init__(self, batcher, max_body=1 << 20):
+        self.batcher = batcher
+        self.max_body = max_body
+        self.counter = 0
+
+    def next_cid(self):
+        self.counter += 1
+        return f"req-{self.counter}"
+
+    async def handle(self, method, path, body):
+        """
+        (status, payload) for one request.
+        """
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/stats":
+            return 200, self.batcher.stats.summary()
+        if method == "POST" and path == "/classify":
+            try:
+                comments = parse_request(json.loads(body or b"null"), self.next_cid)
+            except ValueError as e:
+                return 400, {"error": str(e)}
+            try:
+                return 200, {"results": await self.batcher.submit(comments)}
+            except Exception as e:
+                return 500, {"error": str(e)}
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive; one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > self.max_body:
+                    status, payload = 413, {"error": "Request body too large"}
+                    body = None
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.handle(method, path.split("?")[0], body)
+
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close"
+                    and version == "HTTP/1.1"
+                    and body is not None
+                )
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.connection, host, port)
+        print(f"🚀 Serving on http://{host}:{port} (POST /classify, GET /stats)", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+
+async def serve_stdin(batcher, out=None):
+    """
+    One JSON request per input line; one JSON record per comment is
+    written as soon as its batch finishes (completion order).
+    """
+    out = out or sys.stdout
+    loop = asyncio.get_running_loop()
+    counter = [0]
+    pending = set()
+
+    def next_cid():
+        counter[0] += 1
+        return f"line-{counter[0]}"
+
+    async def answer(comments):
+        try:
+            results = await batcher.submit(comments)
+        except Exception as e:
+            results = [{"comment_id": cid, "error": str(e)} for cid, _ in comments]
+        for result in results:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            comments = parse_request(json.loads(line), next_cid)
+        except ValueError as e:
+            out.write(json.dumps({"error": str(e)}) + "\n")
+            continue
+        task = loop.create_task(answer(comments))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.gather(*pending)
+
+
+async def run_service(service, args, out):
+    batcher = MicroBatcher(service.classify, args.max_batch_size, args.max_wait_ms / 1000)
+    batcher.start()
+    try:
+        if args.stdin:
+            await serve_stdin(batcher, out)
+        else:
+            await ClassificationServer(batcher).serve(args.host, args.port)
+    finally:
+        await batcher.close()
+        print(json.dumps(batcher.stats.summary(), indent=2), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online comment classification")
+    parser.add_argument("--model", choices=sorted(LLM_MODELS), required=True)
+    parser.add_argument("--task", choices=["appearance", "gbv"], default="appearance")
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--cpu-dtype", choices=["float32", "bfloat16", "int8"], default="float32")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads (CPU)")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the decode step")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20.0)
+    parser.add_argument("--max-new-tokens", type=int, default=180)
+    parser.add_argument("--constrained", action="store_true")
+    parser.add_argument("--stdin", action="store_true", help="JSON lines on stdin instead of HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    out = sys.stdout
+    # Runner progress goes to stderr; stdout carries stdin-mode results
+    with contextlib.redirect_stdout(sys.stderr):
+        runner = UnifiedLLMRunner(
+            task=args.task,
+            batch_size=args.max_batch_size,
+            max_new_tokens=args.max_new_tokens,
+            device=args.device,
+            cpu_dtype=args.cpu_dtype,
+            num_threads=args.threads,
+            compile_decode=args.compile,
+            constrained=args.constrained,
+        )
+        service = LLMService(runner, args.model, LLM_MODELS[args.model])
+        try:
+            asyncio.run(run_service(service, args, out))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
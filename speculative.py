@@ -0,0 +1,175 @@
+#------------------------------- Speculative decoding -------------------------------#
+# The outputs are short, templated JSON, so cheap guesses are often right:
+#   - "draft": a small model sharing the target's tokenizer proposes tokens
+#     (DRAFT_MODELS pairs each LLM_MODELS entry with one)
+#   - "prompt_lookup": n-grams copied from the prompt text (segments quote
+#     the comment, keys repeat the instructions); needs no second model
+# The target model verifies every proposal in one forward pass; under greedy
+# decoding the output is the same as plain generation.
+# transformers' assisted generation (the public assistant_model /
+# prompt_lookup_num_tokens generate kwargs) handles one row per call, so
+# batches are generated row by row (left padding stripped). That loses the
+# batching, so UnifiedLLMRunner times both on the first batch and keeps
+# speculative decoding only when it is at least MIN_SPEEDUP faster.
+
+from contextlib import contextmanager
+import time
+import torch
+
+from json_scanner import repair_json_object
+
+SPECULATIVE_MODES = ("draft", "prompt_lookup")
+
+# Row-by-row speculative vs batched plain generation on the first batch
+MIN_SPEEDUP = 1.1
+
+
+def new_stats():
+    return {"rows": 0, "steps": 0, "draft_steps": 0, "proposed": 0, "generated_tokens": 0}
+
+
+def summarize(stats):
+    """
+    Acceptance rate (accepted / proposed draft tokens) and tokens per
+    target verification pass. Each pass keeps its accepted drafts plus one
+    token of its own, so accepted = generated_tokens - steps.
+    """
+    summary = dict(stats)
+    summary["accepted"] = max(stats["generated_tokens"] - stats["steps"], 0)
+    summary["acceptance_rate"] = summary["accepted"] / stats["proposed"] if stats["proposed"] else 0.0
+    summary["tokens_per_step"] = stats["generated_tokens"] / stats["steps"] if stats["steps"] else 0.0
+    return summary
+
+
+@contextmanager
+def count_steps(model, stats):
+    """
+    Count the target model's verification passes and the draft tokens each
+    one checks while the context is open. Assisted generation asks for
+    logits_to_keep = drafts + 1; the first pass of a row also prefills the
+    prompt, which is not counted as drafts.
+    """
+    def hook(module, args, kwargs):
+        keep = kwargs.get("logits_to_keep")
+        if isinstance(keep, int) and keep > 0:
+            drafts = keep - 1
+        else:
+            # No logits_to_keep: after the prefill pass the input is the
+            # last accepted token + the drafts
+            cache = kwargs.get("past_key_values")
+            input_ids = kwargs.get("input_ids")
+            prefill = cache is None or cache.get_seq_length() == 0
+            drafts = 0 if prefill or input_ids is None else input_ids.shape[1] - 1
+        stats["steps"] += 1
+        stats["proposed"] += drafts
+        stats["draft_steps"] += drafts > 0
+
+    handle = model.register_forward_pre_hook(hook, with_kwargs=True)
+    try:
+        yield stats
+    finally:
+        handle.remove()
+
+
+def speculative_kwargs(mode, draft_model=None, prompt_lookup_tokens=10):
+    if mode == "draft":
+        return {"assistant_model": draft_model}
+    if mode == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": prompt_lookup_tokens}
+    raise ValueError(f"Speculative mode must be one of {SPECULATIVE_MODES}")
+
+
+def generate_rows(model, input_ids, attention_mask, make_kwargs, pad_token_id, stats=None):
+    """
+    Assisted generation one row at a time.
+    make_kwargs(prompt_length) -> generate kwargs for one row.
+    Returns the generated ids [rows, longest], padded with pad_token_id.
+    """
+    generated = []
+    for row in range(input_ids.shape[0]):
+        ids = input_ids[row][attention_mask[row].bool()].unsqueeze(0)
+        with torch.no_grad():
+            out = model.generate(
+                input_ids=ids,
+                attention_mask=torch.ones_like(ids),
+                **make_kwargs(ids.shape[1])
+            )
+        generated.append(out[0, ids.shape[1]:])
+
+    width = max(len(ids) for ids in generated)
+    padded = input_ids.new_full((len(generated), width), pad_token_id)
+    for row, ids in enumerate(generated):
+        padded[row, :len(ids)] = ids
+        if stats is not None:
+            stats["rows"] += 1
+            stats["generated_tokens"] += len(ids)
+    return padded
+
+
+# -------------------------
+# Benchmark
+# -------------------------
+
+def compare_with_plain(model, tokenizer, prompts, mode="prompt_lookup", draft_model=None,
+                       prompt_lookup_tokens=10, max_new_tokens=180, batch_size=8,
+                       stop_table=None):
+    """
+    Greedy plain generation (batched, as the static engine runs it) vs
+    speculative generation of the same prompts. Checks that the cleaned
+    outputs are identical and reports tokens per step and speedup.
+    """
+    from transformers import StoppingCriteriaList
+    from json_stopping import StopOnJSONEnd
+
+    device = next(model.parameters()).device
+
+    def kwargs(prompt_length=None):
+        return dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            repetition_penalty=1.1,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList(
+                [StopOnJSONEnd(stop_table, prompt_length)] if stop_table is not None else []
+            )
+        )
+
+    def decode(ids):
+        return [repair_json_object(text) for text in tokenizer.batch_decode(ids, skip_special_tokens=True)]
+
+    plain, spec = [], []
+    plain_seconds = spec_seconds = 0.0
+    stats = new_stats()
+    extra = speculative_kwargs(mode, draft_model, prompt_lookup_tokens)
+
+    for i in range(0, len(prompts), batch_size):
+        enc = tokenizer(prompts[i:i+batch_size], return_tensors="pt", padding=True).to(device)
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            out = model.generate(**enc, **kwargs())
+        plain_seconds += time.perf_counter() - start
+        plain.extend(decode(out[:, enc["input_ids"].shape[1]:]))
+
+        start = time.perf_counter()
+        with count_steps(model, stats):
+            ids = generate_rows(
+                model, enc["input_ids"], enc["attention_mask"],
+                lambda length: {**kwargs(length), **extra},
+                tokenizer.eos_token_id, stats
+            )
+        spec_seconds += time.perf_counter() - start
+        spec.extend(decode(ids))
+
+    report = summarize(stats)
+    report.update({
+        "mode": mode,
+        "prompts": len(prompts),
+        "plain_seconds": plain_seconds,
+        "speculative_seconds": spec_seconds,
+        "speedup": plain_seconds / spec_seconds if spec_seconds else 0.0,
+        "identical": plain == spec,
+        "mismatches": sum(a != b for a, b in zip(plain, spec)),
+    })
+    return report
@@ -6,25 +6,20 @@
 import os
 from llm_runner import UnifiedLLMRunner
 from model_registry import LLM_MODELS
-import json
-import csv
-from output_parser import parse_appearance_output_file
-
+from parallel_parser import parse_output_files
+from comment_stream import (
+    CommentStream,
+    CommentStore,
+    iter_comments_json,
+    iter_comments_csv
+)
+
+# In-memory loaders, fine for small datasets; main() streams instead
 def load_comments_from_json(path):
-    comments = []
-    with open(path, "r") as file:
-        cData = json.load(file)
-        for cid, comment in cData.items():
-            comments.append((cid, comment))
-    return comments
+    return list(iter_comments_json(path))
 
 def load_comments_from_csv(path):
-    comments = []
-    with open(path, "r") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            comments.append((row["tweet_id"], row["tweet"]))
-    return comments
+    return list(iter_comments_csv(path))
 
 def main():
     # input_path = "/datasets/cl0059/outputs/bluesky_replies_sampled_5000.json"
@@ -36,29 +31,37 @@ def main():
     print("🚀 STARTING SOTA MODEL TEST SUITE")
     print("=" * 60)
 
-    if input_path.endswith(".json"):
-        comments = load_comments_from_json(input_path)
-    elif input_path.endswith(".csv"):
-        comments = load_comments_from_csv(input_path)
-    
+    # Re-iterable stream: each model re-reads the file lazily
+    comments = CommentStream(input_path)
+
     # for debug, limit to 10 comments
-    # comments = comments[:10]
+    # comments = load_comments_from_csv(input_path)[:10]
 
-    runner = UnifiedLLMRunner(task="appearance", batch_size=8, max_new_tokens=180)
+    # Quantized weights are cached after the first run; reruns warm-start
+    runner = UnifiedLLMRunner(
+        task="appearance", batch_size=8, max_new_tokens=180,
+        load_cache_dir="/datasets/cl0059/outputs/model_cache"
+    )
     runner.run_all(comments, datasetName)
 
     print("\n" + "=" * 60)
     print("✅ TEST SUITE COMPLETE")
     print("=" * 60)
 
-    # Build lookup dictionary
-    comment_lookup = {cid: text for cid, text in comments}
-
     results_dir = "/datasets/cl0059/outputs/llm_results"
     parsed_dir = "/datasets/cl0059/outputs/parsed_csv"
 
     os.makedirs(parsed_dir, exist_ok=True)
 
+    # Build on-disk lookup (cid -> text) instead of an in-memory dict
+    comment_lookup = CommentStore.from_stream(
+        comments,
+        os.path.join(parsed_dir, f"{datasetName}_comments.sqlite")
+    )
+
+    # Parse every model's results in parallel; parquet=True also writes
+    # typed .parquet files next to the CSVs for agreement analysis
+    jobs = []
     for model_name in LLM_MODELS.keys():
 
         input_jsonl = os.path.join(
@@ -71,12 +74,9 @@ def main():
             f"{model_name}_appearance_parsed_{datasetName}.csv"
         )
 
-        if os.path.exists(input_jsonl):
-            parse_appearance_output_file(
-                input_jsonl,
-                comment_lookup,
-                output_csv
-            )
+        jobs.append({"task": "appearance", "input": input_jsonl, "output": output_csv})
+
+    parse_output_files(jobs, comment_lookup, parquet=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+# run_adaptive on CPU: the stub model generates, OOMAbove fakes the
+# out-of-memory errors.
+#
+#   python -m pytest -q tests/test_adaptive_batch.py
+
+import json
+
+from adaptive_batch import OOMAbove, SafeBatchSizes
+from benchmarks import BenchmarkRunner, StubModel, build_tokenizer, synthetic_corpus
+
+MODEL_ID = "stub-model"
+
+
+class RecordingRunner(BenchmarkRunner):
+    """
+    Records (cids, succeeded) for every generate call.
+    """
+
+    def __init__(self, model, tokenizer, **kwargs):
+        super().__init__(model, tokenizer, **kwargs)
+        self.calls = []
+
+    def generate_batch(self, session, job):
+        cids = [job["cids"][i] for i in job["missing"]]
+        try:
+            job = super().generate_batch(session, job)
+        except Exception:
+            self.calls.append((cids, False))
+            raise
+        self.calls.append((cids, True))
+        return job
+
+
+def run(workdir, comments, oom_above, **kwargs):
+    tokenizer = build_tokenizer()
+    injector = OOMAbove(oom_above)
+    runner = RecordingRunner(
+        StubModel(tokenizer), tokenizer,
+        adaptive_batch=True,
+        oom_injector=injector,
+        max_new_tokens=32,
+        output_base=str(workdir),
+        **kwargs
+    )
+    runner.datasetName = "adaptive"
+    runner.process_dataset(comments, "stub", MODEL_ID)
+
+    with open(runner.output_path("stub"), encoding="utf-8") as f:
+        written = [json.loads(line)["cid"] for line in f]
+    return runner, injector, written
+
+
+def test_oom_halves_and_retries_only_the_failed_batch(tmp_path):
+    comments = synthetic_corpus(60, seed=1)
+    runner, injector, written = run(tmp_path, comments, oom_above=6, batch_size=4, max_batch_size=16)
+
+    failures = [i for i, (_, ok) in enumerate(runner.calls) if not ok]
+    assert failures and injector.raised == len(failures)
+
+    for i in failures:
+        failed, _ = runner.calls[i]
+        retried, _ = runner.calls[i + 1]
+        # Same rows, front half first
+        assert retried == failed[:len(failed) // 2]
+
+    # Every comment generated once, in order, and nothing else re-run
+    succeeded = [cid for cids, ok in runner.calls if ok for cid in cids]
+    assert succeeded == [cid for cid, _ in comments]
+    assert sorted(written) == sorted(cid for cid, _ in comments)
+
+
+def test_grows_up_to_max_batch_size_and_stays_under_the_failing_size(tmp_path):
+    comments = synthetic_corpus(80, seed=2)
+    runner, injector, _ = run(tmp_path, comments, oom_above=100, batch_size=2, max_batch_size=8)
+
+    sizes = [len(cids) for cids, _ in runner.calls]
+    assert injector.raised == 0
+    assert sizes[:6] == [2, 2, 4, 4, 8, 8]
+    assert max(sizes) == 8
+
+    runner, injector, _ = run(tmp_path / "oom", comments, oom_above=6, batch_size=4, max_batch_size=16)
+    first_failure = next(i for i, (_, ok) in enumerate(runner.calls) if not ok)
+    ceiling = len(runner.calls[first_failure][0])
+    assert all(len(cids) <= 6 for cids, ok in runner.calls if ok)
+    assert all(len(cids) < ceiling for cids, _ in runner.calls[first_failure + 1:])
+    assert runner.last_adaptive_stats["safe"] == 6
+
+
+def test_safe_size_is_remembered_per_model(tmp_path):
+    state = str(tmp_path / "batch_sizes.json")
+    comments = synthetic_corpus(60, seed=3)
+
+    run(tmp_path / "first", comments, oom_above=6, batch_size=4, max_batch_size=16,
+        adaptive_state_path=state)
+    remembered = SafeBatchSizes(state).get(MODEL_ID)
+    assert remembered["safe"] == 6
+    assert remembered["ceiling"] == 7
+    assert SafeBatchSizes(state).get("other-model") is None
+
+    # The next run starts at the safe size and never repeats the OOM
+    runner, injector, _ = run(tmp_path / "second", comments, oom_above=6, batch_size=4,
+                              max_batch_size=16, adaptive_state_path=state)
+    assert len(runner.calls[0][0]) == 6
+    assert injector.raised == 0
+    assert all(len(cids) == 6 for cids, _ in runner.calls[:-1])
@@ -0,0 +1,42 @@
+# CommentStream forwards id_field / text_field to whichever reader the
+# file extension picks.
+#
+#   python -m pytest -q tests/test_comment_stream.py
+
+import json
+
+from comment_stream import CommentStream
+
+EXPECTED = [("1", "first"), ("2", 'second, "quoted"')]
+
+
+def test_json_object_of_texts(tmp_path):
+    path = tmp_path / "comments.json"
+    path.write_text(json.dumps(dict(EXPECTED)), encoding="utf-8")
+    assert list(CommentStream(str(path))) == EXPECTED
+
+
+def test_field_names_for_every_format(tmp_path):
+    records = [{"id": cid, "body": text} for cid, text in EXPECTED]
+
+    (tmp_path / "comments.json").write_text(
+        json.dumps({f"key{i}": record for i, record in enumerate(records)}), encoding="utf-8"
+    )
+    (tmp_path / "comments.jsonl").write_text(
+        "".join(json.dumps(record) + "\n" for record in records), encoding="utf-8"
+    )
+    (tmp_path / "comments.csv").write_text(
+        'id,body\n1,first\n2,"second, ""quoted"""\n', encoding="utf-8"
+    )
+
+    for name in ("comments.json", "comments.jsonl", "comments.csv"):
+        stream = CommentStream(str(tmp_path / name), id_field="id", text_field="body")
+        assert list(stream) == EXPECTED, name
+        # Re-iterable
+        assert list(stream) == EXPECTED, name
+
+
+def test_json_records_keyed_by_cid(tmp_path):
+    path = tmp_path / "comments.json"
+    path.write_text(json.dumps({cid: {"body": text} for cid, text in EXPECTED}), encoding="utf-8")
+    assert list(CommentStream(str(path), text_field="body", chunk_size=4)) == EXPECTED
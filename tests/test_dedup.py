@@ -0,0 +1,56 @@
+# The deduper's temporary SQLite file is removed whether process_dataset
+# finishes or fails.
+#
+#   python -m pytest -q tests/test_dedup.py
+
+import json
+import tempfile
+
+import pytest
+
+from benchmarks import BenchmarkRunner, StubModel, build_tokenizer
+
+COMMENTS = [("1", "so fat"), ("2", "nice dress"), ("3", "so  FAT"), ("4", "nice dress")]
+
+
+def fail(rows):
+    raise RuntimeError("generation failed")
+
+
+def run(workdir, oom_injector=None):
+    tokenizer = build_tokenizer()
+    runner = BenchmarkRunner(
+        StubModel(tokenizer), tokenizer,
+        dedup="exact",
+        batch_size=2,
+        max_new_tokens=32,
+        oom_injector=oom_injector,
+        output_base=str(workdir / "out")
+    )
+    runner.datasetName = "dedup"
+    runner.process_dataset(COMMENTS, "stub", "stub-model")
+    return runner
+
+
+@pytest.fixture
+def tempdir(tmp_path, monkeypatch):
+    path = tmp_path / "tmp"
+    path.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(path))
+    return path
+
+
+def test_temp_file_removed_after_run(tmp_path, tempdir):
+    runner = run(tmp_path)
+    assert list(tempdir.iterdir()) == []
+
+    with open(runner.output_path("stub"), encoding="utf-8") as f:
+        written = sorted(json.loads(line)["cid"] for line in f)
+    assert written == ["1", "2", "3", "4"]
+    assert runner.last_dedup_stats["unique"] == 2
+
+
+def test_temp_file_removed_when_run_fails(tmp_path, tempdir):
+    with pytest.raises(RuntimeError, match="generation failed"):
+        run(tmp_path, oom_injector=fail)
+    assert list(tempdir.iterdir()) == []
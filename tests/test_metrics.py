@@ -0,0 +1,68 @@
+# RunMetrics peak memory: per batch, per run and per process, with CUDA's
+# peak counter faked so it runs on CPU.
+#
+#   python -m pytest -q tests/test_metrics.py
+
+import pytest
+
+import metrics
+from metrics import RunMetrics, StageTimer
+
+
+class FakeCuda:
+    """
+    max_memory_allocated / reset_peak_memory_stats of one device.
+    """
+
+    def __init__(self):
+        self.allocated = 0
+        self.peak = 0
+
+    def use(self, nbytes):
+        # Allocate nbytes, then free them again
+        self.peak = max(self.peak, self.allocated + nbytes)
+
+    def is_available(self):
+        return True
+
+    def device_count(self):
+        return 1
+
+    def max_memory_allocated(self, device=None):
+        return self.peak
+
+    def reset_peak_memory_stats(self, device=None):
+        self.peak = self.allocated
+
+
+@pytest.fixture
+def cuda(monkeypatch):
+    fake = FakeCuda()
+    for name in ("is_available", "device_count", "max_memory_allocated", "reset_peak_memory_stats"):
+        monkeypatch.setattr(metrics.torch.cuda, name, getattr(fake, name))
+    return fake
+
+
+def test_peak_memory_is_per_batch_and_per_run(cuda, tmp_path):
+    records = []
+    run_metrics = RunMetrics(prometheus_path=str(tmp_path / "metrics.prom"), hooks=[records.append])
+
+    cuda.use(500)  # an earlier model, before this run
+    run_metrics.start_run("model", "task")
+    for nbytes in (300, 100, 200):
+        cuda.use(nbytes)
+        run_metrics.record_batch("model", "task", {"rows": 1}, StageTimer())
+    run_metrics.finish_run("model", "task")
+
+    assert [r["peak_memory_bytes"] for r in records if r["event"] == "batch"] == [300, 100, 200]
+    assert [r["peak_memory_bytes"] for r in records if r["event"] == "run"] == [300]
+
+    # The next run starts from scratch
+    run_metrics.start_run("model", "task")
+    cuda.use(50)
+    run_metrics.finish_run("model", "task")
+    assert records[-1]["peak_memory_bytes"] == 50
+
+    # The Prometheus gauge is the peak of the whole process
+    prom = (tmp_path / "metrics.prom").read_text()
+    assert "freellm_peak_memory_bytes 500\n" in prom
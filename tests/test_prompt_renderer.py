@@ -0,0 +1,52 @@
+# PromptRenderer's memoized encode() must produce exactly the ids of a
+# full chat-template render + tokenize, on the benchmark tokenizer.
+#
+#   python -m pytest -q tests/test_prompt_renderer.py
+
+import pytest
+
+from benchmarks import build_tokenizer, synthetic_corpus
+from llm_runner import UnifiedLLMRunner
+from prompt_renderer import PromptRenderer, compare_with_full
+
+TRICKY_COMMENTS = [
+    "",
+    " ",
+    "line one\nline two",
+    "\n\nstarts and ends with newlines\n",
+    "  leading and trailing spaces  ",
+    'she said "you look awful"',
+    "it's her 'style', apparently",
+    "\"quoted\" at the start and 'end'",
+    "tabs\tand\r\nwindows newlines",
+    "{\"json\": \"inside\"} and [brackets]",
+    "emoji 😀 and accents: café",
+]
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    tokenizer = build_tokenizer()
+    runner = UnifiedLLMRunner(device="cpu")
+    return PromptRenderer(
+        tokenizer,
+        lambda comment: runner.render_prompt(tokenizer, comment, "llama3_8b"),
+    )
+
+
+def test_tricky_comments_match_full_render(renderer):
+    report = compare_with_full(renderer, TRICKY_COMMENTS, batch_size=4)
+    assert report["fast_path"]
+    assert report["identical"], f"{report['mismatches']} rows differ"
+
+
+def test_each_comment_alone_matches_full_render(renderer):
+    # Batch of one: no padding hides a difference
+    report = compare_with_full(renderer, TRICKY_COMMENTS, batch_size=1)
+    assert report["identical"], f"{report['mismatches']} rows differ"
+
+
+def test_corpus_matches_full_render(renderer):
+    comments = [text for _, text in synthetic_corpus(64, seed=4)]
+    report = compare_with_full(renderer, comments + TRICKY_COMMENTS, batch_size=16)
+    assert report["identical"], f"{report['mismatches']} rows differ"